@@ -14,21 +14,35 @@
 #
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import ast
 import asyncio
-from base64 import b64encode
+import binascii
+from base64 import b64encode, b64decode
 import functools
+import hashlib
+import inspect
+import io
 import logging
+import os
 import random
 import re
+import sqlite3
 import ssl
 import sys
+import tempfile
+import threading
 import time
+from array import array
 from asyncio import BaseTransport, Future
-from collections import namedtuple
+from collections import namedtuple, deque, OrderedDict
+from collections.abc import Sequence
+from contextvars import ContextVar
 from copy import copy
+from itertools import islice
 from datetime import datetime, timezone, timedelta
 from enum import Enum
-from typing import Union, Any, Coroutine, Callable, Optional, Pattern, List
+from typing import Union, Any, Coroutine, Callable, Optional, Pattern, List, AsyncIterator, Iterable, Iterator, \
+    Dict, Tuple
 
 # to avoid imap servers to kill the connection after 30mn idling
 # cf https://www.imapwiki.org/ClientImplementation/Synchronization
@@ -43,6 +57,13 @@ IMAP4_PORT = 143
 IMAP4_SSL_PORT = 993
 STARTED, CONNECTED, NONAUTH, AUTH, SELECTED, LOGOUT = 'STARTED', 'CONNECTED', 'NONAUTH', 'AUTH', 'SELECTED', 'LOGOUT'
 CRLF = b'\r\n'
+# literals (APPEND) are written by chunks of this size, waiting for the transport buffer to drain between them
+LITERAL_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# reading from the transport is paused when more than this is received but not consumed (streaming fetch)
+READ_HIGH_WATER_MARK = 4 * 1024 * 1024
+# cf https://tools.ietf.org/html/rfc7888#section-4
+LITERAL_MINUS_MAX_SIZE = 4096
 
 ID_MAX_PAIRS_COUNT = 30
 ID_MAX_FIELD_LEN = 30
@@ -99,6 +120,87 @@ Commands = {
 Response = namedtuple('Response', 'result lines')
 
 
+class ResponseLines(Sequence):
+    """
+    The lines of a response while it is received, stored in a single buffer with their end offsets
+    instead of one object per line. The literal data (bytearray) are kept as they are, without copy.
+    The lines are given back with the type they were added with : bytes, bytearray (literal data) or
+    str. tolist() builds the list of the lines once and drops the buffer : the list is the Response.lines
+    of the command and the next lines are appended to it.
+    """
+    __slots__ = ('_buffer', '_ends', '_types', '_literals', '_list')
+    _BYTES, _BYTEARRAY, _STR = 0, 1, 2
+
+    def __init__(self, lines: Iterable[Union[bytes, bytearray, str]] = ()) -> None:
+        self.clear()
+        for line in lines:
+            self.append(line)
+
+    def append(self, line: Union[bytes, bytearray, str]) -> None:
+        if self._list is not None:
+            self._list.append(line)
+            return
+        if isinstance(line, str):
+            self._buffer += line.encode()
+            self._types.append(self._STR)
+        elif isinstance(line, bytearray):
+            self._literals[len(self._ends)] = line
+            self._types.append(self._BYTEARRAY)
+        else:
+            self._buffer += line
+            self._types.append(self._BYTES)
+        self._ends.append(len(self._buffer))
+
+    def clear(self) -> None:
+        self._buffer = bytearray()
+        self._ends = array('Q')
+        self._types = bytearray()
+        self._literals: Dict[int, bytearray] = dict()
+        self._list: Optional[list] = None
+
+    def tolist(self) -> List[Union[bytes, bytearray, str]]:
+        """the lines as a list, built once : the buffer is released then"""
+        if self._list is None:
+            self._list = [self._line(index) for index in range(len(self._ends))]
+            self._buffer, self._ends, self._types, self._literals = None, None, None, None
+        return self._list
+
+    def _line(self, index: int) -> Union[bytes, bytearray, str]:
+        line_type = self._types[index]
+        if line_type == self._BYTEARRAY:
+            return self._literals[index]
+        with memoryview(self._buffer) as buffer:
+            data = buffer[self._ends[index - 1] if index else 0:self._ends[index]]
+            return bytes(data) if line_type == self._BYTES else str(data, 'utf-8')
+
+    def __getitem__(self, index):
+        if self._list is not None:
+            return self._list[index]
+        if isinstance(index, slice):
+            return [self._line(i) for i in range(*index.indices(len(self._ends)))]
+        if index < 0:
+            index += len(self._ends)
+        if not 0 <= index < len(self._ends):
+            raise IndexError('response line index out of range')
+        return self._line(index)
+
+    def __iter__(self) -> Iterator[Union[bytes, bytearray, str]]:
+        return iter(self.tolist())
+
+    def __len__(self) -> int:
+        return len(self._list) if self._list is not None else len(self._ends)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (ResponseLines, list, tuple)):
+            return self.tolist() == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return repr(self.tolist())
+
+
 def get_running_loop() -> asyncio.AbstractEventLoop:
     if PY37_OR_LATER:
         return asyncio.get_running_loop()
@@ -140,7 +242,59 @@ def arguments_rfs2971(**kwargs: Union[dict, list, str]) -> Union[dict, list]:
     return args
 
 
+class TimeoutScheduler(object):
+    """
+    Checks the timeouts of the commands of a connection with a single timer handle.
+    Commands only record the time of their last activity (there is no timer to cancel and
+    create again for each received line) : when the timer expires, the commands that have been
+    inactive for their timeout are timed out, and the timer is armed again for the next deadline.
+    """
+    __slots__ = ('_loop', '_commands', '_handle')
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        self._loop = loop
+        self._commands = dict()  # by id : commands are not hashable
+        self._handle: Optional[asyncio.TimerHandle] = None
+
+    def register(self, command: 'Command') -> None:
+        self._commands[id(command)] = command
+        self._arm(command.deadline())
+
+    def unregister(self, command: 'Command') -> None:
+        self._commands.pop(id(command), None)
+        if not self._commands and self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
+
+    def _arm(self, when: float) -> None:
+        if self._handle is not None:
+            if self._handle.when() <= when:
+                return
+            self._handle.cancel()
+        self._handle = self._loop.call_at(when, self._expire)
+
+    def _expire(self) -> None:
+        self._handle = None
+        now = self._loop.time()
+        next_deadline = None
+        for command in list(self._commands.values()):
+            deadline = command.deadline()
+            if deadline <= now:
+                self._commands.pop(id(command))
+                command._timeout_callback()
+            elif next_deadline is None or deadline < next_deadline:
+                next_deadline = deadline
+        if next_deadline is not None:
+            self._arm(next_deadline)
+
+
 class Command(object):
+    __slots__ = ('name', 'tag', 'args', 'prefix', 'untagged_resp_name', '_exception', '_loop', '_event',
+                 '_timeout', '_scheduler', '_last_activity', '_expected_size', '_resp_literal_data',
+                 '_resp_result', '_resp_lines')
+    # overrides the Exec of the Commands table
+    exec_mode: Optional[Exec] = None
+
     def __init__(self, name: str, tag: str, *args, prefix: str = None, untagged_resp_name: str = None,
                  loop: asyncio.AbstractEventLoop = None, timeout: float = None) -> None:
         self.name = name
@@ -153,13 +307,13 @@ class Command(object):
         self._loop = loop if loop is not None else get_running_loop()
         self._event = asyncio.Event()
         self._timeout = timeout
-        self._timer = asyncio.Handle(lambda: None, None, self._loop)  # fake timer
-        self._set_timer()
+        self._scheduler: Optional[TimeoutScheduler] = None
+        self._last_activity = self._loop.time()
         self._expected_size = 0
 
-        self._resp_literal_data = bytearray()
+        self._resp_literal_data: Optional[bytearray] = None
         self._resp_result = 'Init'
-        self._resp_lines: List[bytes] = list()
+        self._resp_lines = ResponseLines()
 
     def __repr__(self) -> str:
         return '{tag} {prefix}{name}{space}{args}'.format(
@@ -173,15 +327,21 @@ class Command(object):
 
     @property
     def response(self):
-        return Response(self._resp_result, self._resp_lines)
+        return Response(self._resp_result, self._resp_lines.tolist())
 
     def close(self, line: bytes, result: str) -> None:
         self.append_to_resp(line, result=result)
-        self._timer.cancel()
+        if self._scheduler is not None:
+            self._scheduler.unregister(self)
         self._event.set()
 
+    def abort(self, exception: Exception) -> None:
+        self._exception = exception
+        self.close(str(exception).encode(), 'KO')
+
     def begin_literal_data(self, expected_size: int, literal_data: bytes = b'') -> bytes:
         self._expected_size = expected_size
+        self._resp_literal_data = bytearray()
         return self.append_literal_data(literal_data)
 
     def wait_literal_data(self) -> bool:
@@ -214,36 +374,154 @@ class Command(object):
 
     def _end_literal_data(self) -> None:
         self._expected_size = 0
-        self._resp_literal_data = bytearray()
+        self._resp_literal_data = None
 
-    def _set_timer(self) -> None:
-        if self._timeout is not None:
-            self._timer = self._loop.call_later(self._timeout, self._timeout_callback)
+    def deadline(self) -> float:
+        return self._last_activity + self._timeout
+
+    def use_scheduler(self, scheduler: TimeoutScheduler) -> None:
+        """
+        starts the command timeout with a scheduler shared with other commands (the connection's one),
+        the inactivity is counted from the command creation
+        """
+        if self._timeout is not None and self._scheduler is None and not self._event.is_set():
+            self._scheduler = scheduler
+            scheduler.register(self)
 
     def _timeout_callback(self) -> None:
-        self._exception = CommandTimeout(self)
-        self.close(str(self._exception).encode(), 'KO')
+        self.abort(CommandTimeout(self))
 
     def _reset_timer(self) -> None:
-        self._timer.cancel()
-        self._set_timer()
+        self._last_activity = self._loop.time()
 
 
 class FetchCommand(Command):
     FETCH_MESSAGE_DATA_RE = re.compile(rb'[0-9]+ FETCH \(')
+    __slots__ = ('_open_parenthesis',)
 
     def __init__(self, tag: str, *args, prefix: str = None, untagged_resp_name: str = None,
                  loop: asyncio.AbstractEventLoop = None, timeout: float = None) -> None:
         super().__init__('FETCH', tag, *args, prefix=prefix, untagged_resp_name=untagged_resp_name,
                          loop=loop, timeout=timeout)
+        self._open_parenthesis = 0
+
+    def append_to_resp(self, line: bytes, result: str = 'Pending') -> None:
+        super().append_to_resp(line, result)
+        # parenthesis are counted from the last message data line, literals (bytearray) are not counted
+        if isinstance(line, bytes):
+            if self.FETCH_MESSAGE_DATA_RE.match(line):
+                self._open_parenthesis = 0
+            self._open_parenthesis += line.count(b'(') - line.count(b')')
 
     def wait_data(self) -> bool:
-        last_fetch_index = 0
-        for index, line in enumerate(self._resp_lines):
-            if isinstance(line, bytes) and self.FETCH_MESSAGE_DATA_RE.match(line):
-                last_fetch_index = index
-        return not matched_parenthesis(b''.join(filter(lambda l: isinstance(l, bytes),
-                                                      self.response.lines[last_fetch_index:])))
+        return self._open_parenthesis != 0
+
+
+class AppendCommand(Command):
+    """
+    APPEND command with the literal data to send : bytes-like, path, binary file object or (async) iterable of bytes.
+    When literal_size is given, the literal data sent is checked against it.
+    """
+    __slots__ = ('literal_data', 'literal_size')
+
+    def __init__(self, tag: str, literal_data: Any, *args, literal_size: int = None, prefix: str = None,
+                 untagged_resp_name: str = None, loop: asyncio.AbstractEventLoop = None, timeout: float = None) -> None:
+        super().__init__('APPEND', tag, *args, prefix=prefix, untagged_resp_name=untagged_resp_name,
+                         loop=loop, timeout=timeout)
+        self.literal_data = literal_data
+        self.literal_size = literal_size
+
+    @property
+    def non_synchronizing(self) -> bool:
+        """the literal is sent right after the command line, without waiting for a continuation (LITERAL+)"""
+        return bool(self.args) and str(self.args[-1]).endswith('+}')
+
+
+class AuthenticateCommand(Command):
+    """AUTHENTICATE command answering the server challenges with its SASL mechanism"""
+    __slots__ = ('mechanism',)
+
+    def __init__(self, tag: str, mechanism: 'SaslMechanism', *args, loop: asyncio.AbstractEventLoop = None,
+                 timeout: float = None) -> None:
+        super().__init__('AUTHENTICATE', tag, mechanism.name, *args, loop=loop, timeout=timeout)
+        self.mechanism = mechanism
+
+
+class StatusCommand(Command):
+    """
+    STATUS command. Its untagged responses are routed with the mailbox name, so the STATUS commands for
+    different mailboxes run at the same time.
+    """
+    __slots__ = ()
+
+    def __init__(self, tag: str, mailbox: str, names: str, loop: asyncio.AbstractEventLoop = None,
+                 timeout: float = None) -> None:
+        super().__init__('STATUS', tag, mailbox, names, untagged_resp_name=status_resp_name(mailbox.encode()),
+                         loop=loop, timeout=timeout)
+
+
+class ListStatusCommand(Command):
+    """
+    LIST RETURN (STATUS (...)) (rfc5819). The server interleaves the untagged LIST and STATUS responses, the command
+    is sync so that it receives both (with their names) and no STATUS command runs meanwhile.
+    """
+    __slots__ = ()
+    exec_mode = Exec.is_sync
+
+    def __init__(self, tag: str, reference_name: str, mailbox_pattern: str, status_items: str,
+                 loop: asyncio.AbstractEventLoop = None, timeout: float = None) -> None:
+        super().__init__('LIST', tag, reference_name, mailbox_pattern, 'RETURN (STATUS (%s))' % status_items,
+                         loop=loop, timeout=timeout)
+
+
+class StreamingFetchCommand(FetchCommand):
+    """
+    FETCH command that puts the message data (list of lines) in a queue as soon as they are complete,
+    instead of keeping them in the response. on_data is called with the size of the data of the streamed
+    messages while it is received, the literals by chunks : received_size is the size of the message being
+    received, not queued yet.
+    """
+    __slots__ = ('queue', 'on_data', 'received_size')
+
+    def __init__(self, tag: str, queue: Optional[asyncio.Queue], *args, prefix: str = None,
+                 untagged_resp_name: str = None, loop: asyncio.AbstractEventLoop = None, timeout: float = None,
+                 on_data: Callable[[int], None] = None) -> None:
+        super().__init__(tag, *args, prefix=prefix, untagged_resp_name=untagged_resp_name,
+                         loop=loop, timeout=timeout)
+        self.queue = queue
+        self.on_data = on_data
+        self.received_size = 0
+
+    def append_literal_data(self, data: bytes) -> bytes:
+        self._received(min(len(data), self._expected_size - len(self._resp_literal_data)))
+        return super().append_literal_data(data)
+
+    def append_to_resp(self, line: bytes, result: str = 'Pending') -> None:
+        if result == 'Pending' and not isinstance(line, bytearray):  # literals are counted by chunks
+            self._received(len(line))
+        super().append_to_resp(line, result)
+        if result == 'Pending' and not self.wait_data():
+            message = self._resp_lines.tolist()
+            self._resp_lines.clear()
+            self.received_size = 0
+            if self.queue is not None:
+                self.queue.put_nowait(message)
+
+    def _received(self, size: int) -> None:
+        if self.queue is not None:
+            self.received_size += size
+            if self.on_data is not None:
+                self.on_data(size)
+
+    def stop_streaming(self) -> int:
+        """the next messages are dropped, returns the size counted for the message being received"""
+        self.queue = None
+        size, self.received_size = self.received_size, 0
+        return size
+
+
+def message_size(lines: List[bytes]) -> int:
+    return sum(len(line) for line in lines)
 
 
 def matched_parenthesis(fetch_response: bytes) -> bool:
@@ -251,6 +529,8 @@ def matched_parenthesis(fetch_response: bytes) -> bool:
 
 
 class IdleCommand(Command):
+    __slots__ = ('queue', 'buffer')
+
     def __init__(self, tag: str, queue: asyncio.Queue, *args, prefix: str = None, untagged_resp_name: str = None,
                  loop: asyncio.AbstractEventLoop = None, timeout: float = None) -> None:
         super().__init__('IDLE', tag, *args, prefix=prefix, untagged_resp_name=untagged_resp_name,
@@ -285,6 +565,18 @@ class Abort(Error):
         super().__init__(reason)
 
 
+class ConnectionLost(Abort):
+    def __init__(self, reason: str):
+        super().__init__(reason)
+
+
+class DownloadInterrupted(ConnectionLost):
+    def __init__(self, reason: str, offset: int, end: Optional[int]):
+        super().__init__(reason)
+        self.offset = offset
+        self.end = end
+
+
 class CommandTimeout(AioImapException):
     def __init__(self, command: Command):
         self.command = command
@@ -308,11 +600,151 @@ def change_state(coro: Callable[..., Coroutine[Any, Any, Optional[Response]]]):
     return wrapper
 
 
+async def literal_chunks(literal_data: Any, chunk_size: int = LITERAL_CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """
+    Yields the literal data by chunks. It can be a bytes-like object, a path, a binary file object
+    (anything with a read method) or a (async) iterable of bytes. A path is opened and a file object
+    is read in the default executor, not to block the event loop with the disk I/O (except io.BytesIO).
+    The iterables of bytes are iterated on the event loop.
+    """
+    if isinstance(literal_data, (bytes, bytearray, memoryview)):
+        view = memoryview(literal_data).cast('B')
+        for start in range(0, len(view), chunk_size):
+            yield view[start:start + chunk_size]
+    elif isinstance(literal_data, (str, os.PathLike)):
+        f = await asyncio.get_event_loop().run_in_executor(None, open, literal_data, 'rb')
+        try:
+            async for chunk in literal_chunks(f, chunk_size):
+                yield chunk
+        finally:
+            f.close()
+    elif isinstance(literal_data, io.BytesIO):
+        chunk = literal_data.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = literal_data.read(chunk_size)
+    elif hasattr(literal_data, 'read'):
+        loop = asyncio.get_event_loop()
+        chunk = await loop.run_in_executor(None, literal_data.read, chunk_size)
+        while chunk:
+            yield chunk
+            chunk = await loop.run_in_executor(None, literal_data.read, chunk_size)
+    elif hasattr(literal_data, '__aiter__'):
+        async for chunk in literal_data:
+            yield chunk
+    else:
+        for chunk in literal_data:
+            yield chunk
+
+
+def literal_size(literal_data: Any, size: int = None) -> int:
+    """
+    Returns the size of the literal data : size if given, else the length of a bytes-like object,
+    the size of a file (from its current position for a file object).
+    :raises ValueError: when the size cannot be known (iterators, pipes)
+    """
+    if size is not None:
+        return size
+    if isinstance(literal_data, (bytes, bytearray)):
+        return len(literal_data)
+    if isinstance(literal_data, memoryview):
+        return literal_data.nbytes
+    if isinstance(literal_data, (str, os.PathLike)):
+        return os.stat(literal_data).st_size
+    if hasattr(literal_data, 'seek') and hasattr(literal_data, 'tell'):
+        try:
+            position = literal_data.tell()
+            end = literal_data.seek(0, io.SEEK_END)
+            literal_data.seek(position)
+            return end - position
+        except (OSError, ValueError):
+            pass
+    raise ValueError('size is needed to send literal data from %s' % type(literal_data).__name__)
+
+
+class SaslMechanism(object):
+    """
+    SASL mechanism for the AUTHENTICATE command. A mechanism gives its initial response (sent with the
+    command when the server has SASL-IR, rfc4959) and answers the server challenges.
+    """
+    name = None
+
+    def initial_response(self) -> Optional[bytes]:
+        """the client first message, None if the mechanism starts with a server challenge"""
+        return None
+
+    def respond(self, challenge: bytes) -> Optional[bytes]:
+        """the answer to a server challenge, None to cancel the authentication exchange"""
+        return None
+
+
+class PlainMechanism(SaslMechanism):
+    """rfc4616"""
+    name = 'PLAIN'
+
+    def __init__(self, user: str, password: str, authzid: str = '') -> None:
+        self.user = user
+        self.password = password
+        self.authzid = authzid
+
+    def initial_response(self) -> bytes:
+        return ('%s\0%s\0%s' % (self.authzid, self.user, self.password)).encode()
+
+    def respond(self, challenge: bytes) -> bytes:
+        return self.initial_response()
+
+
+class XOAuth2Mechanism(SaslMechanism):
+    """
+    https://developers.google.com/gmail/imap/xoauth2-protocol
+    When the token is refused, the server sends the error as a challenge and waits for an empty response.
+    """
+    name = 'XOAUTH2'
+
+    def __init__(self, user: str, token: str) -> None:
+        self.user = user
+        self.token = token
+
+    def initial_response(self) -> bytes:
+        return f"user={self.user}\1auth=Bearer {self.token}\1\1".encode("ascii")
+
+    def respond(self, challenge: bytes) -> bytes:
+        if not challenge:
+            return self.initial_response()
+        log.debug('%s authentication error: %s', self.name, challenge)
+        return b''
+
+
+class OAuthBearerMechanism(XOAuth2Mechanism):
+    """rfc7628"""
+    name = 'OAUTHBEARER'
+
+    def __init__(self, user: str, token: str, host: str = None, port: int = None) -> None:
+        super().__init__(user, token)
+        self.host = host
+        self.port = port
+
+    def initial_response(self) -> bytes:
+        response = 'n,a=%s,\1' % self.user.replace('=', '=3D').replace(',', '=2C')
+        if self.host is not None:
+            response += 'host=%s\1' % self.host
+        if self.port is not None:
+            response += 'port=%d\1' % self.port
+        return (response + 'auth=Bearer %s\1\1' % self.token).encode('ascii')
+
+    def respond(self, challenge: bytes) -> bytes:
+        if not challenge:
+            return self.initial_response()
+        log.debug('%s authentication error: %s', self.name, challenge)
+        return b'\1'
+
+
 # cf https://tools.ietf.org/html/rfc3501#section-9
 # untagged responses types
 literal_data_re = re.compile(rb'.*\{(?P<size>\d+)\}$')
 message_data_re = re.compile(rb'[0-9]+ ((FETCH)|(EXPUNGE))')
 tagged_status_response_re = re.compile(rb'[A-Z0-9]+ ((OK)|(NO)|(BAD))')
+capability_code_re = re.compile(rb'\[CAPABILITY (?P<capabilities>[^\]]*)\]')
 
 
 class IMAP4ClientProtocol(asyncio.Protocol):
@@ -322,16 +754,25 @@ class IMAP4ClientProtocol(asyncio.Protocol):
         self.state = STARTED
         self.state_condition = asyncio.Condition()
         self.capabilities = set()
+        self.cached_capabilities: Optional[set] = None
+        self.enabled = set()
         self.pending_async_commands = dict()
         self.pending_sync_command = None
         self.idle_queue = asyncio.Queue()
         self._idle_event = asyncio.Event()
         self.imap_version = None
-        self.literal_data = None
         self.incomplete_line = b''
         self.current_command = None
         self.conn_lost_cb = conn_lost_cb
         self.tasks: set[Future] = set()
+        self._write_paused = False
+        self._connection_lost: Optional[ConnectionLost] = None
+        self.stop_idle_on_connection_lost = True
+        self._drain_waiters: deque = deque()
+        self.timeout_scheduler = TimeoutScheduler(loop) if loop is not None else None
+        self.read_high_water_mark = READ_HIGH_WATER_MARK
+        self._unconsumed_size = 0
+        self._read_paused = False
 
         self.tagnum = 0
         self.tagpre = int2ap(random.randint(4096, 65535))
@@ -352,39 +793,120 @@ class IMAP4ClientProtocol(asyncio.Protocol):
 
     def connection_lost(self, exc: Optional[Exception]) -> None:
         log.debug('connection lost: %s', exc)
+        self._connection_lost = ConnectionLost('connection lost: %r' % exc if exc is not None else 'connection lost')
+        if self.stop_idle_on_connection_lost and self.has_pending_idle_command():
+            self.idle_queue.put_nowait(STOP_WAIT_SERVER_PUSH)
+        self.abort_pending_commands(self._connection_lost)
+        self._wake_up_drain_waiters(self._connection_lost)
+        task = asyncio.ensure_future(self._notify_state_waiters())
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
         if self.conn_lost_cb is not None:
             self.conn_lost_cb(exc)
 
-    def _handle_responses(self, data: bytes, line_handler: Callable[[bytes, Command], Optional[Command]], current_cmd: Command = None) -> None:
-        if not data:
-            if self.pending_sync_command is not None:
-                self.pending_sync_command.flush()
-            if current_cmd is not None and current_cmd.wait_data():
-                raise IncompleteRead(current_cmd)
+    async def _notify_state_waiters(self) -> None:
+        async with self.state_condition:
+            self.state_condition.notify_all()
+
+    def abort_pending_commands(self, exc: Exception) -> None:
+        """fails the pending commands with exc"""
+        commands = list(self.pending_async_commands.values())
+        if self.pending_sync_command is not None:
+            commands.append(self.pending_sync_command)
+        self.pending_sync_command = None
+        self.pending_async_commands.clear()
+        for command in commands:
+            command.abort(exc)
+
+    def pause_writing(self) -> None:
+        log.debug('transport buffer above high-water mark, pausing writes')
+        self._write_paused = True
+
+    def resume_writing(self) -> None:
+        log.debug('transport buffer drained, resuming writes')
+        self._write_paused = False
+        self._wake_up_drain_waiters()
+
+    async def drain(self) -> None:
+        """
+        Waits until the transport write buffer goes below its high-water mark.
+        Large writes (literals) should await it between chunks to keep the memory bounded.
+        """
+        if self._connection_lost:
+            raise ConnectionLost(str(self._connection_lost))
+        if not self._write_paused:
             return
+        waiter = (self.loop if self.loop is not None else get_running_loop()).create_future()
+        self._drain_waiters.append(waiter)
+        try:
+            await waiter
+        finally:
+            if waiter in self._drain_waiters:
+                self._drain_waiters.remove(waiter)
 
-        if current_cmd is not None and current_cmd.wait_literal_data():
-            data = current_cmd.append_literal_data(data)
-            if current_cmd.wait_literal_data():
-                raise IncompleteRead(current_cmd)
-
-        line, separator, tail = data.partition(CRLF)
-        if not separator:
-            raise IncompleteRead(current_cmd, data)
-
-        cmd = line_handler(line, current_cmd)
-
-        begin_literal = literal_data_re.match(line)
-        if begin_literal:
-            size = int(begin_literal.group('size'))
-            if cmd is None:
-                cmd = Command('NIL', 'unused')
-            cmd.begin_literal_data(size)
-            self._handle_responses(tail, line_handler, current_cmd=cmd)
-        elif cmd is not None and cmd.wait_data():
-            self._handle_responses(tail, line_handler, current_cmd=cmd)
-        else:
-            self._handle_responses(tail, line_handler)
+    def data_queued(self, size: int) -> None:
+        """
+        Accounts for received data that is waiting for its consumer, and pauses reading from
+        the transport when it goes above read_high_water_mark.
+        """
+        self._unconsumed_size += size
+        if not self._read_paused and self._unconsumed_size > self.read_high_water_mark \
+                and self.transport is not None:
+            log.debug('%d bytes not consumed, pausing reading', self._unconsumed_size)
+            self._read_paused = True
+            self.transport.pause_reading()
+
+    def data_consumed(self, size: int) -> None:
+        """resumes reading when the unconsumed data goes below a quarter of read_high_water_mark"""
+        self._unconsumed_size -= size
+        if self._read_paused and self._unconsumed_size <= self.read_high_water_mark // 4:
+            log.debug('%d bytes not consumed, resuming reading', self._unconsumed_size)
+            self._read_paused = False
+            if not self._connection_lost:
+                self.transport.resume_reading()
+
+    def _wake_up_drain_waiters(self, exc: Optional[Exception] = None) -> None:
+        while self._drain_waiters:
+            waiter = self._drain_waiters.popleft()
+            if waiter.done():
+                continue
+            if exc is None:
+                waiter.set_result(None)
+            else:
+                waiter.set_exception(exc)
+
+    def _handle_responses(self, data: bytes, line_handler: Callable[[bytes, Command], Optional[Command]], current_cmd: Command = None) -> None:
+        # iterative (and not recursive) : a single read can hold thousands of lines
+        while True:
+            if not data:
+                if self.pending_sync_command is not None:
+                    self.pending_sync_command.flush()
+                if current_cmd is not None and current_cmd.wait_data():
+                    raise IncompleteRead(current_cmd)
+                return
+
+            if current_cmd is not None and current_cmd.wait_literal_data():
+                data = current_cmd.append_literal_data(data)
+                if current_cmd.wait_literal_data():
+                    raise IncompleteRead(current_cmd)
+
+            line, separator, data = data.partition(CRLF)
+            if not separator:
+                raise IncompleteRead(current_cmd, line)
+
+            cmd = line_handler(line, current_cmd)
+
+            begin_literal = literal_data_re.match(line)
+            if begin_literal:
+                size = int(begin_literal.group('size'))
+                if cmd is None:
+                    cmd = Command('NIL', 'unused')
+                cmd.begin_literal_data(size)
+                current_cmd = cmd
+            elif cmd is not None and cmd.wait_data():
+                current_cmd = cmd
+            else:
+                current_cmd = None
 
     def _handle_line(self, line: bytes, current_cmd: Command) -> Optional[Command]:
         if not line:
@@ -415,26 +937,35 @@ class IMAP4ClientProtocol(asyncio.Protocol):
         self.transport.write(data)
 
     async def execute(self, command: Command, scrub: str =None) -> Response:
+        if self._connection_lost:
+            raise ConnectionLost(str(self._connection_lost))
         if self.state not in Commands.get(command.name).valid_states:
             raise Abort('command %s illegal in state %s' % (command.name, self.state))
+        if self.timeout_scheduler is None:
+            self.timeout_scheduler = TimeoutScheduler(command._loop)
+        command.use_scheduler(self.timeout_scheduler)
 
         if self.pending_sync_command is not None:
             await self.pending_sync_command.wait()
 
-        if Commands.get(command.name).exec == Exec.is_sync:
+        is_sync = (command.exec_mode or Commands.get(command.name).exec) == Exec.is_sync
+        if is_sync:
             if self.pending_async_commands:
                 await self.wait_async_pending_commands()
             self.pending_sync_command = command
         else:
-            if self.pending_async_commands.get(command.untagged_resp_name) is not None:
+            # several commands may be waiting for the same one
+            while self.pending_async_commands.get(command.untagged_resp_name) is not None:
                 await self.pending_async_commands[command.untagged_resp_name].wait()
             self.pending_async_commands[command.untagged_resp_name] = command
 
         self.send(str(command), scrub=scrub)
+        if isinstance(command, AppendCommand) and command.non_synchronizing:
+            self._start_sending_literal(command)
         try:
             await command.wait()
-        except CommandTimeout:
-            if Commands.get(command.name).exec == Exec.is_sync:
+        except Exception:
+            if is_sync:
                 self.pending_sync_command = None
             else:
                 self.pending_async_commands.pop(command.untagged_resp_name, None)
@@ -453,7 +984,13 @@ class IMAP4ClientProtocol(asyncio.Protocol):
             self.state = NONAUTH
         else:
             raise Error(command.decode())
-        await self.capability()
+        capability_code = capability_code_re.search(command)
+        if capability_code is not None:
+            self._set_capabilities(capability_code.group('capabilities').decode().split())
+        elif self.state == NONAUTH and self.cached_capabilities:
+            self._set_capabilities(self.cached_capabilities)
+        else:
+            await self.capability()
 
     @change_state
     async def login(self, user: str, password: str) -> Response:
@@ -464,9 +1001,7 @@ class IMAP4ClientProtocol(asyncio.Protocol):
 
         if 'OK' == response.result:
             self.state = AUTH
-            for line in response.lines:
-                if b'CAPABILITY' in line:
-                    self.capabilities = self.capabilities.union(set(line.decode().replace('CAPABILITY', '').strip().split()))
+            self._update_capabilities(response)
         return response
 
     @change_state
@@ -479,17 +1014,44 @@ class IMAP4ClientProtocol(asyncio.Protocol):
         https://learn.microsoft.com/en-us/exchange/client-developer/legacy-protocols/how-to-authenticate-an-imap-pop-smtp-application-by-using-oauth
         https://developers.google.com/gmail/imap/xoauth2-protocol
         """
-        sasl_string = b64encode(f"user={user}\1auth=Bearer {token}\1\1".encode("ascii"))
+        # the initial response is always sent, even if the server doesn't announce SASL-IR (outlook)
+        return await self._authenticate(XOAuth2Mechanism(user, token), sasl_ir=True)
 
-        response = await self.execute(
-            Command('AUTHENTICATE', self.new_tag(), 'XOAUTH2', sasl_string.decode("ascii"), loop=self.loop),
-            scrub=token,
-        )
+    @change_state
+    async def authenticate(self, mechanism: SaslMechanism, sasl_ir: bool = None) -> Response:
+        """
+        AUTHENTICATE with a SASL mechanism. The initial response is sent with the command (one round trip)
+        when the server has the SASL-IR capability, or if sasl_ir is True.
+        """
+        return await self._authenticate(mechanism, sasl_ir)
+
+    async def _authenticate(self, mechanism: SaslMechanism, sasl_ir: bool = None) -> Response:
+        if sasl_ir is None:
+            sasl_ir = 'SASL-IR' in self.capabilities
+        initial_response = mechanism.initial_response() if sasl_ir else None
+        if initial_response is None:
+            command = AuthenticateCommand(self.new_tag(), mechanism, loop=self.loop)
+            response = await self.execute(command)
+        else:
+            # an empty initial response is sent as "=" (rfc4959)
+            encoded = b64encode(initial_response).decode('ascii') or '='
+            command = AuthenticateCommand(self.new_tag(), mechanism, encoded, loop=self.loop)
+            response = await self.execute(command, scrub=encoded)
 
         if 'OK' == response.result:
             self.state = AUTH
+            self._update_capabilities(response)
         return response
 
+    def _update_capabilities(self, response: Response) -> None:
+        # the servers send their post-login capabilities as an untagged response or a response code
+        for line in response.lines:
+            capability_code = capability_code_re.search(line)
+            if capability_code is not None:
+                self.capabilities = self.capabilities.union(capability_code.group('capabilities').decode().split())
+            elif line.startswith(b'CAPABILITY'):
+                self.capabilities = self.capabilities.union(set(line.decode().replace('CAPABILITY', '').strip().split()))
+
     @change_state
     async def logout(self) -> Response:
         response = (await self.execute(Command('LOGOUT', self.new_tag(), loop=self.loop)))
@@ -525,18 +1087,74 @@ class IMAP4ClientProtocol(asyncio.Protocol):
     def idle_done(self) -> None:
         self.send('DONE')
 
-    async def search(self, *criteria, charset: Optional[str] = 'utf-8', by_uid: bool = False) -> Response:
+    async def search(self, *criteria, charset: Optional[str] = 'utf-8', by_uid: bool = False,
+                     ret: str = None) -> Response:
+        if ret is not None and 'ESEARCH' not in self.capabilities:
+            raise Abort('server has not ESEARCH capability')
         args = ('CHARSET', charset) + criteria if charset is not None else criteria
+        # with return options (rfc4731) the result is an untagged ESEARCH response
+        args = ('RETURN (%s)' % ret,) + args if ret is not None else args
         prefix = 'UID' if by_uid else ''
 
         return await self.execute(
-            Command('SEARCH', self.new_tag(), *args, prefix=prefix, loop=self.loop))
+            Command('SEARCH', self.new_tag(), *args, prefix=prefix,
+                    untagged_resp_name='ESEARCH' if ret is not None else None, loop=self.loop))
+
+    async def sort(self, sort_criteria: str, *criteria: str, charset: str = 'utf-8', by_uid: bool = False,
+                   ret: str = None) -> Response:
+        if 'SORT' not in self.capabilities:
+            raise Abort('server has not SORT capability')
+        if ret is not None and 'ESORT' not in self.capabilities:
+            raise Abort('server has not ESORT capability')
+        # with return options (rfc5267) the result is an untagged ESEARCH response
+        args = ('RETURN (%s)' % ret,) if ret is not None else ()
+        args += ('(%s)' % sort_criteria.strip('()'), charset) + criteria
+
+        return await self.execute(
+            Command('SORT', self.new_tag(), *args, prefix='UID' if by_uid else '',
+                    untagged_resp_name='ESEARCH' if ret is not None else None, loop=self.loop))
+
+    async def thread(self, algorithm: str, *criteria: str, charset: str = 'utf-8', by_uid: bool = False) -> Response:
+        if 'THREAD=%s' % algorithm.upper() not in self.capabilities:
+            raise Abort('server has not THREAD=%s capability' % algorithm.upper())
+
+        return await self.execute(
+            Command('THREAD', self.new_tag(), algorithm, charset, *criteria, prefix='UID' if by_uid else '',
+                    loop=self.loop))
 
     async def fetch(self, message_set: str, message_parts: str, by_uid: bool = False, timeout: float = None) -> Response:
         return await self.execute(
             FetchCommand(self.new_tag(), message_set, message_parts,
                          prefix='UID' if by_uid else '', loop=self.loop, timeout=timeout))
 
+    async def fetch_stream(self, message_set: str, message_parts: str, by_uid: bool = False,
+                           timeout: float = None) -> AsyncIterator[List[bytes]]:
+        queue = asyncio.Queue()
+        command = StreamingFetchCommand(self.new_tag(), queue, message_set, message_parts,
+                                        prefix='UID' if by_uid else '', loop=self.loop, timeout=timeout,
+                                        on_data=self.data_queued)
+        execution = asyncio.ensure_future(self.execute(command))
+        self.tasks.add(execution)
+        execution.add_done_callback(self.tasks.discard)
+        execution.add_done_callback(lambda _: queue.put_nowait(None))
+        try:
+            message = await queue.get()
+            while message is not None:
+                self.data_consumed(message_size(message))
+                yield message
+                message = await queue.get()
+            response = await execution
+            if response.result != 'OK':
+                raise Error('fetch failed: %s %s' % (response.result, b' '.join(response.lines).decode()))
+        finally:
+            # the consumer may stop before the end of the fetch (aclose) : the data it will not consume is released
+            unconsumed_size = command.stop_streaming()
+            while not queue.empty():
+                message = queue.get_nowait()
+                if message is not None:
+                    unconsumed_size += message_size(message)
+            self.data_consumed(unconsumed_size)
+
     async def store(self, *args: str, by_uid: bool = False) -> Response:
         return await self.execute(
             Command('STORE', self.new_tag(), *args,
@@ -564,6 +1182,10 @@ class IMAP4ClientProtocol(asyncio.Protocol):
                 raise Abort(
                     'EXPUNGE with uids is only valid with UIDPLUS capability. UIDPLUS not in (%s)' % self.capabilities)
             return await self.expunge(*criteria, by_uid=True)
+        if command.upper() == 'SORT':
+            return await self.sort(*criteria, by_uid=True)
+        if command.upper() == 'THREAD':
+            return await self.thread(*criteria, by_uid=True)
         raise Abort('command UID only possible with COPY, FETCH, EXPUNGE (w/UIDPLUS) or STORE (was %s)' % command.upper())
 
     async def copy(self, *args: str, by_uid: bool = False) -> Response:
@@ -579,8 +1201,10 @@ class IMAP4ClientProtocol(asyncio.Protocol):
 
     async def capability(self) -> None: # that should be a Response (would avoid the Optional)
         response = await self.execute(Command('CAPABILITY', self.new_tag(), loop=self.loop))
+        self._set_capabilities(response.lines[0].decode().split())
 
-        capability_list = response.lines[0].decode().split()
+    def _set_capabilities(self, capability_list: Iterable[str]) -> None:
+        capability_list = list(capability_list)
         self.capabilities = set(capability_list)
         try:
             self.imap_version = list(
@@ -588,7 +1212,31 @@ class IMAP4ClientProtocol(asyncio.Protocol):
         except IndexError:
             raise Error('server not IMAP4 compliant')
 
-    async def append(self, message_bytes: bytes, mailbox: str = 'INBOX', flags: str = None, date: Any = None, timeout: float = None) -> Response:
+    async def enable(self, capability: str) -> Response:
+        response = await self.execute(Command('ENABLE', self.new_tag(), capability, loop=self.loop))
+        if response.result == 'OK':
+            for line in response.lines:
+                if line.startswith(b'ENABLED'):
+                    self.enabled.update(line.decode().split()[1:])
+        return response
+
+    async def starttls(self, ssl_context: ssl.SSLContext, server_hostname: str = None) -> Response:
+        if 'STARTTLS' not in self.capabilities:
+            raise Abort('server has not STARTTLS capability')
+        response = await self.execute(Command('STARTTLS', self.new_tag(), loop=self.loop))
+        if response.result != 'OK':
+            return response
+        loop = self.loop if self.loop is not None else get_running_loop()
+        self.transport = await loop.start_tls(self.transport, self, ssl_context, server_hostname=server_hostname)
+        # the capabilities received before the TLS negotiation must be discarded (rfc3501 6.2.1)
+        await self.capability()
+        return response
+
+    async def append(self, message_bytes: Any, mailbox: str = 'INBOX', flags: str = None, date: Any = None,
+                     timeout: float = None, size: int = None) -> Response:
+        size = literal_size(message_bytes, size)
+        literal_plus = 'LITERAL+' in self.capabilities or \
+                       ('LITERAL-' in self.capabilities and size <= LITERAL_MINUS_MAX_SIZE)
         args = [mailbox]
         if flags is not None:
             if (flags[0], flags[-1]) != ('(', ')'):
@@ -597,9 +1245,9 @@ class IMAP4ClientProtocol(asyncio.Protocol):
                 args.append(flags)
         if date is not None:
             args.append(time2internaldate(date))
-        args.append('{%s}' % len(message_bytes))
-        self.literal_data = message_bytes
-        return await self.execute(Command('APPEND', self.new_tag(), *args, loop=self.loop, timeout=timeout))
+        args.append('{%d%s}' % (size, '+' if literal_plus else ''))
+        return await self.execute(AppendCommand(self.new_tag(), message_bytes, *args, literal_size=size,
+                                                loop=self.loop, timeout=timeout))
 
     async def id(self, **kwargs: Union[dict, list, str]) -> Response:
         args = arguments_rfs2971(**kwargs)
@@ -613,6 +1261,15 @@ class IMAP4ClientProtocol(asyncio.Protocol):
             raise Abort('server has not NAMESPACE capability')
         return await self.execute(Command('NAMESPACE', self.new_tag(), loop=self.loop))
 
+    async def status(self, mailbox: str, names: str) -> Response:
+        return await self.execute(StatusCommand(self.new_tag(), mailbox, names, loop=self.loop))
+
+    async def list_status(self, reference_name: str, mailbox_pattern: str, status_items: str) -> Response:
+        if 'LIST-STATUS' not in self.capabilities:
+            raise Abort('server has not LIST-STATUS capability')
+        return await self.execute(ListStatusCommand(self.new_tag(), reference_name, mailbox_pattern, status_items,
+                                                    loop=self.loop))
+
     async def simple_command(self, name, *args: str) -> Response:
         if name not in self.simple_commands:
             raise NotImplementedError('simple command only available for %s' % self.simple_commands)
@@ -624,7 +1281,9 @@ class IMAP4ClientProtocol(asyncio.Protocol):
     async def wait(self, state_regexp: Pattern) -> None:
         state_re = re.compile(state_regexp)
         async with self.state_condition:
-            await self.state_condition.wait_for(lambda: state_re.match(self.state))
+            await self.state_condition.wait_for(lambda: state_re.match(self.state) or self._connection_lost)
+        if not state_re.match(self.state):
+            raise ConnectionLost(str(self._connection_lost))
 
     async def wait_for_idle_response(self):
         await self._idle_event.wait()
@@ -640,7 +1299,15 @@ class IMAP4ClientProtocol(asyncio.Protocol):
                 cmd_name, text = match.group(1), match.string
             else:
                 cmd_name, _, text = line.partition(b' ')
-            command = self.pending_async_commands.get(cmd_name.decode().upper())
+            name = cmd_name.decode().upper()
+            command = self.pending_async_commands.get(name)
+            if name == 'STATUS':
+                command = self.pending_async_commands.get(status_resp_name(text), command)
+                if command is None:
+                    # the server wrote the name differently (case, encoding) : only one STATUS can match it
+                    status_commands = [c for c in self.pending_async_commands.values() if isinstance(c, StatusCommand)]
+                    if len(status_commands) == 1:
+                        command = status_commands[0]
             if command is not None:
                 command.append_to_resp(text)
             else:
@@ -678,19 +1345,63 @@ class IMAP4ClientProtocol(asyncio.Protocol):
         if self.pending_sync_command is None:
             log.info('server says %s (ignored)' % line)
         elif self.pending_sync_command.name == 'APPEND':
-            if self.literal_data is None:
-                Abort('asked for literal data but have no literal data to send')
-            self.transport.write(self.literal_data)
-            self.transport.write(CRLF)
-            self.literal_data = None
+            if getattr(self.pending_sync_command, 'literal_data', None) is None:
+                log.info('server asks for literal data but there is none to send (ignored) : %s' % line)
+            else:
+                self._start_sending_literal(self.pending_sync_command)
         elif self.pending_sync_command.name == 'IDLE':
             log.debug('continuation line -- assuming IDLE is active : %s', line)
             self._idle_event.set()
+        elif isinstance(self.pending_sync_command, AuthenticateCommand):
+            self._sasl_response(self.pending_sync_command, line)
         else:
             log.debug('continuation line appended to pending sync command %s : %s' % (self.pending_sync_command, line))
             self.pending_sync_command.append_to_resp(line)
             self.pending_sync_command.flush()
 
+    def _sasl_response(self, command: AuthenticateCommand, line: bytes) -> None:
+        try:
+            challenge = b64decode(line[1:].strip(), validate=True)
+        except ValueError:
+            log.warning('invalid %s challenge %s', command.mechanism.name, line)
+            response = None
+        else:
+            response = command.mechanism.respond(challenge)
+        if response is None:
+            log.debug('no %s response to the challenge %s', command.mechanism.name, line)
+            self.send('*')  # cancels the authentication exchange
+            return
+        encoded = b64encode(response).decode('ascii')
+        self.send(encoded, scrub=encoded)
+
+    def _start_sending_literal(self, command: AppendCommand) -> None:
+        task = asyncio.ensure_future(self._send_literal(command, command.literal_data, command.literal_size))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        command.literal_data = None
+
+    async def _send_literal(self, command: Command, literal_data: Any, size: int = None) -> None:
+        try:
+            sent = 0
+            async for chunk in literal_chunks(literal_data):
+                sent += len(chunk)
+                if size is not None and sent > size:
+                    raise Abort('literal data is longer than its announced size (%d)' % size)
+                self.transport.write(chunk)
+                await self.drain()
+                command._reset_timer()  # the server is silent while receiving the literal
+            if size is not None and sent != size:
+                raise Abort('literal data is shorter (%d) than its announced size (%d)' % (sent, size))
+            self.transport.write(CRLF)
+        except Exception as exc:
+            log.warning('error while sending literal data for %s: %r', command, exc)
+            if self.pending_sync_command is command:
+                self.pending_sync_command = None
+            command.abort(exc)
+            # the server waits for the rest of the literal and would read the next commands as its data :
+            # the connection cannot be used anymore
+            self.transport.abort()
+
     def new_tag(self) -> str:
         tag = self.tagpre + str(self.tagnum)
         self.tagnum += 1
@@ -700,6 +1411,70 @@ class IMAP4ClientProtocol(asyncio.Protocol):
         return [c for c in self.pending_async_commands.values() if c is not None and c.tag == tag]
 
 
+# the port of the server the current task connects to, for the TLS sessions of a SessionCachingSSLContext
+_tls_server_port: ContextVar[Optional[int]] = ContextVar('tls_server_port', default=None)
+
+
+class SessionCachingSSLContext(ssl.SSLContext):
+    """
+    SSLContext keeping the last TLS session of each server (host and port) : the next connections to the
+    same server resume it (abbreviated handshake) instead of doing a full handshake. A session that the
+    server does not accept anymore falls back to a full handshake. The max_sessions most recently used
+    sessions are kept.
+    """
+    def __new__(cls, protocol: int = ssl.PROTOCOL_TLS_CLIENT, *args, **kwargs):
+        return super().__new__(cls, protocol, *args, **kwargs)
+
+    def __init__(self, protocol: int = ssl.PROTOCOL_TLS_CLIENT, max_sessions: int = 100):
+        self.max_sessions = max_sessions
+        self.tls_sessions: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()  # the context can be shared by clients running in several threads
+
+    @classmethod
+    def create_default(cls, cafile: str = None, capath: str = None, cadata: Any = None,
+                       max_sessions: int = 100) -> 'SessionCachingSSLContext':
+        """a context with the settings of ssl.create_default_context() for the server authentication"""
+        # PROTOCOL_TLS_CLIENT requires the certificate and checks the host name
+        ssl_context = cls(ssl.PROTOCOL_TLS_CLIENT, max_sessions=max_sessions)
+        if sys.version_info >= (3, 13):
+            ssl_context.verify_flags |= ssl.VERIFY_X509_PARTIAL_CHAIN | ssl.VERIFY_X509_STRICT
+        if cafile or capath or cadata:
+            ssl_context.load_verify_locations(cafile, capath, cadata)
+        else:
+            ssl_context.load_default_certs(ssl.Purpose.SERVER_AUTH)
+        keylogfile = os.environ.get('SSLKEYLOGFILE')
+        if keylogfile and not sys.flags.ignore_environment:
+            ssl_context.keylog_filename = keylogfile
+        return ssl_context
+
+    def wrap_bio(self, incoming: ssl.MemoryBIO, outgoing: ssl.MemoryBIO, server_side: bool = False,
+                 server_hostname: str = None, session: ssl.SSLSession = None) -> ssl.SSLObject:
+        if session is None and not server_side:
+            with self._lock:
+                session = self.tls_sessions.get((server_hostname, _tls_server_port.get()))
+        return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+
+    def save_session(self, server_hostname: str, ssl_object: ssl.SSLObject, port: int = None) -> None:
+        if ssl_object.session is not None:
+            log.debug('TLS session with %s:%s (reused: %s)', server_hostname, port, ssl_object.session_reused)
+            with self._lock:
+                self.tls_sessions[(server_hostname, port)] = ssl_object.session
+                self.tls_sessions.move_to_end((server_hostname, port))
+                while len(self.tls_sessions) > self.max_sessions:
+                    self.tls_sessions.popitem(last=False)
+
+
+@functools.lru_cache(maxsize=1)
+def default_ssl_context() -> SessionCachingSSLContext:
+    """
+    The SSL context used by IMAP4_SSL when none is given : a SessionCachingSSLContext with the defaults of
+    ssl.create_default_context(), built once per process. Loading the CA certificates takes tens of ms, and
+    all the clients resume the TLS sessions of the same server (host, port) : reconnecting many clients does
+    one full handshake per server.
+    """
+    return SessionCachingSSLContext.create_default()
+
+
 class IMAP4(object):
     TIMEOUT_SECONDS = 10.0
 
@@ -727,6 +1502,17 @@ class IMAP4(object):
         self.port = port
         self.conn_lost_cb = conn_lost_cb
         self.ssl_context = ssl_context
+        # dict shared by the clients of a pool : the pre-login capabilities of each server are asked once
+        self.capabilities_cache: Optional[dict] = None
+        # FetchCache used by fetch_cached, it may be shared by several clients
+        self.fetch_cache: Optional[FetchCache] = None
+        # BodyCache used by fetch_cached for the message contents (BODY[], BODY[1.2], RFC822...)
+        self.body_cache: Optional[BodyCache] = None
+        # False when the mailbox names given to the commands are already encoded in modified UTF-7
+        self.encode_mailbox_names = True
+        self.user: Optional[str] = None
+        self.selected_mailbox: Optional[str] = None
+        self.uidvalidity: Optional[int] = None
         # self.create_client(host, port, loop, conn_lost_cb, ssl_context)
 
     async def connect(self) -> None:
@@ -735,9 +1521,24 @@ class IMAP4(object):
         It raises an exception in case of connection issues. 
         :return:
         """
-        self.protocol = IMAP4ClientProtocol(self.asyncio_loop, self.conn_lost_cb)
-        await self.asyncio_loop.create_connection(lambda: self.protocol, self.host, self.port, ssl=self.ssl_context)
+        self.protocol = self._create_protocol()
+        if self.capabilities_cache is not None:
+            self.protocol.cached_capabilities = self.capabilities_cache.get((self.host, self.port))
+        port = _tls_server_port.set(self.port)
+        try:
+            await self.asyncio_loop.create_connection(lambda: self.protocol, self.host, self.port,
+                                                      ssl=self.ssl_context)
+        finally:
+            _tls_server_port.reset(port)
         await asyncio.wait_for(self.protocol.wait('AUTH|NONAUTH'), self.timeout)
+        if self.capabilities_cache is not None and self.protocol.state == NONAUTH:
+            self.capabilities_cache[(self.host, self.port)] = frozenset(self.protocol.capabilities)
+        if isinstance(self.ssl_context, SessionCachingSSLContext):
+            # after the greeting, TLS 1.3 session tickets have been received
+            self.ssl_context.save_session(self.host, self.protocol.transport.get_extra_info('ssl_object'), self.port)
+
+    def _create_protocol(self) -> IMAP4ClientProtocol:
+        return IMAP4ClientProtocol(self.asyncio_loop, self.conn_lost_cb)
 
     def get_state(self) -> str:
         return self.protocol.state
@@ -749,7 +1550,39 @@ class IMAP4(object):
         """
         This method is used to login in the IMAP server. This method must be called after wait_hello_from_server.
         """
-        return await asyncio.wait_for(self.protocol.login(user, password), self.timeout)
+        response = await asyncio.wait_for(self.protocol.login(user, password), self.timeout)
+        if response.result == 'OK':
+            self.user = user
+        return response
+
+    async def authenticate(self, mechanism: SaslMechanism) -> Response:
+        """
+        Authenticates with a SASL mechanism (PlainMechanism, XOAuth2Mechanism, OAuthBearerMechanism or
+        a SaslMechanism subclass). When the server has SASL-IR, it takes only one round trip.
+        :return: Response
+        """
+        response = await asyncio.wait_for(self.protocol.authenticate(mechanism), self.timeout)
+        if response.result == 'OK':
+            self.user = getattr(mechanism, 'user', None)
+        return response
+
+    async def starttls(self, ssl_context: ssl.SSLContext = None) -> Response:
+        """
+        Upgrades the connection to TLS (on the IMAP port 143) and asks the server capabilities again.
+        It must be called before login.
+        :param ssl_context: ssl.SSLContext, default_ssl_context() if None
+        :return: Response
+        """
+        if ssl_context is None:
+            ssl_context = default_ssl_context()
+        port = _tls_server_port.set(self.port)
+        try:
+            response = await asyncio.wait_for(self.protocol.starttls(ssl_context, self.host), self.timeout)
+        finally:
+            _tls_server_port.reset(port)
+        if response.result == 'OK' and isinstance(ssl_context, SessionCachingSSLContext):
+            ssl_context.save_session(self.host, self.protocol.transport.get_extra_info('ssl_object'), self.port)
+        return response
 
     async def xoauth2(self, user: str, token: bytes) -> Response:
         """
@@ -758,7 +1591,10 @@ class IMAP4(object):
         :param token: acces token retrieved from your client application
         :return: Server response: namedtuple('Response', 'result lines')
         """
-        return await asyncio.wait_for(self.protocol.xoauth2(user, token), self.timeout)
+        response = await asyncio.wait_for(self.protocol.xoauth2(user, token), self.timeout)
+        if response.result == 'OK':
+            self.user = user
+        return response
 
     async def logout(self) -> Response:
         """
@@ -775,7 +1611,10 @@ class IMAP4(object):
         :param mailbox: the desired mailbox or folder, for example 'INBOX', 'TRASH', 'SENT', .... -> str
         :return: Server responds with a status and an overview of the mails in the folder -> Response: namedtuple('Response', 'result lines')
         """
-        return await asyncio.wait_for(self.protocol.select(mailbox), self.timeout)
+        response = await asyncio.wait_for(self.protocol.select(self._mailbox_to_imap(mailbox)), self.timeout)
+        if response.result == 'OK':
+            self.selected_mailbox, self.uidvalidity = mailbox, extract_uidvalidity(response)
+        return response
 
     async def search(self, *criteria: str, charset: Optional[str] = 'utf-8') -> Response:
         """
@@ -871,9 +1710,146 @@ class IMAP4(object):
                 """
         return await asyncio.wait_for(self.protocol.search(*criteria, by_uid=True, charset=charset), self.timeout)
 
+    async def search_page(self, *criteria: str, first: int = 1, last: int = 500, charset: Optional[str] = 'utf-8',
+                          by_uid: bool = True) -> List[int]:
+        """
+        One page of the search result, in the mailbox order :
+            uids = await imap_client.search_page('UNSEEN', first=-1, last=-50)  # the 50 last unseen messages
+        When the server has ESEARCH and PARTIAL (rfc9394), only the page is returned by the server
+        (SEARCH RETURN (PARTIAL first:last)), else the whole SEARCH result is sliced.
+        :param first: position of the first message of the page, starting at 1. Negative positions are counted from
+        the end of the result -> int
+        :param last: position of the last message of the page -> int
+        :param by_uid: UIDs if True, else message sequence numbers -> bool
+        :return: the ids of the page -> List[int]
+        :raises Error: when the server response is not OK
+        """
+        partial = self.has_capability('ESEARCH') and self.has_capability('PARTIAL')
+        response = await asyncio.wait_for(self.protocol.search(
+            *criteria, charset=charset, by_uid=by_uid, ret='PARTIAL %d:%d' % (first, last) if partial else None),
+            self.timeout)
+        if response.result != 'OK':
+            raise Error('search failed: %s %s' % (response.result, b' '.join(response.lines).decode()))
+        if partial:
+            result = parse_esearch(response).partial
+            return result.ids if result is not None else []
+        return partial_slice(parse_search(response), first, last)
+
+    async def search_pages(self, *criteria: str, page_size: int = 500, reverse: bool = False,
+                           charset: Optional[str] = 'utf-8', by_uid: bool = True) -> AsyncIterator[List[int]]:
+        """
+        Iterates over the search result by pages, to load only what is displayed :
+            async for uids in imap_client.search_pages('ALL', page_size=50, reverse=True):
+                response = await imap_client.uid('fetch', ','.join(map(str, uids)), '(ENVELOPE)')
+                if not await display(response):
+                    break
+
+        With ESEARCH and PARTIAL (rfc9394) each page is a SEARCH RETURN (PARTIAL ...) command sent when the previous
+        page is consumed. With ESEARCH only, the result is received once as a compact sequence set (SEARCH
+        RETURN (ALL)) that is sliced as the pages are consumed. Else it is a SEARCH sliced in pages.
+        :param page_size: number of ids by page -> int
+        :param reverse: the last messages first (the ids of each page are in descending order) -> bool
+        :param by_uid: UIDs if True, else message sequence numbers -> bool
+        :raises Error: when the server response is not OK
+        """
+        if self.has_capability('ESEARCH') and self.has_capability('PARTIAL'):
+            sign, position = (-1 if reverse else 1), 1
+            while True:
+                page = await self.search_page(*criteria, first=sign * position, last=sign * (position + page_size - 1),
+                                              charset=charset, by_uid=by_uid)
+                if page:
+                    yield page[::-1] if reverse else page
+                if len(page) < page_size:
+                    return
+                position += page_size
+
+        response = await asyncio.wait_for(self.protocol.search(
+            *criteria, charset=charset, by_uid=by_uid, ret='ALL' if self.has_capability('ESEARCH') else None),
+            self.timeout)
+        if response.result != 'OK':
+            raise Error('search failed: %s %s' % (response.result, b' '.join(response.lines).decode()))
+        if self.has_capability('ESEARCH'):
+            ids = iter_sequence_set(esearch_items(response).get('ALL') or '', reverse)
+        else:
+            ids = iter(parse_search(response)[::-1] if reverse else parse_search(response))
+        page = list(islice(ids, page_size))
+        while page:
+            yield page
+            page = list(islice(ids, page_size))
+
+    async def sort(self, sort_criteria: str, *criteria: str, charset: str = 'utf-8') -> Response:
+        """
+        SORT command (rfc5256, SORT capability) : the ids of the messages matching the search criteria in the order
+        given by the sort criteria, sorted by the server. The sort keys are ARRIVAL, CC, DATE, FROM, SIZE, SUBJECT
+        and TO, each of them can be preceded by REVERSE :
+            response = await imap_client.sort('REVERSE DATE', 'UNSEEN')
+            ids = parse_search(response)
+        :param sort_criteria: the sort keys, like 'REVERSE DATE SUBJECT' -> str
+        :param criteria: the search criteria, like for search -> str
+        :param charset: the character set of the search criteria (mandatory for SORT) -> str
+        :return: Server responds with a status and the sorted message ids -> Response: namedtuple('Response', 'result lines')
+        """
+        return await asyncio.wait_for(self.protocol.sort(sort_criteria, *criteria, charset=charset), self.timeout)
+
+    async def uid_sort(self, sort_criteria: str, *criteria: str, charset: str = 'utf-8') -> Response:
+        """
+        Same as sort with UIDs instead of message sequence numbers.
+        :return: Server responds with a status and the sorted UIDs -> Response: namedtuple('Response', 'result lines')
+        """
+        return await asyncio.wait_for(self.protocol.sort(sort_criteria, *criteria, charset=charset, by_uid=True),
+                                      self.timeout)
+
+    async def sort_page(self, sort_criteria: str, *criteria: str, first: int = 1, last: int = 50,
+                        charset: str = 'utf-8', by_uid: bool = True) -> List[int]:
+        """
+        One page of the sorted messages, to fetch only the messages that are displayed :
+            uids = await imap_client.sort_page('REVERSE ARRIVAL', 'ALL', first=1, last=50)
+            response = await imap_client.uid('fetch', ','.join(map(str, uids)), '(ENVELOPE)')
+        When the server has ESORT with PARTIAL (rfc9394) or CONTEXT=SORT (rfc5267), only the page is returned by the
+        server (SORT RETURN (PARTIAL first:last)), else the whole SORT result is sliced.
+        :param first: position of the first message of the page, starting at 1. Negative positions are counted from
+        the end of the result : first=-1, last=-50 gives the 50 last messages -> int
+        :param last: position of the last message of the page -> int
+        :param by_uid: UIDs if True, else message sequence numbers -> bool
+        :return: the ids of the page in the sort order -> List[int]
+        :raises Error: when the server response is not OK
+        """
+        partial = self.has_capability('CONTEXT=SORT') or self.has_capability('ESORT') and self.has_capability('PARTIAL')
+        response = await asyncio.wait_for(self.protocol.sort(
+            sort_criteria, *criteria, charset=charset, by_uid=by_uid,
+            ret='PARTIAL %d:%d' % (first, last) if partial else None), self.timeout)
+        if response.result != 'OK':
+            raise Error('sort failed: %s %s' % (response.result, b' '.join(response.lines).decode()))
+        if partial:
+            result = parse_esearch(response).partial
+            return result.ids if result is not None else []
+        return partial_slice(parse_search(response), first, last)
+
+    async def thread(self, algorithm: str, *criteria: str, charset: str = 'utf-8') -> Response:
+        """
+        THREAD command (rfc5256, THREAD=<algorithm> capability) : the messages matching the search criteria grouped
+        in conversations by the server, with the ORDEREDSUBJECT or REFERENCES algorithm :
+            response = await imap_client.thread('REFERENCES', 'ALL')
+            for thread in parse_thread(response):
+                print(thread.id, thread.children)
+        :param algorithm: 'ORDEREDSUBJECT' or 'REFERENCES' -> str
+        :param criteria: the search criteria, like for search -> str
+        :param charset: the character set of the search criteria -> str
+        :return: Server responds with a status and the threads -> Response: namedtuple('Response', 'result lines')
+        """
+        return await asyncio.wait_for(self.protocol.thread(algorithm, *criteria, charset=charset), self.timeout)
+
+    async def uid_thread(self, algorithm: str, *criteria: str, charset: str = 'utf-8') -> Response:
+        """
+        Same as thread with UIDs instead of message sequence numbers.
+        :return: Server responds with a status and the threads of UIDs -> Response: namedtuple('Response', 'result lines')
+        """
+        return await asyncio.wait_for(self.protocol.thread(algorithm, *criteria, charset=charset, by_uid=True),
+                                      self.timeout)
+
     async def uid(self, command: str, *criteria: str) -> Response:
         """
-        This method allows the client to perform an IMAP command on a certain UID. The commands are 'FETCH', 'STORE', 'COPY', 'MOVE' and 'EXPUNGE'.
+        This method allows the client to perform an IMAP command on a certain UID. The commands are 'FETCH', 'STORE', 'COPY', 'MOVE', 'EXPUNGE', 'SORT' and 'THREAD'.
         THis method instructs the server to use UID's as arguments or results instead of message sequence numbers.
         It is possible to provide criteria alongside the IMAP command:
             Fetch -> UID | desired message parts
@@ -881,8 +1857,10 @@ class IMAP4(object):
             COPY -> UID | destination folder
             MOVE -> UID | destination folder
             EXPUNGE -> UID
+            SORT -> sort criteria | search criteria
+            THREAD -> algorithm | search criteria
         From https://www.atmail.com/blog/imap-commands/ (23/08/2024)
-        :param command: 'FETCH', 'STORE', 'COPY', 'MOVE' or 'EXPUNGE' -> str
+        :param command: 'FETCH', 'STORE', 'COPY', 'MOVE', 'EXPUNGE', 'SORT' or 'THREAD' -> str
         :param criteria: target UID, other criteria related to command -> str
         :return: Server responds with a status and the result of the command -> Response: namedtuple('Response', 'result lines')
         """
@@ -914,6 +1892,8 @@ class IMAP4(object):
         :param criteria: message ID, destination folder
         :return: Server responds with a status and information about the outcome of the operation -> Response: namedtuple('Response', 'result lines')
         """
+        if criteria:
+            criteria = criteria[:-1] + (self._mailbox_to_imap(criteria[-1]),)
         return await asyncio.wait_for(self.protocol.copy(*criteria), self.timeout)
 
     async def expunge(self) -> Response:
@@ -955,6 +1935,199 @@ class IMAP4(object):
         """
         return await self.protocol.fetch(message_set, message_parts, timeout=self.timeout)
 
+    async def fetch_parts(self, message_set: str, predicate: Callable[['BodyPart'], bool],
+                          by_uid: bool = False) -> Dict[int, List[Tuple['BodyPart', bytes]]]:
+        """
+        Downloads only the MIME parts matching predicate : the BODYSTRUCTURE of the messages is fetched first,
+        then the matching parts with BODY.PEEK[section] (one UID FETCH for the messages needing the same sections).
+
+            pdfs = await imap_client.fetch_parts('1:*', lambda part: part.content_type == 'application/pdf')
+
+        :param predicate: called with each non multipart BodyPart (content_type, size, disposition, filename...)
+        :return: for each message UID, the list of the matching parts with their data (use BodyPart.decode to
+        decode the content transfer encoding)
+        """
+        response = await self.protocol.fetch(message_set, '(UID BODYSTRUCTURE)', by_uid=by_uid, timeout=self.timeout)
+        if response.result != 'OK':
+            raise Error('fetch failed: %s %s' % (response.result, b' '.join(response.lines).decode()))
+        matching = dict()
+        for _, items in fetch_items(response.lines):
+            parts = [part for part in parse_bodystructure(items['BODYSTRUCTURE']).walk()
+                     if not part.is_multipart() and predicate(part)]
+            matching[int(items['UID'])] = parts
+
+        uids_by_sections = dict()
+        for uid, parts in matching.items():
+            if parts:
+                uids_by_sections.setdefault(tuple(part.section for part in parts), list()).append(str(uid))
+        data = dict()
+        for sections, uids in uids_by_sections.items():
+            message_parts = '(%s)' % ' '.join('BODY.PEEK[%s]' % section for section in sections)
+            response = await self.protocol.fetch(','.join(uids), message_parts, by_uid=True, timeout=self.timeout)
+            if response.result != 'OK':
+                raise Error('fetch failed: %s %s' % (response.result, b' '.join(response.lines).decode()))
+            for _, items in fetch_items(response.lines):
+                data[int(items['UID'])] = items
+        return {uid: [(part, _bytes(data.get(uid, {}).get('BODY[%s]' % part.section))) for part in parts]
+                for uid, parts in matching.items()}
+
+    async def fetch_size(self, uid: int) -> int:
+        """:return: the RFC822.SIZE of the message uid"""
+        return int(await self._fetch_item(uid, 'RFC822.SIZE', 'RFC822.SIZE'))
+
+    async def fetch_range(self, uid: int, offset: int, length: int) -> bytes:
+        """
+        Fetches length bytes of the message uid starting at offset, with a partial BODY.PEEK[]<offset.length>.
+        The data is shorter (or empty) past the end of the message.
+        """
+        return _bytes(await self._fetch_item(uid, 'BODY.PEEK[]<%d.%d>' % (offset, length), 'BODY[]<%d>' % offset))
+
+    async def _fetch_item(self, uid: int, message_part: str, key: str) -> Any:
+        response = await self.protocol.fetch(str(uid), '(%s)' % message_part, by_uid=True, timeout=self.timeout)
+        if response.result != 'OK':
+            raise Error('fetch failed: %s %s' % (response.result, b' '.join(response.lines).decode()))
+        for _, items in fetch_items(response.lines):
+            if key in items:
+                return items[key]
+        raise Error('no %s for message UID %s' % (key, uid))
+
+    async def download(self, uid: int, sink: Callable[[int, bytes], Any], offset: int = 0, end: int = None,
+                       chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> int:
+        """
+        Downloads the message uid by chunks of chunk_size bytes (partial fetches BODY.PEEK[]<offset.length>),
+        so a big message is never held in memory and a lost connection does not restart the download :
+
+            with open('message.eml', 'wb') as f:
+                await imap_client.download(uid, lambda offset, data: f.write(data))
+
+        :param sink: called with the offset and the data of each chunk, in order. It may be a coroutine function
+        :param offset: offset to start (or resume) the download from -> int
+        :param end: offset to stop the download at, the size of the message (fetched with RFC822.SIZE) by default
+        :return: the offset reached (the message size when the download is complete)
+        :raises DownloadInterrupted: (a ConnectionLost) when the connection is lost, its offset is the offset
+        to resume from
+        """
+        try:
+            if end is None:
+                end = await self.fetch_size(uid)
+            while offset < end:
+                data = await self.fetch_range(uid, offset, min(chunk_size, end - offset))
+                if not data:
+                    break
+                written = sink(offset, data)
+                if inspect.isawaitable(written):
+                    await written
+                offset += len(data)
+        except DownloadInterrupted:
+            raise
+        except ConnectionLost as exc:
+            raise DownloadInterrupted(str(exc), offset, end) from exc
+        return offset
+
+    async def fetch_cached(self, uids: Iterable[int], message_parts: str) -> Dict[int, Dict[str, Any]]:
+        """
+        Same as a UID FETCH of uids, but the immutable data items (headers, ENVELOPE, BODYSTRUCTURE...) are read from
+        fetch_cache, and the message contents (BODY[], BODY[section], RFC822) from body_cache if it is set :
+        only the messages missing from the caches are fetched. FLAGS, MODSEQ and the partial fetches
+        are always fetched. The cache of the selected mailbox is invalidated when its UIDVALIDITY changes.
+        The caches are read and written in the default executor of the loop, so their disk I/O does not block it.
+
+            imap_client.fetch_cache = FetchCache('headers.db')
+            await imap_client.select('INBOX')
+            messages = await imap_client.fetch_cached(uids, '(FLAGS BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)])')
+            subject = messages[uid]['BODY[HEADER.FIELDS (FROM SUBJECT)]']
+
+        :return: the data items of each message by UID, the keys are upper case and without .PEEK
+        """
+        uids = list(uids)
+        items = [item for item in parse_imap_list([b'(%s)' % message_parts.strip('()').encode()])
+                 if item.upper() != 'UID']
+        cacheable = [item for item in items if is_immutable_fetch_item(item)]
+        volatile = [item for item in items if not is_immutable_fetch_item(item)]
+        messages: Dict[int, Dict[str, Any]] = {uid: dict() for uid in uids}
+        use_cache = self.uidvalidity is not None and (self.fetch_cache is not None or self.body_cache is not None)
+
+        missing = uids
+        if use_cache and cacheable:
+            keys = [fetch_item_key(item) for item in cacheable]
+            # the caches do blocking disk I/O (SQLite, files), they are read and written in the default executor
+            for uid, cached_items in (await self.asyncio_loop.run_in_executor(
+                    None, self._cached_messages, uids, keys)).items():
+                messages[uid].update(cached_items)
+            missing = [uid for uid in uids if any(key not in messages[uid] for key in keys)]
+
+        missing_set = set(missing)
+        cached = [uid for uid in uids if uid not in missing_set]
+        for fetched_uids, fetched_items in ((missing, items), (cached, volatile)):
+            if not fetched_uids or not fetched_items:
+                continue
+            response = await self.protocol.fetch(uid_set(fetched_uids), '(UID %s)' % ' '.join(fetched_items),
+                                                 by_uid=True, timeout=self.timeout)
+            if response.result != 'OK':
+                raise Error('fetch failed: %s %s' % (response.result, b' '.join(response.lines).decode()))
+            to_cache = dict()
+            for _, fetched in fetch_items(response.lines):
+                uid = int(fetched.pop('UID', 0))
+                if uid not in messages:
+                    continue
+                messages[uid].update(fetched)
+                if use_cache:
+                    to_cache[uid] = {key: value for key, value in fetched.items() if is_immutable_fetch_item(key)}
+            if to_cache:
+                await self.asyncio_loop.run_in_executor(None, self._cache_messages, to_cache)
+        return messages
+
+    def _cache_mailbox(self) -> str:
+        # the caches may be shared by the clients of several accounts
+        return '%s@%s:%s/%s' % (self.user, self.host, self.port, self.selected_mailbox)
+
+    def _cached_messages(self, uids: List[int], keys: List[str]) -> Dict[int, Dict[str, Any]]:
+        if self.fetch_cache is not None:
+            self.fetch_cache.validate(self._cache_mailbox(), self.uidvalidity)
+        return {uid: self._cached_items(uid, keys) for uid in uids}
+
+    def _cache_messages(self, messages: Dict[int, Dict[str, Any]]) -> None:
+        for uid, items in messages.items():
+            self._cache_items(uid, items)
+
+    def _cached_items(self, uid: int, keys: List[str]) -> Dict[str, Any]:
+        mailbox = self._cache_mailbox()
+        items = self.fetch_cache.get(mailbox, uid) if self.fetch_cache is not None else dict()
+        if self.body_cache is not None:
+            for key in filter(is_body_fetch_item, keys):
+                data = self.body_cache.get(mailbox, self.uidvalidity, uid, key)
+                if data is not None:
+                    items = {**items, key: data}
+        return items
+
+    def _cache_items(self, uid: int, items: Dict[str, Any]) -> None:
+        mailbox = self._cache_mailbox()
+        if self.body_cache is not None:
+            for key in list(filter(is_body_fetch_item, items)):
+                self.body_cache.put(mailbox, self.uidvalidity, uid, key, _bytes(items.pop(key)))
+        if self.fetch_cache is not None:
+            self.fetch_cache.put(mailbox, uid, items)
+
+    def fetch_stream(self, message_set: str, message_parts: str, by_uid: bool = False) -> AsyncIterator[List[bytes]]:
+        """
+        Same as fetch (or uid fetch with by_uid=True) but the messages are yielded as soon as they are received :
+
+            async for message in imap_client.fetch_stream('1:*', '(UID BODY.PEEK[])'):
+                await store(message)
+
+        A message is the list of the response lines for one message (the literals are separate lines).
+        If the consumer is slower than the network, the reading of the socket is paused when more than
+        protocol.read_high_water_mark bytes are waiting to be consumed (the message being received included),
+        so the memory stays bounded. A consumer breaking out of the loop should call the aclose() method of
+        the iterator : the messages it will not consume are released and the reading is resumed then.
+        The timeout is applied between two received lines.
+        :param message_set: a set of the message sequence numbers (or uids) of the targeted messages -> str
+        :param message_parts: a combination of the desired message parts -> str
+        :param by_uid: message_set is a uid set -> bool
+        :raises Error: when the server response is not OK
+        """
+        return self.protocol.fetch_stream(message_set, message_parts, by_uid=by_uid, timeout=self.timeout)
+
     async def idle(self) -> Response:
         """
         This method is used internally. It is better to use the idle_start method
@@ -1006,6 +2179,8 @@ class IMAP4(object):
         await asyncio.wait({idle, wait_for_ack}, return_when=asyncio.FIRST_COMPLETED)
         if not self.is_idling():
             wait_for_ack.cancel()
+            if idle.done() and isinstance(idle.exception(), ConnectionLost):
+                raise idle.exception()
             raise Abort('server returned error to IDLE command')
 
         def start_stop_wait_server_push():
@@ -1031,6 +2206,7 @@ class IMAP4(object):
         This command returns the prefix and hierarchy delimiter to the Personal Namespace(s), other Users’ Namespace(s) and Shared Namespace(s) that the server wishes to expose. The command also reveals the folder separator.
         The response is returned in the following order: personal namespaces, user namespaces and shared namespaces. If there are not user namespaces or shared namespaces, a NIL is displayed.
         :return: Server responds with a status and the different namespaces -> Response: namedtuple('Response', 'result lines')
+        parse_namespace(response) gives them as Namespaces
         """
         return await asyncio.wait_for(self.protocol.namespace(), self.timeout)
 
@@ -1060,7 +2236,11 @@ class IMAP4(object):
         :param mailbox: The requested mailbox -> str
         :return: Server responds with a status and an overview of the selected folder -> Response: namedtuple('Response', 'result lines')
         """
-        return await asyncio.wait_for(self.protocol.simple_command('EXAMINE', mailbox), self.timeout)
+        response = await asyncio.wait_for(self.protocol.simple_command('EXAMINE', self._mailbox_to_imap(mailbox)),
+                                          self.timeout)
+        if response.result == 'OK':
+            self.selected_mailbox, self.uidvalidity = mailbox, extract_uidvalidity(response)
+        return response
 
     async def status(self, mailbox: str, names: str) -> Response:
         """
@@ -1074,8 +2254,33 @@ class IMAP4(object):
         :param mailbox: the requested mailbox -> str
         :param names: the folder attributes of interest -> str
         :return: Server responds with a status and the status of the selected attributes in the selected folder -> Response: namedtuple('Response', 'result lines')
+        parse_status(response) gives them as a dict
+        """
+        return await asyncio.wait_for(
+            self.protocol.status(mailbox_argument(self._mailbox_to_imap(mailbox)), names), self.timeout)
+
+    async def status_many(self, mailboxes: Iterable[str],
+                          status_items: str = 'MESSAGES UNSEEN UIDNEXT') -> Dict[str, Dict[str, int]]:
+        """
+        Sends the STATUS commands of all the mailboxes at once (pipelined) and waits for their responses :
+
+            statuses = await imap_client.status_many(['INBOX', 'Sent Items'], 'MESSAGES UNSEEN')
+            print(statuses['Sent Items']['UNSEEN'])
+
+        :param mailboxes: the mailbox names (not quoted nor encoded) -> Iterable[str]
+        :param status_items: the STATUS data items -> str
+        :return: the status by mailbox name, like {'INBOX': {'MESSAGES': 12, 'UNSEEN': 2}}. The mailboxes
+        for which the server answered NO are missing
         """
-        return await asyncio.wait_for(self.protocol.simple_command('STATUS', mailbox, names), self.timeout)
+        responses = await asyncio.gather(*(asyncio.wait_for(self.protocol.status(
+            mailbox_argument(self._mailbox_to_imap(mailbox)), '(%s)' % status_items), self.timeout)
+            for mailbox in mailboxes))
+        statuses = dict()
+        for response in responses:
+            if response.result == 'OK':
+                for name, mailbox in parse_list_status(response.lines[:-1], 'STATUS').items():
+                    statuses[name] = mailbox.status
+        return statuses
 
     async def subscribe(self, mailbox: str) -> Response:
         """
@@ -1088,7 +2293,7 @@ class IMAP4(object):
         :param mailbox: the mailbox of interest
         :return: Server responds with a status and information about the outcome of the command -> Response: namedtuple('Response', 'result lines')
         """
-        return await asyncio.wait_for(self.protocol.simple_command('SUBSCRIBE', mailbox), self.timeout)
+        return await asyncio.wait_for(self.protocol.simple_command('SUBSCRIBE', self._mailbox_to_imap(mailbox)), self.timeout)
 
     async def unsubscribe(self, mailbox: str) -> Response:
         """
@@ -1096,7 +2301,8 @@ class IMAP4(object):
         :param mailbox: the mailbox you wish to unsubscribe to -> str
         :return: Server responds with a status and information about the outcome of the command -> Response: namedtuple('Response', 'result lines')
         """
-        return await asyncio.wait_for(self.protocol.simple_command('UNSUBSCRIBE', mailbox), self.timeout)
+        return await asyncio.wait_for(self.protocol.simple_command('UNSUBSCRIBE', self._mailbox_to_imap(mailbox)),
+                                      self.timeout)
 
     async def lsub(self, reference_name: str, mailbox_name: str) -> Response:
         """
@@ -1115,16 +2321,20 @@ class IMAP4(object):
         :param mailbox_name: can contain wildcards to match names under the provided hierarchy.
         :return: Server responds with a status and a list of the subscribed folders -> Response: namedtuple('Response', 'result lines')
         """
-        return await asyncio.wait_for(self.protocol.simple_command('LSUB', reference_name, mailbox_name), self.timeout)
+        return await asyncio.wait_for(self.protocol.simple_command(
+            'LSUB', self._mailbox_to_imap(reference_name), self._mailbox_to_imap(mailbox_name)), self.timeout)
 
     async def create(self, mailbox_name: str) -> Response:
-        return await asyncio.wait_for(self.protocol.simple_command('CREATE', mailbox_name), self.timeout)
+        return await asyncio.wait_for(self.protocol.simple_command('CREATE', self._mailbox_to_imap(mailbox_name)),
+                                      self.timeout)
 
     async def delete(self, mailbox_name: str) -> Response:
-        return await asyncio.wait_for(self.protocol.simple_command('DELETE', mailbox_name), self.timeout)
+        return await asyncio.wait_for(self.protocol.simple_command('DELETE', self._mailbox_to_imap(mailbox_name)),
+                                      self.timeout)
 
     async def rename(self, old_mailbox_name: str, new_mailbox_name: str) -> Response:
-        return await asyncio.wait_for(self.protocol.simple_command('RENAME', old_mailbox_name, new_mailbox_name), self.timeout)
+        return await asyncio.wait_for(self.protocol.simple_command(
+            'RENAME', self._mailbox_to_imap(old_mailbox_name), self._mailbox_to_imap(new_mailbox_name)), self.timeout)
 
     async def getquotaroot(self, mailbox_name: str) -> Response:
         return await asyncio.wait_for(self.protocol.execute(Command('GETQUOTAROOT', self.protocol.new_tag(), 'INBOX', untagged_resp_name='QUOTA')), self.timeout)
@@ -1136,13 +2346,58 @@ class IMAP4(object):
         From: https://www.atmail.com/blog/imap-commands/ (23/08/2024)
         :param reference_name:
         :param mailbox_pattern:
-        :return:
+        :return: Server responds with a status and the mailboxes, parse_list(response) gives the ListedMailbox
         """
-        return await asyncio.wait_for(self.protocol.simple_command('LIST', reference_name, mailbox_pattern),
-                                      self.timeout)
+        return await asyncio.wait_for(self.protocol.simple_command(
+            'LIST', self._mailbox_to_imap(reference_name), self._mailbox_to_imap(mailbox_pattern)), self.timeout)
+
+    async def list_status(self, reference_name: str = '""', mailbox_pattern: str = '*',
+                          status_items: str = 'MESSAGES UNSEEN UIDNEXT') -> Dict[str, 'ListedMailbox']:
+        """
+        Lists the mailboxes with their status, in one command if the server has LIST-STATUS (rfc5819) :
 
-    async def append(self, message_bytes, mailbox: str = 'INBOX', flags: str = None, date: Any = None) -> Response:
-        return await self.protocol.append(message_bytes, mailbox, flags, date, timeout=self.timeout)
+            for mailbox in (await imap_client.list_status(status_items='MESSAGES UNSEEN')).values():
+                print(mailbox.name, mailbox.status['UNSEEN'])
+
+        Without LIST-STATUS, it is a LIST followed by the pipelined STATUS of the selectable mailboxes.
+        :param status_items: the STATUS data items, for example 'MESSAGES UNSEEN UIDNEXT HIGHESTMODSEQ' -> str
+        :return: the ListedMailbox (name flags delimiter status) by mailbox name, status is a dict like
+        {'MESSAGES': 12, 'UNSEEN': 2}
+        :raises Error: when the server response is not OK
+        """
+        if self.has_capability('LIST-STATUS'):
+            response = await asyncio.wait_for(self.protocol.list_status(
+                self._mailbox_to_imap(reference_name), self._mailbox_to_imap(mailbox_pattern), status_items), self.timeout)
+            if response.result != 'OK':
+                raise Error('list failed: %s %s' % (response.result, b' '.join(response.lines).decode()))
+            return parse_list_status(response.lines[:-1])
+
+        response = await self.list(reference_name, mailbox_pattern)
+        if response.result != 'OK':
+            raise Error('list failed: %s %s' % (response.result, b' '.join(response.lines).decode()))
+        mailboxes = {mailbox.name: mailbox for mailbox in parse_list(response)}
+        selectable = [mailbox.name for mailbox in mailboxes.values()
+                      if not {'\\NOSELECT', '\\NONEXISTENT'} & {flag.upper() for flag in mailbox.flags}]
+        for name, status in (await self.status_many(selectable, status_items)).items():
+            if name in mailboxes:
+                mailboxes[name] = mailboxes[name]._replace(status=status)
+        return mailboxes
+
+    async def append(self, message_bytes: Any, mailbox: str = 'INBOX', flags: str = None, date: Any = None,
+                     size: int = None) -> Response:
+        """
+        Appends a message to a mailbox. The message is not loaded in memory : it is sent by chunks
+        after the server continuation (or right after the command if the server has LITERAL+).
+        :param message_bytes: the message as bytes-like object, path, binary file object (read from its
+        current position) or async iterable of bytes -> Any
+        :param mailbox: destination mailbox -> str
+        :param flags: flags to set, with or without parenthesis -> str
+        :param date: internal date of the message -> Any
+        :param size: message size, mandatory for iterables -> int
+        :return: Server responds with a status -> Response: namedtuple('Response', 'result lines')
+        """
+        return await self.protocol.append(message_bytes, self._mailbox_to_imap(mailbox), flags, date, timeout=self.timeout,
+                                          size=size)
 
     async def close(self) -> Response:
         """
@@ -1162,17 +2417,20 @@ class IMAP4(object):
         await self.logout()
 
     async def move(self, uid_set: str, mailbox: str) -> Response:
-        return await asyncio.wait_for(self.protocol.move(uid_set, mailbox), self.timeout)
+        return await asyncio.wait_for(self.protocol.move(uid_set, self._mailbox_to_imap(mailbox)), self.timeout)
 
     async def enable(self, capability: str) -> Response:
         if 'ENABLE' not in self.protocol.capabilities:
             raise Abort('server has not ENABLE capability')
 
-        return await asyncio.wait_for(self.protocol.simple_command('ENABLE', capability), self.timeout)
+        return await asyncio.wait_for(self.protocol.enable(capability), self.timeout)
 
     def has_capability(self, capability: str) -> bool:
         return capability in self.protocol.capabilities
 
+    def _mailbox_to_imap(self, name: str) -> str:
+        return mailbox_to_imap(name, encoded=not self.encode_mailbox_names)
+
 
 def extract_exists(response: Response) -> Optional[int]:
     for line in response.lines:
@@ -1180,6 +2438,639 @@ def extract_exists(response: Response) -> Optional[int]:
             return int(line.replace(b' EXISTS', b'').decode())
 
 
+def extract_uidvalidity(response: Response) -> Optional[int]:
+    for line in response.lines:
+        match = uidvalidity_re.search(line)
+        if match:
+            return int(match.group('uidvalidity'))
+
+
+def uid_set(uids: Iterable[int]) -> str:
+    """returns a sequence set with ranges for the consecutive uids : [1, 2, 3, 5] -> '1:3,5'"""
+    ranges = list()
+    for uid in sorted(set(uids)):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(start) if start == end else '%d:%d' % (start, end) for start, end in ranges)
+
+
+ListedMailbox = namedtuple('ListedMailbox', 'name flags delimiter status')
+Namespaces = namedtuple('Namespaces', 'personal other shared')
+ESearchResult = namedtuple('ESearchResult', 'tag uid min max count all partial')
+Partial = namedtuple('Partial', 'first last ids')
+ThreadNode = namedtuple('ThreadNode', 'id children')
+
+
+def parse_imap_data(lines: Iterable[Union[bytes, bytearray]]) -> list:
+    """
+    Parses all the data items of one response (its first line and the literals following it) :
+    b'INBOX (MESSAGES 2)' -> ['INBOX', ['MESSAGES', '2']]
+    """
+    lines = list(lines)
+    return parse_imap_list([b'(' + lines[0]] + lines[1:] + [b')'])
+
+
+def untagged_data(lines: Iterable[Union[bytes, bytearray]], name: str = None) -> Iterator[Tuple[str, list]]:
+    """
+    Yields the name and the parsed data of the untagged responses of lines : ('STATUS', ['INBOX', ['MESSAGES', '2']]).
+    The async commands receive their untagged responses without their name : name is given then.
+    """
+    response = response_name = None
+    previous = None
+    for line in lines:
+        # literals are bytearray : the line following a literal is the end of the same response
+        if type(line) is bytes and type(previous) is not bytearray:
+            if response is not None:
+                yield response_name, parse_imap_data(response)
+            if name is None:
+                word, _, rest = line.partition(b' ')
+                response_name, response = word.upper().decode(), [rest]
+            else:
+                response_name, response = name, [line]
+        elif response is not None:
+            response.append(line)
+        previous = line
+    if response is not None:
+        yield response_name, parse_imap_data(response)
+
+
+def parse_list_status(lines: Iterable[Union[bytes, bytearray]], name: str = None) -> Dict[str, ListedMailbox]:
+    """
+    Parses the LIST (or LSUB) and STATUS untagged responses into ListedMailbox by mailbox name (decoded from
+    modified UTF-7). The mailboxes that are only in a STATUS response have no flags nor delimiter.
+    """
+    mailboxes: Dict[str, ListedMailbox] = dict()
+    for response_name, data in untagged_data(lines, name):
+        if response_name in ('LIST', 'LSUB'):
+            mailbox = decode_mailbox(_text(data[2]))
+            status = mailboxes[mailbox].status if mailbox in mailboxes else dict()
+            mailboxes[mailbox] = ListedMailbox(mailbox, data[0], _text(data[1]), status)
+        elif response_name == 'STATUS':
+            mailbox, items = decode_mailbox(_text(data[0])), data[1]
+            status = {items[i].upper(): int(items[i + 1]) for i in range(0, len(items) - 1, 2)}
+            if mailbox in mailboxes:
+                mailboxes[mailbox].status.update(status)
+            else:
+                mailboxes[mailbox] = ListedMailbox(mailbox, [], None, status)
+    return mailboxes
+
+
+def parse_list(response: Response) -> List[ListedMailbox]:
+    """the mailboxes of a LIST or LSUB response, their status is empty"""
+    return list(parse_list_status(response.lines[:-1], 'LIST').values())
+
+
+def parse_status(response: Response) -> Dict[str, int]:
+    """the data items of a STATUS response : {'MESSAGES': 12, 'UNSEEN': 2}"""
+    for mailbox in parse_list_status(response.lines[:-1], 'STATUS').values():
+        return mailbox.status
+    return dict()
+
+
+def parse_namespace(response: Response) -> Namespaces:
+    """the personal, other users and shared namespaces of a NAMESPACE response, as lists of (prefix, delimiter)"""
+    for _, data in untagged_data(response.lines[:-1], 'NAMESPACE'):
+        return Namespaces(*[[(_text(namespace[0]), _text(namespace[1])) for namespace in namespaces or ()]
+                            for namespaces in data[:3]])
+    return Namespaces([], [], [])
+
+
+def parse_quota(response: Response) -> Dict[str, Dict[str, Tuple[int, int]]]:
+    """the usage and limit of each resource by quota root of a GETQUOTA(ROOT) response : {'': {'STORAGE': (10, 512)}}"""
+    quotas = dict()
+    for _, (root, resources) in untagged_data(response.lines[:-1], 'QUOTA'):
+        quotas[_text(root)] = {resources[i].upper(): (int(resources[i + 1]), int(resources[i + 2]))
+                               for i in range(0, len(resources) - 2, 3)}
+    return quotas
+
+
+def parse_search(response: Response) -> List[int]:
+    """the message ids of a SEARCH or SORT response in their order : [3, 1, 2]"""
+    return [int(token) for line in response.lines[:-1] if type(line) is bytes
+            for token in line.split() if token.isdigit()]
+
+
+def parse_sequence_set(sequence_set: str) -> List[int]:
+    """
+    The numbers of a sequence set in their order. The ranges of an ESORT result can be descending :
+    '4,1:2,9:7' -> [4, 1, 2, 9, 8, 7]
+    """
+    return list(iter_sequence_set(sequence_set))
+
+
+def iter_sequence_set(sequence_set: str, reverse: bool = False) -> Iterator[int]:
+    """
+    Iterates over the numbers of a sequence set without expanding it, from its end if reverse is True :
+    a SEARCH RETURN (ALL) result of millions of messages is only a few ranges.
+    """
+    items = sequence_set.split(',') if sequence_set else []
+    for item in reversed(items) if reverse else items:
+        start, _, end = item.partition(':')
+        start, end = int(start), int(end or start)
+        if reverse:
+            start, end = end, start
+        yield from range(start, end + 1) if start <= end else range(start, end - 1, -1)
+
+
+def partial_slice(ids: Sequence, first: int, last: int) -> list:
+    """
+    The ids of a PARTIAL range (rfc9394) of a whole SEARCH/SORT result. Positions start at 1 and the negative ones
+    are counted from the end : partial_slice(ids, -1, -50) are the 50 last ids.
+    """
+    if first < 0:
+        first, last = sorted((-first, -last))
+        return list(ids[max(len(ids) - last, 0):max(len(ids) - first + 1, 0)])
+    first, last = sorted((first, last))
+    return list(ids[first - 1:last])
+
+
+def parse_esearch(response: Response) -> ESearchResult:
+    """
+    The first ESEARCH response (rfc4731) of a SEARCH or SORT with RETURN options :
+    b'(TAG "A1") UID COUNT 3 PARTIAL (1:2 4,2)' -> ESearchResult('A1', True, None, None, 3, [], Partial(1, 2, [4, 2]))
+    """
+    items = esearch_items(response)
+    partial = None
+    if items.get('PARTIAL') is not None:
+        window, ids = items['PARTIAL']
+        first, _, last = window.partition(':')
+        partial = Partial(int(first), int(last), parse_sequence_set(ids) if ids is not None else [])
+    return ESearchResult(items.get('TAG'), 'UID' in items, _int(items.get('MIN')), _int(items.get('MAX')),
+                         _int(items.get('COUNT')), parse_sequence_set(items.get('ALL') or ''), partial)
+
+
+def esearch_items(response: Response) -> Dict[str, Any]:
+    """
+    The raw data items of the first ESEARCH response, with its TAG correlator and the UID indicator :
+    b'(TAG "A1") UID ALL 1:1000000' -> {'TAG': 'A1', 'UID': True, 'ALL': '1:1000000'}
+    """
+    for _, data in untagged_data(response.lines[:-1], 'ESEARCH'):
+        items = dict()
+        if data and isinstance(data[0], list):
+            items['TAG'] = _text(data[0][1]) if len(data[0]) > 1 else None
+            data = data[1:]
+        if data and isinstance(data[0], str) and data[0].upper() == 'UID':
+            items['UID'], data = True, data[1:]
+        items.update((data[i].upper(), data[i + 1]) for i in range(0, len(data) - 1, 2))
+        return items
+    return dict()
+
+
+def parse_thread(response: Response) -> List[ThreadNode]:
+    """
+    The threads of a THREAD response (rfc5256) as trees of ThreadNode (id children) :
+    b'(2)(3 6 (4 23)(44 7 96))' -> [ThreadNode(2, []), ThreadNode(3, [ThreadNode(6, [ThreadNode(4, [...]), ...])])]
+    A thread whose root message is missing (b'((3)(5))') has a root node with None as id.
+    """
+    for _, data in untagged_data(response.lines[:-1], 'THREAD'):
+        return [_thread_node(thread) for thread in data]
+    return []
+
+
+def _thread_node(thread: list) -> ThreadNode:
+    # a thread is a chain of ids (each one the parent of the next one) followed by the sub threads of the last id
+    ids = [int(item) for item in thread if not isinstance(item, list)]
+    node = ThreadNode(ids[-1] if ids else None, [_thread_node(item) for item in thread if isinstance(item, list)])
+    for id_ in reversed(ids[:-1]):
+        node = ThreadNode(id_, [node])
+    return node
+
+
+def status_resp_name(data: bytes) -> str:
+    """
+    The key of the pending STATUS command for the mailbox starting data (quoted or not) : 'STATUS INBOX'.
+    It is 'STATUS' if the mailbox name is a literal.
+    """
+    token = imap_token_re.match(data)
+    if token is None or token.group('atom') is None and token.group('quoted') is None:
+        return 'STATUS'
+    if token.group('quoted') is not None:
+        name = re.sub(rb'\\(.)', rb'\1', token.group('quoted')).decode(errors='replace')
+    else:
+        name = token.group('atom').decode(errors='replace')
+    return 'STATUS %s' % ('INBOX' if name.upper() == 'INBOX' else name)
+
+
+modified_base64_re = re.compile(r'&([A-Za-z0-9+,]*)-')
+
+
+@functools.lru_cache(maxsize=1024)
+def encode_mailbox(name: str) -> str:
+    """encodes a mailbox name in modified UTF-7 (rfc3501 5.1.3) : 'Entwürfe' -> 'Entw&APw-rfe', 'R&D' -> 'R&-D'"""
+    encoded = list()
+    unicode_chars = list()
+
+    def encode_unicode_chars() -> None:
+        if unicode_chars:
+            data = b64encode(''.join(unicode_chars).encode('utf-16-be')).rstrip(b'=').replace(b'/', b',')
+            encoded.append('&%s-' % data.decode())
+            unicode_chars.clear()
+
+    for char in name:
+        if '\x20' <= char <= '\x7e':
+            encode_unicode_chars()
+            encoded.append('&-' if char == '&' else char)
+        else:
+            unicode_chars.append(char)
+    encode_unicode_chars()
+    return ''.join(encoded)
+
+
+def _decode_modified_base64(match: Any) -> str:
+    data = match.group(1)
+    if not data:
+        return '&'
+    try:
+        return b64decode(data.replace(',', '/') + '=' * (-len(data) % 4)).decode('utf-16-be')
+    except (binascii.Error, UnicodeDecodeError):
+        return match.group(0)
+
+
+@functools.lru_cache(maxsize=1024)
+def decode_mailbox(name: str) -> str:
+    """decodes a mailbox name from modified UTF-7 (rfc3501 5.1.3) : 'Entw&APw-rfe' -> 'Entwürfe'"""
+    if '&' not in name:
+        return name
+    return modified_base64_re.sub(_decode_modified_base64, name)
+
+
+def mailbox_to_imap(name: str, encoded: bool = False) -> str:
+    """
+    The mailbox name to send, encoded in modified UTF-7 ('R&D' -> 'R&-D') unless it is already encoded.
+    The quotes of a quoted name are kept.
+    """
+    if encoded or not isinstance(name, str):
+        return name
+    return encode_mailbox(name)
+
+
+def mailbox_argument(name: str) -> str:
+    """the mailbox name as an atom if possible, else quoted. A name already quoted is kept"""
+    if name and re.fullmatch(r'[^\x00-\x20(){%*"\\\]\x7f]+', name):
+        return name
+    if len(name) > 1 and name[0] == name[-1] == '"':
+        return name
+    return quoted(name)
+
+
+uidvalidity_re = re.compile(rb'\[UIDVALIDITY (?P<uidvalidity>\d+)\]')
+imap_token_re = re.compile(rb'[ \t]*(?:(?P<open>\()|(?P<close>\))|"(?P<quoted>(?:[^"\\]|\\.)*)"|'
+                           rb'\{(?P<literal>\d+)\+?\}[ \t]*$|(?P<atom>[^\s()"{\[]+(?:\[[^\]]*\](?:<[\d.]+>)?)?))')
+fetch_line_re = re.compile(rb'(?P<id>\d+) FETCH ')
+
+
+def parse_imap_list(lines: Iterable[bytes]) -> list:
+    """
+    Parses the first parenthesized list of response lines (the tokens before it are skipped) into python lists :
+    atoms and quoted strings are str, NIL is None, literals (the lines following a {size} line) are bytes.
+    """
+    stack = list()
+    lines = iter(lines)
+    for line in lines:
+        pos = 0
+        while pos < len(line):
+            token = imap_token_re.match(line, pos)
+            if token is None:
+                if line[pos:].strip():
+                    raise Error('cannot parse %r' % bytes(line[pos:]))
+                break
+            pos = token.end()
+            if token.group('open'):
+                stack.append(list())
+            elif token.group('close'):
+                if not stack:
+                    raise Error('unbalanced parenthesis in %r' % bytes(line))
+                closed = stack.pop()
+                if not stack:
+                    return closed
+                stack[-1].append(closed)
+            elif not stack:
+                if token.group('literal') is not None:
+                    next(lines, None)
+            elif token.group('quoted') is not None:
+                stack[-1].append(re.sub(rb'\\(.)', rb'\1', token.group('quoted')).decode())
+            elif token.group('literal') is not None:
+                stack[-1].append(bytes(next(lines, b'')))
+            else:
+                atom = token.group('atom').decode()
+                stack[-1].append(None if atom.upper() == 'NIL' else atom)
+    raise Error('incomplete list in %r' % list(lines))
+
+
+def fetch_items(lines: Iterable[bytes]) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """
+    Yields the message sequence number and the data items of each message of FETCH response lines,
+    the keys are upper case : {'UID': '5', 'BODYSTRUCTURE': [...], 'BODY[2]': b'...'}.
+    """
+    message_lines = None
+    message_id = None
+    for line in lines:
+        # literals are bytearray, they can't be mistaken for a FETCH line
+        match = fetch_line_re.match(line) if type(line) is bytes else None
+        if match is not None:
+            if message_lines is not None:
+                yield message_id, _fetch_items_dict(message_lines)
+            message_id, message_lines = int(match.group('id')), [line]
+        elif message_lines is not None:
+            message_lines.append(line)
+    if message_lines is not None:
+        yield message_id, _fetch_items_dict(message_lines)
+
+
+def _fetch_items_dict(lines: List[bytes]) -> Dict[str, Any]:
+    items = parse_imap_list(lines)
+    return {items[i].upper(): items[i + 1] for i in range(0, len(items) - 1, 2)}
+
+
+MUTABLE_FETCH_ITEMS = {'FLAGS', 'MODSEQ'}
+
+
+def fetch_item_key(item: str) -> str:
+    """returns the data item name of the FETCH response for a requested item : BODY.PEEK[HEADER] -> BODY[HEADER]"""
+    return item.upper().replace('.PEEK[', '[', 1)
+
+
+def is_immutable_fetch_item(item: str) -> bool:
+    """the data items that never change for a message (all except flags, mod-sequence and partial fetches)"""
+    return fetch_item_key(item) not in MUTABLE_FETCH_ITEMS and not item.endswith('>')
+
+
+def is_body_fetch_item(item: str) -> bool:
+    """the data items of the message contents : BODY[], BODY[1.2], BODY[TEXT], BINARY[2], RFC822, RFC822.TEXT"""
+    key = fetch_item_key(item)
+    if key in ('RFC822', 'RFC822.TEXT'):
+        return True
+    return key.startswith(('BODY[', 'BINARY[')) and 'HEADER' not in key and 'MIME' not in key
+
+
+class FetchCache(object):
+    """
+    Cache of the immutable FETCH data items of messages (headers, ENVELOPE, BODYSTRUCTURE...) used by
+    IMAP4.fetch_cached. A message never changes for a UIDVALIDITY, so the items are kept by mailbox and UID,
+    and the mailbox is invalidated when its UIDVALIDITY changes.
+
+    The max_messages most recently used messages are kept in memory. If path is given, all the messages
+    are also stored in a SQLite database, and the cache survives a restart. The SQLite calls are blocking :
+    fetch_cached uses the cache from the default executor, its methods are serialized with a lock.
+    """
+    def __init__(self, path: str = None, max_messages: int = 10000) -> None:
+        self.max_messages = max_messages
+        self._messages: OrderedDict = OrderedDict()
+        self._uidvalidities: Dict[str, int] = dict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        if path is not None:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            with self._db:
+                self._db.execute('CREATE TABLE IF NOT EXISTS mailboxes (mailbox TEXT PRIMARY KEY, uidvalidity INTEGER)')
+                self._db.execute('CREATE TABLE IF NOT EXISTS items (mailbox TEXT, uid INTEGER, item TEXT, value TEXT, '
+                                 'PRIMARY KEY (mailbox, uid, item))')
+            self._uidvalidities = dict(self._db.execute('SELECT mailbox, uidvalidity FROM mailboxes'))
+
+    def validate(self, mailbox: str, uidvalidity: int) -> None:
+        """forgets the messages of mailbox if its UIDVALIDITY is not uidvalidity"""
+        with self._lock:
+            if self._uidvalidities.get(mailbox) == uidvalidity:
+                return
+            for key in [key for key in self._messages if key[0] == mailbox]:
+                del self._messages[key]
+            if self._db is not None:
+                with self._db:
+                    self._db.execute('DELETE FROM items WHERE mailbox = ?', (mailbox,))
+                    self._db.execute('INSERT OR REPLACE INTO mailboxes VALUES (?, ?)', (mailbox, uidvalidity))
+            self._uidvalidities[mailbox] = uidvalidity
+
+    def get(self, mailbox: str, uid: int) -> Dict[str, Any]:
+        with self._lock:
+            items = self._messages.get((mailbox, uid))
+            if items is not None:
+                self._messages.move_to_end((mailbox, uid))
+                return items
+            if self._db is None:
+                return dict()
+            items = {item: ast.literal_eval(value) for item, value in
+                     self._db.execute('SELECT item, value FROM items WHERE mailbox = ? AND uid = ?', (mailbox, uid))}
+            if items:
+                self._remember(mailbox, uid, items)
+            return items
+
+    def put(self, mailbox: str, uid: int, items: Dict[str, Any]) -> None:
+        with self._lock:
+            if not items:
+                return
+            self._remember(mailbox, uid, {**self._messages.get((mailbox, uid), dict()), **items})
+            if self._db is not None:
+                with self._db:
+                    self._db.executemany('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?)',
+                                         [(mailbox, uid, item, repr(value)) for item, value in items.items()])
+
+    def _remember(self, mailbox: str, uid: int, items: Dict[str, Any]) -> None:
+        self._messages[(mailbox, uid)] = items
+        self._messages.move_to_end((mailbox, uid))
+        while len(self._messages) > self.max_messages:
+            self._messages.popitem(last=False)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+
+
+class BodyCache(object):
+    """
+    Disk cache of the message contents (BODY[], BODY[section]...) used by IMAP4.fetch_cached, keyed by
+    mailbox (with the account), UIDVALIDITY, UID and section : the entries of an old UIDVALIDITY are
+    not read anymore and are evicted with the least recently used ones.
+
+    Each entry is a file of directory, written in a temporary file and renamed so a reader never sees
+    a partial entry. When the files exceed max_size bytes the least recently used are deleted, the
+    modification time of the files keeps the order between restarts.
+
+    get and put do blocking file I/O : fetch_cached calls them in the default executor, the files
+    are read and written outside of the lock that protects the index of the entries.
+    """
+    def __init__(self, directory: str, max_size: int = 1024 * 1024 * 1024) -> None:
+        self.directory = directory
+        self.max_size = max_size
+        self.size = 0
+        self._files: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        entries = sorted(os.scandir(directory), key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if entry.name.endswith('.tmp'):
+                os.unlink(entry.path)  # interrupted write
+            elif entry.is_file():
+                self._files[entry.name] = entry.stat().st_size
+                self.size += entry.stat().st_size
+        self._evict()
+
+    @staticmethod
+    def file_name(mailbox: str, uidvalidity: int, uid: int, section: str) -> str:
+        return hashlib.sha256(repr((mailbox, uidvalidity, uid, section)).encode()).hexdigest()
+
+    def get(self, mailbox: str, uidvalidity: int, uid: int, section: str) -> Optional[bytes]:
+        name = self.file_name(mailbox, uidvalidity, uid, section)
+        with self._lock:
+            if name not in self._files:
+                return None
+        path = os.path.join(self.directory, name)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.size -= self._files.pop(name, 0)
+            return None
+        with self._lock:
+            if name in self._files:
+                self._files.move_to_end(name)
+        return data
+
+    def put(self, mailbox: str, uidvalidity: int, uid: int, section: str, data: bytes) -> None:
+        name = self.file_name(mailbox, uidvalidity, uid, section)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, os.path.join(self.directory, name))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        with self._lock:
+            self.size += len(data) - self._files.pop(name, 0)
+            self._files[name] = len(data)
+            self._evict()
+
+    def _evict(self) -> None:
+        while self.size > self.max_size and self._files:
+            name, size = self._files.popitem(last=False)
+            self.size -= size
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+
+class BodyPart(object):
+    """
+    MIME part of a BODYSTRUCTURE (rfc3501 7.4.2). section is the part specifier to fetch it with BODY[section],
+    parts are the sub parts of a multipart, or the body of a message/rfc822 part.
+    """
+    __slots__ = ('section', 'content_type', 'params', 'id', 'description', 'encoding', 'size', 'lines',
+                 'disposition', 'disposition_params', 'parts')
+
+    def __init__(self, section: str, content_type: str, params: Dict[str, str] = None, id: str = None,
+                 description: str = None, encoding: str = None, size: int = 0, lines: int = None,
+                 disposition: str = None, disposition_params: Dict[str, str] = None,
+                 parts: List['BodyPart'] = None) -> None:
+        self.section = section
+        self.content_type = content_type
+        self.params = params or dict()
+        self.id = id
+        self.description = description
+        self.encoding = encoding
+        self.size = size
+        self.lines = lines
+        self.disposition = disposition
+        self.disposition_params = disposition_params or dict()
+        self.parts = parts or list()
+
+    @property
+    def filename(self) -> Optional[str]:
+        return self.disposition_params.get('filename', self.params.get('name'))
+
+    def is_multipart(self) -> bool:
+        return self.content_type.startswith('multipart/')
+
+    def walk(self) -> Iterator['BodyPart']:
+        """yields this part and all its sub parts, depth first"""
+        stack = [self]
+        while stack:
+            part = stack.pop()
+            yield part
+            stack.extend(reversed(part.parts))
+
+    def decode(self, data: bytes) -> bytes:
+        """decodes the part data fetched with BODY[section] from its content transfer encoding"""
+        if self.encoding == 'base64':
+            return b64decode(data)
+        if self.encoding == 'quoted-printable':
+            return binascii.a2b_qp(data)
+        return bytes(data)
+
+    def __repr__(self) -> str:
+        return 'BodyPart(%s, %s, size=%s)' % (self.section or '[]', self.content_type, self.size)
+
+
+def _bytes(value: Any) -> bytes:
+    if value is None:
+        return b''
+    return value.encode() if isinstance(value, str) else bytes(value)
+
+
+def _int(value: Any) -> Optional[int]:
+    return None if value is None else int(value)
+
+
+def _text(value: Any) -> Optional[str]:
+    return value.decode(errors='replace') if isinstance(value, (bytes, bytearray)) else value
+
+
+def _params(value: Optional[list]) -> Dict[str, str]:
+    if not isinstance(value, list):
+        return dict()
+    return {_text(value[i]).lower(): _text(value[i + 1]) for i in range(0, len(value) - 1, 2)}
+
+
+def _disposition(part: BodyPart, value: Any) -> None:
+    if isinstance(value, list) and value:
+        part.disposition = _text(value[0]).lower()
+        part.disposition_params = _params(value[1] if len(value) > 1 else None)
+
+
+def parse_bodystructure(structure: list, section: str = None) -> BodyPart:
+    """
+    Builds the BodyPart tree of a BODYSTRUCTURE (or BODY) parsed with parse_imap_list. The section of
+    a message body is '' if it is a multipart (its sub parts are numbered from 1) or '1' otherwise.
+    """
+    if structure and isinstance(structure[0], list):
+        return _parse_multipart(structure, section or '')
+    section = section or '1'
+    content_type = ('%s/%s' % (_text(structure[0]), _text(structure[1]))).lower()
+    encoding = _text(structure[5])
+    part = BodyPart(section, content_type, _params(structure[2]), _text(structure[3]), _text(structure[4]),
+                    encoding.lower() if encoding else encoding, int(structure[6] or 0))
+    extension = structure[7:]
+    if content_type == 'message/rfc822' and len(extension) >= 3:
+        body = extension[1]
+        part.parts = [parse_bodystructure(body, section if isinstance(body[0], list) else section + '.1')]
+        part.lines, extension = _int(extension[2]), extension[3:]
+    elif content_type.startswith('text/') and extension:
+        part.lines, extension = _int(extension[0]), extension[1:]
+    if len(extension) > 1:
+        _disposition(part, extension[1])
+    return part
+
+
+def _parse_multipart(structure: list, prefix: str) -> BodyPart:
+    # the sub parts are followed by the subtype and the extension data (that may contain lists)
+    position = 0
+    while isinstance(structure[position], list):
+        position += 1
+    children = structure[:position]
+    subtype, extension = _text(structure[position]), structure[position + 1:]
+    part = BodyPart(prefix, 'multipart/%s' % subtype.lower(), _params(extension[0] if extension else None))
+    part.parts = [parse_bodystructure(child, '%s.%d' % (prefix, i) if prefix else str(i))
+                  for i, child in enumerate(children, 1)]
+    if len(extension) > 1:
+        _disposition(part, extension[1])
+    return part
+
+
 class IMAP4_SSL(IMAP4):
     def __init__(self, host: str = '127.0.0.1', port: int = IMAP4_SSL_PORT, loop: asyncio.AbstractEventLoop = None,
                  timeout: float = IMAP4.TIMEOUT_SECONDS,  conn_lost_cb: Callable[[Optional[Exception]], None] = None, ssl_context: ssl.SSLContext = None):
@@ -1191,11 +3082,277 @@ class IMAP4_SSL(IMAP4):
                 :param loop: asyncio eventloop
                 :param timeout: timeout limit when setting up connection, default 10s -> float
                 :param conn_lost_cb: Callback when connection lost -> callable
-                :param ssl_context: ssl.SSLContext
+                :param ssl_context: ssl.SSLContext, a SessionCachingSSLContext resumes TLS sessions
                 """
         if ssl_context is None:
-            ssl_context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+            ssl_context = default_ssl_context()
+        super().__init__(host, port, loop, timeout, conn_lost_cb, ssl_context)
+
+
+class ResilientIMAP4(IMAP4):
+    """
+    IMAP4 client that reconnects when the connection is lost, and restores the session : it logs in again
+    (LOGIN or XOAUTH2 with a new token from token_refresher), enables the same extensions, selects
+    the same mailbox and resumes IDLE.
+
+    The commands in progress when the connection is lost fail immediately with ConnectionLost, they are
+    not sent again (they may have been executed by the server). wait_connected waits for the session
+    to be restored.
+
+    The reconnection attempts are delayed with an exponential backoff with full jitter : a random delay
+    between 0 and min(max_delay, base_delay * 2 ** attempt).
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = IMAP4_PORT, loop: asyncio.AbstractEventLoop = None,
+                 timeout: float = IMAP4.TIMEOUT_SECONDS, conn_lost_cb: Callable[[Optional[Exception]], None] = None,
+                 ssl_context: ssl.SSLContext = None,
+                 token_refresher: Callable[[], Coroutine[Any, Any, Union[str, bytes]]] = None,
+                 base_delay: float = 0.5, max_delay: float = 30.0, max_attempts: Optional[int] = None):
+        """
+        :param token_refresher: coroutine function returning a new XOAUTH2 (or OAUTHBEARER) token for reconnections
+        :param base_delay: delay of the first reconnection attempt in seconds (before jitter) -> float
+        :param max_delay: maximum delay between reconnection attempts in seconds -> float
+        :param max_attempts: number of reconnection attempts before giving up, None for no limit -> int
+        """
         super().__init__(host, port, loop, timeout, conn_lost_cb, ssl_context)
+        self.token_refresher = token_refresher
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self._credentials = None
+        self._starttls: Optional[ssl.SSLContext] = None
+        self._starttls_enabled = False
+        self._enabled: List[str] = list()
+        self._mailbox = None
+        self._idle_timeout: Optional[float] = None
+        self._idle_result: Optional[Future] = None
+        self._closing = False
+        self._reconnection: Optional[Future] = None
+
+    def _create_protocol(self) -> IMAP4ClientProtocol:
+        protocol = IMAP4ClientProtocol(self.asyncio_loop, lambda exc: self._connection_lost(protocol, exc))
+        # IDLE is resumed after reconnecting, wait_server_push keeps waiting
+        protocol.stop_idle_on_connection_lost = False
+        if self.protocol is not None:
+            # the server pushes are still delivered to wait_server_push after reconnecting
+            protocol.idle_queue = self.protocol.idle_queue
+        return protocol
+
+    def _connection_lost(self, protocol: IMAP4ClientProtocol, exc: Optional[Exception]) -> None:
+        if self.conn_lost_cb is not None:
+            self.conn_lost_cb(exc)
+        if self._closing or protocol is not self.protocol or self.is_reconnecting():
+            return
+        self._reconnection = asyncio.ensure_future(self._reconnect())
+        self._reconnection.add_done_callback(self._reconnection_done)
+
+    def is_reconnecting(self) -> bool:
+        return self._reconnection is not None and not self._reconnection.done()
+
+    async def wait_connected(self) -> None:
+        """
+        Waits for the session to be restored if the client is reconnecting.
+        :raises AioImapException: when the reconnection has failed
+        """
+        if self._reconnection is not None:
+            await asyncio.shield(self._reconnection)
+
+    def backoff_delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def _reconnect(self) -> None:
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.backoff_delay(attempt))
+            try:
+                await self.connect()
+                await self._restore_session()
+                log.info('reconnected to %s:%s after %d attempt(s)', self.host, self.port, attempt + 1)
+                return
+            except (OSError, asyncio.TimeoutError, ConnectionLost, CommandTimeout) as exc:
+                attempt += 1
+                log.warning('reconnection attempt %d to %s:%s failed: %r', attempt, self.host, self.port, exc)
+                if self.protocol.transport is not None:
+                    self.protocol.transport.close()
+                if self._closing or (self.max_attempts is not None and attempt >= self.max_attempts):
+                    raise ConnectionLost('could not reconnect to %s:%s : %r' % (self.host, self.port, exc))
+
+    def _reconnection_done(self, reconnection: Future) -> None:
+        if reconnection.cancelled() or reconnection.exception() is None:
+            return
+        log.error('giving up reconnection: %r', reconnection.exception())
+        if self._idle_result is not None and not self._idle_result.done():
+            self._idle_result.set_exception(reconnection.exception())
+
+    async def _restore_session(self) -> None:
+        if self._starttls_enabled:
+            response = await super().starttls(self._starttls)
+            if response.result != 'OK':
+                raise Abort('STARTTLS failed when reconnecting: %s' % response.lines)
+        if self._credentials is not None:
+            method, user, secret = self._credentials
+            if method == 'XOAUTH2':
+                if self.token_refresher is not None:
+                    secret = await self.token_refresher()
+                    self._credentials = (method, user, secret)
+                response = await super().xoauth2(user, secret)
+            elif method == 'AUTHENTICATE':
+                if self.token_refresher is not None and isinstance(secret, XOAuth2Mechanism):
+                    secret.token = await self.token_refresher()
+                response = await super().authenticate(secret)
+            else:
+                response = await super().login(user, secret)
+            if response.result != 'OK':
+                raise Abort('authentication failed when reconnecting: %s' % response.lines)
+        for capability in self._enabled:
+            await super().enable(capability)
+        if self._mailbox is not None:
+            command, mailbox = self._mailbox
+            await (super().examine(mailbox) if command == 'EXAMINE' else super().select(mailbox))
+        if self._idle_timeout is not None:
+            self._chain_idle(await super().idle_start(self._idle_timeout))
+
+    async def starttls(self, ssl_context: ssl.SSLContext = None) -> Response:
+        if ssl_context is None:
+            ssl_context = default_ssl_context()
+        response = await super().starttls(ssl_context)
+        if response.result == 'OK':
+            self._starttls, self._starttls_enabled = ssl_context, True
+        return response
+
+    async def login(self, user: str, password: str) -> Response:
+        response = await super().login(user, password)
+        if response.result == 'OK':
+            self._credentials = ('LOGIN', user, password)
+        return response
+
+    async def authenticate(self, mechanism: SaslMechanism) -> Response:
+        response = await super().authenticate(mechanism)
+        if response.result == 'OK':
+            self._credentials = ('AUTHENTICATE', None, mechanism)
+        return response
+
+    async def xoauth2(self, user: str, token: bytes) -> Response:
+        response = await super().xoauth2(user, token)
+        if response.result == 'OK':
+            self._credentials = ('XOAUTH2', user, token)
+        return response
+
+    async def enable(self, capability: str) -> Response:
+        response = await super().enable(capability)
+        if response.result == 'OK' and capability not in self._enabled:
+            self._enabled.append(capability)
+        return response
+
+    async def select(self, mailbox: str = 'INBOX') -> Response:
+        response = await super().select(mailbox)
+        if response.result == 'OK':
+            self._mailbox = ('SELECT', mailbox)
+        return response
+
+    async def examine(self, mailbox: str = 'INBOX') -> Response:
+        response = await super().examine(mailbox)
+        if response.result == 'OK':
+            self._mailbox = ('EXAMINE', mailbox)
+        return response
+
+    async def close(self) -> Response:
+        response = await super().close()
+        if response.result == 'OK':
+            self._mailbox = None
+        return response
+
+    async def download(self, uid: int, sink: Callable[[int, bytes], Any], offset: int = 0, end: int = None,
+                       chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> int:
+        """
+        Same as IMAP4.download, but the download is resumed from the last received chunk after a reconnection.
+        """
+        while True:
+            try:
+                return await super().download(uid, sink, offset, end, chunk_size)
+            except DownloadInterrupted as interrupted:
+                if self._closing or self._reconnection is None:
+                    raise
+                offset, end = interrupted.offset, interrupted.end
+                await self.wait_connected()
+
+    async def logout(self) -> Response:
+        self._closing = True
+        if self._reconnection is not None:
+            self._reconnection.cancel()
+        return await super().logout()
+
+    async def idle_start(self, timeout: float = TWENTY_NINE_MINUTES) -> Future:
+        """
+        Same as IMAP4.idle_start, but IDLE is resumed after a reconnection : the returned future
+        is done when idle_done is called (or on error), whatever the number of reconnections.
+        """
+        idle = await super().idle_start(timeout)
+        self._idle_timeout = timeout
+        self._idle_result = self.asyncio_loop.create_future()
+        self._chain_idle(idle)
+        return self._idle_result
+
+    def idle_done(self) -> None:
+        self._idle_timeout = None
+        super().idle_done()
+
+    def _chain_idle(self, idle: Future) -> None:
+        result = self._idle_result
+
+        def idle_command_done(future: Future) -> None:
+            if result.done():
+                return
+            if future.cancelled():
+                result.cancel()
+            elif isinstance(future.exception(), ConnectionLost) and self._idle_timeout is not None \
+                    and not self._closing:
+                return  # resumed after the reconnection
+            elif future.exception() is not None:
+                result.set_exception(future.exception())
+            else:
+                result.set_result(future.result())
+        idle.add_done_callback(idle_command_done)
+
+
+class ResilientIMAP4_SSL(ResilientIMAP4):
+    def __init__(self, host: str = '127.0.0.1', port: int = IMAP4_SSL_PORT, loop: asyncio.AbstractEventLoop = None,
+                 timeout: float = IMAP4.TIMEOUT_SECONDS, conn_lost_cb: Callable[[Optional[Exception]], None] = None,
+                 ssl_context: ssl.SSLContext = None, **kwargs):
+        """same as ResilientIMAP4 with the default port and ssl context of IMAP4_SSL"""
+        if ssl_context is None:
+            ssl_context = default_ssl_context()
+        super().__init__(host, port, loop, timeout, conn_lost_cb, ssl_context, **kwargs)
+
+
+async def download_concurrently(clients: Sequence, uid: int, sink: Callable[[int, bytes], Any], offset: int = 0,
+                                end: int = None, chunk_size: int = DOWNLOAD_CHUNK_SIZE) -> int:
+    """
+    Downloads the message uid like IMAP4.download, but the chunks are fetched in parallel with several
+    connections (clients, with the same mailbox selected). sink is called with the offset of each chunk,
+    the chunks may arrive in any order :
+
+        with open('message.eml', 'wb') as f:
+            await download_concurrently(clients, uid, lambda offset, data: (f.seek(offset), f.write(data)))
+
+    ResilientIMAP4 clients resume their chunk after a reconnection.
+    :return: the end offset
+    """
+    if end is None:
+        end = await clients[0].fetch_size(uid)
+    ranges = deque((start, min(start + chunk_size, end)) for start in range(offset, end, chunk_size))
+
+    async def download_ranges(client: IMAP4) -> None:
+        while ranges:
+            start, stop = ranges.popleft()
+            await client.download(uid, sink, start, stop, chunk_size)
+
+    downloads = [asyncio.ensure_future(download_ranges(client)) for client in clients]
+    try:
+        await asyncio.gather(*downloads)
+    finally:
+        for download in downloads:
+            download.cancel()
+    return end
 
 
 
@@ -13,15 +13,18 @@
 #
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import argparse
 import asyncio
 from base64 import b64decode
 import email
 import email.mime.nonmultipart
 import logging
+import random
 import re
 import sys
 import uuid
-from collections import deque
+from bisect import bisect_left
+from collections import deque, Counter
 from copy import deepcopy
 from datetime import datetime, timedelta
 from email._policybase import Compat32
@@ -29,7 +32,6 @@ from email.header import Header
 from email.message import Message
 from functools import update_wrapper
 from math import ceil
-from operator import attrgetter
 
 from pytz import utc
 
@@ -47,11 +49,110 @@ CAPABILITIES = 'IDLE UIDPLUS MOVE ENABLE NAMESPACE AUTH=XOAUTH2'
 CRLF = b'\r\n'
 
 
+def base_subject(message):
+    """the subject without its Re:/Fwd: prefixes, to group the messages of a thread (simplified rfc5256)"""
+    subject = str(message.email.get('Subject', '')).strip().lower()
+    while re.match(r'(re|fwd?):', subject):
+        subject = subject.partition(':')[2].strip()
+    return subject
+
+
+def sequence_set(msg_ids):
+    """the ids in their order with ranges for the consecutive ones : ['1', '2', '3', '7', '5'] -> '1:3,7,5'"""
+    ranges = list()
+    for msg_id in map(int, msg_ids):
+        if ranges and ranges[-1][1] == msg_id - 1:
+            ranges[-1][1] = msg_id
+        else:
+            ranges.append([msg_id, msg_id])
+    return ','.join(str(start) if start == end else '%d:%d' % (start, end) for start, end in ranges)
+
+
+SORT_KEYS = {
+    'ARRIVAL': lambda message: message.uid,
+    'CC': lambda message: str(message.email.get('Cc', '')).lower(),
+    'DATE': lambda message: message.date,
+    'FROM': lambda message: str(message.email.get('From', '')).lower(),
+    'SIZE': lambda message: len(message.as_bytes()),
+    'SUBJECT': base_subject,
+    'TO': lambda message: str(message.email.get('To', '')).lower(),
+}
+
+
 class InvalidUidSet(RuntimeError):
     def __init__(self, *args) -> None:
         super().__init__(*args)
 
 
+class Mailbox(object):
+    """
+    Messages of a mailbox in sequence order, indexed by UID.
+
+    Message sequence numbers are the positions in the sorted UID array : they are
+    not stored but set on the messages (msg.id) when they are read from the mailbox,
+    so an expunge does not have to renumber all the following messages.
+    """
+    def __init__(self):
+        self._uids = list()
+        self._by_uid = dict()
+        self.uidnext = 1
+
+    def append(self, mail):
+        mail.uid = self.uidnext
+        mail.id = len(self._uids) + 1
+        self.uidnext += 1
+        self._uids.append(mail.uid)
+        self._by_uid[mail.uid] = mail
+        return mail.uid
+
+    def get_by_uid(self, uid):
+        msg = self._by_uid.get(uid)
+        if msg is not None:
+            msg.id = bisect_left(self._uids, uid) + 1
+        return msg
+
+    def remove_by_uid(self, uid):
+        msg = self._by_uid.pop(uid)
+        del self._uids[bisect_left(self._uids, uid)]
+        return msg
+
+    def by_uids(self, uids):
+        """:param uids: a range or an iterable of UIDs"""
+        if isinstance(uids, range) and uids.step == 1:
+            start, stop = bisect_left(self._uids, uids.start), bisect_left(self._uids, uids.stop)
+            return self._messages(start, self._uids[start:stop])
+        return [msg for msg in (self.get_by_uid(uid) for uid in sorted(set(uids))) if msg is not None]
+
+    def by_ids(self, ids):
+        """:param ids: a range or an iterable of message sequence numbers"""
+        if isinstance(ids, range) and ids.step == 1:
+            start = max(ids.start - 1, 0)
+            return self._messages(start, self._uids[start:max(ids.stop - 1, 0)])
+        return [self[id - 1] for id in sorted(set(ids)) if 0 < id <= len(self._uids)]
+
+    def _messages(self, first_index, uids):
+        messages = list()
+        for index, uid in enumerate(uids, first_index + 1):
+            msg = self._by_uid[uid]
+            msg.id = index
+            messages.append(msg)
+        return messages
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self._messages(index.indices(len(self))[0], self._uids[index])
+        uid = self._uids[index]
+        msg = self._by_uid[uid]
+        msg.id = index + 1 if index >= 0 else len(self._uids) + index + 1
+        return msg
+
+    def __iter__(self):
+        return iter(self._messages(0, self._uids))
+
+    def __len__(self):
+        return len(self._uids)
+
+
 class ServerState(object):
     DEFAULT_MAILBOXES = ['INBOX', 'Trash', 'Sent', 'Drafts']
 
@@ -59,28 +160,29 @@ class ServerState(object):
         self.mailboxes = dict()
         self.connections = dict()
         self.subcriptions = dict()
+        # commands, bytes_received, bytes_sent, connections : for load testing
+        self.stats = Counter()
 
     def reset(self):
         self.mailboxes = dict()
         for connection in self.connections.values():
             connection.transport.close()
         self.connections = dict()
+        self.stats = Counter()
 
     def add_mail(self, to, mail, mailbox='INBOX'):
+        return self._append_mail(to, deepcopy(mail), mailbox)
+
+    def _append_mail(self, to, m, mailbox):
         if to not in self.mailboxes:
             self.mailboxes[to] = dict()
         if mailbox not in self.mailboxes[to]:
-            self.mailboxes[to][mailbox] = list()
-        m = deepcopy(mail)
-        m.id = len(self.mailboxes[to][mailbox]) + 1
-        m.uid = self.max_uid(to, mailbox) + 1
-        self.mailboxes[to][mailbox].append(m)
-        return m.uid
+            self.mailboxes[to][mailbox] = Mailbox()
+        return self.mailboxes[to][mailbox].append(m)
 
     def max_uid(self, user, mailbox):
-        if user not in self.mailboxes or mailbox not in self.mailboxes[user] \
-            or len(self.mailboxes[user][mailbox]) == 0: return 0
-        return max(self.mailboxes[user][mailbox], key=lambda msg: msg.uid).uid
+        if user not in self.mailboxes or mailbox not in self.mailboxes[user]: return 0
+        return self.mailboxes[user][mailbox].uidnext - 1
 
     def max_id(self, user, mailbox):
         if user not in self.mailboxes or mailbox not in self.mailboxes[user]: return 0
@@ -91,14 +193,29 @@ class ServerState(object):
             self.mailboxes[user_login] = dict()
         for mb in self.DEFAULT_MAILBOXES:
             self.create_mailbox_if_not_exists(user_login, mb)
-        if user_login not in self.connections:
+        if user_login not in self.connections or self.connections[user_login].transport.is_closing():
+            # a client reconnecting gets the new mails notifications
             self.connections[user_login] = protocol
         if user_login not in self.subcriptions:
             self.subcriptions[user_login] = set()
 
     def create_mailbox_if_not_exists(self, user_login, user_mailbox):
         if user_mailbox not in self.mailboxes[user_login]:
-            self.mailboxes[user_login][user_mailbox] = list()
+            self.mailboxes[user_login][user_mailbox] = Mailbox()
+
+    def populate(self, users, mailboxes, nb_messages, mail_factory):
+        """
+        Adds nb_messages mails built by mail_factory() in each mailbox of each user.
+        Mails are not copied : the factory must return a new Mail for each call.
+        """
+        for user in users:
+            if user not in self.mailboxes:
+                self.mailboxes[user] = dict()
+            for mb in self.DEFAULT_MAILBOXES + list(mailboxes):
+                self.create_mailbox_if_not_exists(user, mb)
+            for mb in mailboxes:
+                for _ in range(nb_messages):
+                    self._append_mail(user, mail_factory(), mb)
 
     def get_mailbox_messages(self, user_login, user_mailbox):
         return self.mailboxes[user_login].get(user_mailbox)
@@ -134,7 +251,7 @@ class ServerState(object):
         return sorted([mb for mb in mb.keys() if mb_re.match(mb)])
 
     def remove(self, message, user, mailbox):
-        self.remove_byid(user, mailbox, message.id)
+        self.mailboxes[user][mailbox].remove_by_uid(message.uid)
 
     def delete_mailbox(self, user, mailbox):
         if mailbox in self.mailboxes[user]:
@@ -146,29 +263,24 @@ class ServerState(object):
             self.mailboxes[user][new_mb] = mb
 
     def copy(self, user, src_mailbox, dest_mailbox, message_set):
-        to_copy = [msg for msg in self.mailboxes[user][src_mailbox] if str(msg.id) in message_set]
-        if dest_mailbox not in self.mailboxes[user]:
-            self.mailboxes[user][dest_mailbox] = list()
-        self.mailboxes[user][dest_mailbox] += to_copy
+        ids = [int(id) for id in message_set if id.isdigit()]
+        for msg in self.mailboxes[user][src_mailbox].by_ids(ids):
+            self.add_mail(user, msg, dest_mailbox)
 
     def move(self, user, src_mailbox, dest_mailbox, id_range, msg_attribute):
-        id_getter = attrgetter(msg_attribute)
-        to_move = [msg for msg in self.mailboxes[user][src_mailbox] if id_getter(msg) in id_range]
+        mailbox = self.mailboxes[user][src_mailbox]
+        to_move = mailbox.by_uids(id_range) if msg_attribute == 'uid' else mailbox.by_ids(id_range)
         id_moved = []
         for msg in to_move:
             self.remove(msg, user, src_mailbox)
-            id_moved.append(self.add_mail(user, msg, dest_mailbox))
+            id_moved.append(self._append_mail(user, msg, dest_mailbox))
         if len(id_moved) == 0:
             id_moved.append(0)
         return range(min(id_moved), max(id_moved) + 1)
 
     def remove_byid(self, user, mailbox, id):
-        msg = self.mailboxes[user][mailbox].pop(id-1)
-        self._reindex(user, mailbox)
-        return msg
-
-    def _reindex(self, user, mailbox):
-        for idx, msg in enumerate(self.mailboxes[user][mailbox]): msg.id = idx + 1
+        mb = self.mailboxes[user][mailbox]
+        return mb.remove_by_uid(mb[id - 1].uid)
 
 
 def critical_section(next_state):
@@ -188,16 +300,51 @@ def critical_section(next_state):
     return decorator
 
 
-command_re = re.compile(br'((DONE)|(?P<tag>\w+) (?P<cmd>[\w]+)([\w \.#@:\*"\(\)\{\}\[\]\+\-\\\%=]+)?$)')
+class NetworkConditions(object):
+    """
+    Network conditions simulated by each server connection :
+
+    :param rtt: round trip time in seconds, half of it delays the commands execution and half the responses
+    :param bandwidth: server to client bytes per second (0 for unlimited)
+    :param max_fragment_size: responses are split in random chunks of 1 to max_fragment_size bytes (0 to disable)
+    :param drop_after_bytes: the connection is aborted after sending this number of bytes
+    :param drop_literal_probability: probability to abort the connection in the middle of a literal
+    :param read_rate: client to server bytes per second, the server pauses reading to simulate a slow consumer
+    :param seed: random seed, each connection gets its own random generator derived from it
+    """
+    def __init__(self, rtt=0.0, bandwidth=0, max_fragment_size=0, drop_after_bytes=None,
+                 drop_literal_probability=0.0, read_rate=0, seed=None):
+        self.rtt = rtt
+        self.bandwidth = bandwidth
+        self.max_fragment_size = max_fragment_size
+        self.drop_after_bytes = drop_after_bytes
+        self.drop_literal_probability = drop_literal_probability
+        self.read_rate = read_rate
+        self.seed = seed
+        self._connections = 0
+
+    def new_random(self):
+        self._connections += 1
+        return random.Random(None if self.seed is None else '%s-%d' % (self.seed, self._connections))
+
+
+DROP_CONNECTION = None
+literal_re = re.compile(rb'\{(?P<size>\d+)\}\r\n')
+literal_plus_re = re.compile(rb'\{(?P<size>\d+)\+\}$')
+command_re = re.compile(br'((DONE)|(?P<tag>\w+) (?P<cmd>[\w]+)([\w \.#@:\*"\(\)\{\}\[\]\+\-\\\%=<>&,]+)?$)')
 FETCH_HEADERS_RE = re.compile(r'.*BODY.PEEK\[HEADER.FIELDS \((?P<headers>.+)\)\].*')
+BODY_SECTION_RE = re.compile(r'BODY(\.PEEK)?\[(?P<section>\d+(\.\d+)*)\]$')
+BODY_PARTIAL_RE = re.compile(r'BODY(\.PEEK)?\[\]<(?P<start>\d+)\.(?P<length>\d+)>$')
 
 
 class ImapProtocol(asyncio.Protocol):
     IDLE_STILL_HERE_PERIOD_SECONDS = 10
     DEFAULT_QUOTA = 5000
+    # an APPEND literal shorter than announced is answered with BAD after this inactivity delay
+    LITERAL_TIMEOUT_SECONDS = 0.5
 
     def __init__(self, server_state, fetch_chunk_size=0, capabilities=CAPABILITIES,
-                 loop=asyncio.get_event_loop()):
+                 loop=asyncio.get_event_loop(), conditions=None, starttls_context=None):
         self.uidvalidity = int(datetime.now().timestamp())
         self.capabilities = capabilities
         self.state_to_send = list()
@@ -213,25 +360,62 @@ class ImapProtocol(asyncio.Protocol):
         self.state = NONAUTH
         self.state_condition = asyncio.Condition()
         self.append_literal_command = None
+        self.sasl_authentication = None
+        self.append_literal_data = bytearray()
+        self._literal_timeout_handle = None
+        self._reading_paused = False
+        self.conditions = conditions
+        self._random = conditions.new_random() if conditions is not None else None
+        self._send_queue = deque()
+        self._send_handle = None
+        self._send_free_at = 0
+        self._bytes_written = 0
+        self.starttls_context = starttls_context
+        self.tls = False
 
     def connection_made(self, transport):
         self.transport = transport
-        transport.write('* OK IMAP4rev1 MockIMAP Server ready\r\n'.encode())
+        self.server_state.stats['connections'] += 1
+        self.send('* OK IMAP4rev1 MockIMAP Server ready\r\n'.encode())
 
     def data_received(self, data):
+        self.server_state.stats['bytes_received'] += len(data)
+        if self.conditions is not None and self.conditions.read_rate:
+            self._reading_paused = True
+            self.transport.pause_reading()
+            self.loop.call_later(len(data) / self.conditions.read_rate, self._resume_reading)
         if self.append_literal_command is not None:
             self.append_literal(data)
             return
-        for cmd_line in data.splitlines():
+        self.handle_commands(data)
+
+    def handle_commands(self, data):
+        while data:
+            cmd_line, _, data = data.partition(b'\n')
+            cmd_line = cmd_line.rstrip(b'\r')
+            if self.sasl_authentication is not None:
+                tag, method = self.sasl_authentication
+                self.sasl_authentication = None
+                if cmd_line == b'*':
+                    self.send_tagged_line(tag, 'BAD AUTHENTICATE cancelled')
+                else:
+                    self.sasl_authenticate(tag, method, cmd_line.decode())
+                continue
             if command_re.match(cmd_line) is None:
                 self.send_untagged_line('BAD Error in IMAP command : Unknown command (%r).' % cmd_line)
+                continue
+            command_array = cmd_line.decode().rstrip().split()
+            if self.state is IDLE:
+                self.exec_command(None, command_array)
+            elif command_array[1].lower() == 'append' and literal_plus_re.search(cmd_line):
+                # non synchronizing literal (LITERAL+) : the literal data follows the command line
+                self.server_state.stats['commands'] += 1
+                self.append(command_array[0], *command_array[2:])
+                if data:
+                    self.append_literal(data)
+                return
             else:
-                command_array = cmd_line.decode().rstrip().split()
-                if self.state is not IDLE:
-                    tag = command_array[0]
-                    self.exec_command(tag, command_array[1:])
-                else:
-                    self.exec_command(None, command_array)
+                self.exec_command(command_array[0], command_array[1:])
 
     def connection_lost(self, error):
         if error:
@@ -239,6 +423,11 @@ class ImapProtocol(asyncio.Protocol):
 
         if self.idle_task is not None:
             self.idle_task.cancel()
+        if self._literal_timeout_handle is not None:
+            self._literal_timeout_handle.cancel()
+        if self._send_handle is not None:
+            self._send_handle.cancel()
+        self._send_queue.clear()
         self.transport.close()
 
     def exec_command(self, tag, command_array):
@@ -249,7 +438,9 @@ class ImapProtocol(asyncio.Protocol):
             parameters = ['uid'] + command_array[2:]
         if not hasattr(self, command):
             return self.error(tag, 'Command "%s" not implemented' % command)
-        self.loop.call_later(self.delay_seconds, lambda: getattr(self, command)(tag, *parameters))
+        self.server_state.stats['commands'] += 1
+        delay = self.delay_seconds + (self.conditions.rtt / 2 if self.conditions is not None else 0)
+        self.loop.call_later(delay, lambda: getattr(self, command)(tag, *parameters))
 
     def send_untagged_line(self, response, encoding='utf-8', continuation=False, max_chunk_size=0):
         self.send_raw_untagged_line(response.encode(encoding=encoding), continuation, max_chunk_size)
@@ -269,7 +460,68 @@ class ImapProtocol(asyncio.Protocol):
 
     def send(self, _bytes):
         log.debug("Sending %r", _bytes)
-        self.transport.write(_bytes)
+        self.server_state.stats['bytes_sent'] += len(_bytes)
+        if self.conditions is None:
+            self.transport.write(_bytes)
+        else:
+            self._shape(_bytes)
+
+    def _shape(self, _bytes):
+        conditions = self.conditions
+        literal = literal_re.search(_bytes)
+        if literal and self._random.random() < conditions.drop_literal_probability:
+            literal_size = int(literal.group('size'))
+            _bytes = _bytes[:literal.end() + self._random.randint(0, max(literal_size - 1, 0))]
+        else:
+            literal = None
+
+        at = self.loop.time() + conditions.rtt / 2
+        for chunk in self._fragments(_bytes):
+            at = max(at, self._send_free_at)
+            if conditions.bandwidth:
+                self._send_free_at = at + len(chunk) / conditions.bandwidth
+            self._send_queue.append((at, chunk))
+        if literal:
+            self._send_queue.append((at, DROP_CONNECTION))
+        if self._send_handle is None:
+            self._send_handle = self.loop.call_at(self._send_queue[0][0], self._write_queue)
+
+    def _fragments(self, _bytes):
+        max_size = self.conditions.max_fragment_size
+        if not max_size:
+            return [_bytes]
+        fragments, index = list(), 0
+        while index < len(_bytes):
+            size = self._random.randint(1, max_size)
+            fragments.append(_bytes[index:index + size])
+            index += size
+        return fragments
+
+    def _write_queue(self):
+        self._send_handle = None
+        now = self.loop.time()
+        while self._send_queue and self._send_queue[0][0] <= now:
+            _, chunk = self._send_queue.popleft()
+            drop_after_bytes = self.conditions.drop_after_bytes
+            if chunk is DROP_CONNECTION or \
+                    drop_after_bytes is not None and self._bytes_written + len(chunk) >= drop_after_bytes:
+                if chunk is not DROP_CONNECTION:
+                    self.transport.write(chunk[:drop_after_bytes - self._bytes_written])
+                log.info('dropping connection of %s', self.user_login)
+                self._send_queue.clear()
+                self.transport.abort()
+                return
+            self._bytes_written += len(chunk)
+            self.transport.write(chunk)
+        if self._send_queue:
+            self._send_handle = self.loop.call_at(self._send_queue[0][0], self._write_queue)
+
+    def _resume_reading(self):
+        self._reading_paused = False
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+        if self.append_literal_command is not None:
+            self._arm_literal_timeout()
 
     @critical_section(next_state=AUTH)
     def login(self, tag, *args):
@@ -278,18 +530,27 @@ class ImapProtocol(asyncio.Protocol):
         self.send_untagged_line('CAPABILITY IMAP4rev1 %s' % self.capabilities)
         self.send_tagged_line(tag, 'OK LOGIN completed')
 
-    @critical_section(next_state=AUTH)
-    def authenticate(self, tag, method, sasl_string):
-        if method != "XOAUTH2":
-            self.error(tag, 'Only XOAUTH2 autheticate is supported.')
+    def authenticate(self, tag, method, *sasl_string):
+        if method not in ('XOAUTH2', 'PLAIN'):
+            self.error(tag, 'Only XOAUTH2 and PLAIN autheticate are supported.')
             return
-        
-        token = b64decode(sasl_string).decode('ascii')
+        if not sasl_string:
+            # without initial response (SASL-IR) the client answers an empty challenge
+            self.sasl_authentication = (tag, method)
+            self.send_raw_untagged_line(b'', continuation=True)
+            return
+        self.sasl_authenticate(tag, method, sasl_string[0])
 
-        # disassemble sasl string
-        user_part, token_part = token.split('\1',1)
+    @critical_section(next_state=AUTH)
+    def sasl_authenticate(self, tag, method, sasl_string):
+        token = b64decode(sasl_string).decode('ascii') if sasl_string != '=' else ''
 
-        _, self.user_login = user_part.split("=")
+        # disassemble sasl string
+        if method == 'PLAIN':
+            _, self.user_login, _ = token.split('\0')
+        else:
+            user_part, token_part = token.split('\1', 1)
+            _, self.user_login = user_part.split("=")
 
         self.server_state.login(self.user_login, self)
         
@@ -350,12 +611,25 @@ class ImapProtocol(asyncio.Protocol):
 
     def search(self, tag, *args_param):
         args = list(args_param)
-        by_uid = False
-        args.reverse()
+        by_uid = bool(args) and args[0] == 'uid'
+        if by_uid:
+            args.pop(0)
+        return_options = None
+        if args and args[0].upper() == 'RETURN':
+            return_options = self._pop_parenthesized(args[1:])
+            args = args[len(return_options) + 1:]
+        msg_ids = self._search(args, by_uid)
+
+        if return_options is None:
+            self.send_untagged_line('SEARCH {msg_uids}'.format(msg_uids=' '.join(msg_ids)))
+        else:
+            self.send_untagged_line(self._esearch_response(tag, ' '.join(return_options).strip('()').split(),
+                                                           msg_ids, by_uid))
+        self.send_tagged_line(tag, 'OK %sSEARCH completed' % ('UID ' if by_uid else ''))
 
-        if args[-1] == 'uid':
-            args.pop()
-            by_uid = True
+    def _search(self, args_param, by_uid=False):
+        args = list(args_param)
+        args.reverse()
 
         charset, keyword, unkeyword, older, younger, range_ = None, None, None, None, None, None
         if args and 'CHARSET' == args[-1].upper():
@@ -385,10 +659,83 @@ class ImapProtocol(asyncio.Protocol):
 
         all = 'ALL' in args
 
-        self.send_untagged_line(
-            'SEARCH {msg_uids}'.format(msg_uids=' '.join(
-                self.memory_search(all, keyword, unkeyword, older, younger, by_uid=by_uid, range_=range_))))
-        self.send_tagged_line(tag, 'OK %sSEARCH completed' % ('UID ' if by_uid else ''))
+        return self.memory_search(all, keyword, unkeyword, older, younger, by_uid=by_uid, range_=range_)
+
+    def sort(self, tag, *args_param):
+        args = list(args_param)
+        by_uid = bool(args) and args[0] == 'uid'
+        if by_uid:
+            args.pop(0)
+        return_options = None
+        if args and args[0].upper() == 'RETURN':
+            return_options = self._pop_parenthesized(args[1:])
+            args = args[len(return_options) + 1:]
+        sort_criteria = self._pop_parenthesized(args)
+        keys = ' '.join(sort_criteria).strip('()').upper().split()
+        search_args = args[len(sort_criteria) + 1:]  # skips the charset
+        if not keys or any(key not in SORT_KEYS for key in keys if key != 'REVERSE'):
+            return self.error(tag, 'Error in IMAP command: Invalid sort criteria')
+
+        messages = self._search_messages(search_args, by_uid)
+        for key, reverse in reversed([(key, i > 0 and keys[i - 1] == 'REVERSE')
+                                      for i, key in enumerate(keys) if key != 'REVERSE']):
+            messages.sort(key=SORT_KEYS[key], reverse=reverse)
+        msg_ids = [str(msg.uid if by_uid else msg.id) for msg in messages]
+
+        if return_options is None:
+            self.send_untagged_line('SORT {msg_ids}'.format(msg_ids=' '.join(msg_ids)))
+        else:
+            self.send_untagged_line(self._esearch_response(tag, ' '.join(return_options).strip('()').split(),
+                                                           msg_ids, by_uid))
+        self.send_tagged_line(tag, 'OK %sSORT completed' % ('UID ' if by_uid else ''))
+
+    def thread(self, tag, *args_param):
+        args = list(args_param)
+        by_uid = bool(args) and args[0] == 'uid'
+        if by_uid:
+            args.pop(0)
+        if args[0].upper() != 'ORDEREDSUBJECT':
+            return self.error(tag, 'Error in IMAP command: Unsupported thread algorithm %s' % args[0])
+
+        threads = dict()
+        for msg in sorted(self._search_messages(args[2:], by_uid), key=lambda msg: msg.date):
+            threads.setdefault(base_subject(msg), []).append(str(msg.uid if by_uid else msg.id))
+        # the first message of each thread is the parent of the others
+        self.send_untagged_line('THREAD {threads}'.format(threads=''.join(
+            '(%s)' % ' '.join(ids) if len(ids) <= 2 else '(%s %s)' % (ids[0], ''.join('(%s)' % i for i in ids[1:]))
+            for ids in threads.values())))
+        self.send_tagged_line(tag, 'OK %sTHREAD completed' % ('UID ' if by_uid else ''))
+
+    def _search_messages(self, args, by_uid):
+        msg_ids = set(self._search(args, by_uid))
+        return [msg for msg in self.server_state.get_mailbox_messages(self.user_login, self.user_mailbox)
+                if str(msg.uid if by_uid else msg.id) in msg_ids]
+
+    @staticmethod
+    def _pop_parenthesized(args):
+        """the tokens of the parenthesized list starting args : ['(REVERSE', 'DATE)', 'UTF-8'] -> ['(REVERSE', 'DATE)']"""
+        for i, arg in enumerate(args):
+            if arg.endswith(')'):
+                return args[:i + 1]
+        return args
+
+    @staticmethod
+    def _esearch_response(tag, return_options, msg_ids, by_uid):
+        options = [option.upper() for option in return_options] or ['ALL']
+        response = 'ESEARCH (TAG "%s")%s' % (tag, ' UID' if by_uid else '')
+        if 'MIN' in options and msg_ids:
+            response += ' MIN %s' % msg_ids[0]
+        if 'MAX' in options and msg_ids:
+            response += ' MAX %s' % msg_ids[-1]
+        if 'COUNT' in options:
+            response += ' COUNT %d' % len(msg_ids)
+        if 'ALL' in options and msg_ids:
+            response += ' ALL %s' % sequence_set(msg_ids)
+        if 'PARTIAL' in options:
+            first, last = sorted(int(i) for i in options[options.index('PARTIAL') + 1].split(':'))
+            page = msg_ids[first - 1:last] if first > 0 else msg_ids[max(len(msg_ids) + first, 0):len(msg_ids) + last + 1]
+            response += ' PARTIAL (%s %s)' % (options[options.index('PARTIAL') + 1], ','.join(page) or 'NIL')
+        return response
 
     def memory_search(self, all, keyword, unkeyword, older, younger, by_uid=False, range_=None):
         def item_match(msg):
@@ -409,11 +756,11 @@ class ImapProtocol(asyncio.Protocol):
             arg_list = list(args[1:])
         uid = int(arg_list[0])  # args = ['12', '+FLAGS', '(FOO)']
         flags = ' '.join(arg_list[2:]).strip('()').split() # only support one flag and do not handle replacement (without + sign)
-        for message in self.server_state.get_mailbox_messages(self.user_login, self.user_mailbox):
-            if message.uid == uid:
-                message.flags.extend(flags)
-                self.send_untagged_line('{uid} FETCH (UID {uid} FLAGS ({flags}))'.format(
-                    uid=uid, flags=' '.join(message.flags)))
+        message = self.server_state.get_mailbox_messages(self.user_login, self.user_mailbox).get_by_uid(uid)
+        if message is not None:
+            message.flags.extend(flags)
+            self.send_untagged_line('{uid} FETCH (UID {uid} FLAGS ({flags}))'.format(
+                uid=uid, flags=' '.join(message.flags)))
         self.send_tagged_line(tag, 'OK Store completed.')
 
     def fetch(self, tag, *args):
@@ -428,12 +775,12 @@ class ImapProtocol(asyncio.Protocol):
             return self.error(tag, 'Error in IMAP command: Invalid uidset')
         parts = arg_list[1:]
         parts_str = ' '.join(parts)
-        for message in self.server_state.get_mailbox_messages(self.user_login, self.user_mailbox):
-            if (by_uid and message.uid in fetch_range) or (not by_uid and message.id in fetch_range):
-                response = self._build_fetch_response(message, parts, by_uid=by_uid)
-                if 'BODY.PEEK' not in parts_str and ('BODY[]' in parts_str or 'RFC822' in parts_str):
-                    message.flags.append('\Seen')
-                self.send_raw_untagged_line(response)
+        mailbox = self.server_state.get_mailbox_messages(self.user_login, self.user_mailbox)
+        for message in (mailbox.by_uids(fetch_range) if by_uid else mailbox.by_ids(fetch_range)):
+            response = self._build_fetch_response(message, parts, by_uid=by_uid)
+            if 'BODY.PEEK' not in parts_str and ('BODY[]' in parts_str or 'RFC822' in parts_str):
+                message.flags.append('\Seen')
+            self.send_raw_untagged_line(response)
         self.send_tagged_line(tag, 'OK FETCH completed.')
 
     def _build_sequence_range(self, uid_pattern):
@@ -464,7 +811,9 @@ class ImapProtocol(asyncio.Protocol):
             if part == 'UID' and not by_uid:
                 response += ('UID %s' % message.uid).encode()
             if part == 'BODY[]' or part == 'BODY.PEEK[]' or part == 'RFC822':
-                response += ('%s {%s}\r\n' % (part, len(message.as_bytes()))).encode() + message.as_bytes()
+                # the response has the data item name without .PEEK (rfc3501 7.4.2)
+                response += ('%s {%s}\r\n' % (part.replace('.PEEK', ''), len(message.as_bytes()))).encode() \
+                            + message.as_bytes()
             if part == 'BODY.PEEK[HEADER.FIELDS':
                 fetch_header = FETCH_HEADERS_RE.match(' '.join(parts))
                 if fetch_header:
@@ -476,6 +825,20 @@ class ImapProtocol(asyncio.Protocol):
                                  (headers, len(message_headers.as_bytes()))).encode() + message_headers.as_bytes()
             if part == 'FLAGS':
                 response += ('FLAGS (%s)' % ' '.join(message.flags)).encode()
+            if part == 'RFC822.SIZE':
+                response += ('RFC822.SIZE %d' % len(message.as_bytes())).encode()
+            body_partial = BODY_PARTIAL_RE.match(part)
+            if body_partial:
+                start = int(body_partial.group('start'))
+                data = message.as_bytes()[start:start + int(body_partial.group('length'))]
+                response += ('BODY[]<%d> {%d}\r\n' % (start, len(data))).encode() + data
+            if part == 'BODYSTRUCTURE':
+                response += b'BODYSTRUCTURE ' + bodystructure(message.email)
+            body_section = BODY_SECTION_RE.match(part)
+            if body_section:
+                section = body_section.group('section')
+                data = mime_part(message.email, section).get_payload().encode()
+                response += ('BODY[%s] {%d}\r\n' % (section, len(data))).encode() + data
         response = response.strip(b' ')
         response += b')'
         return response
@@ -483,34 +846,55 @@ class ImapProtocol(asyncio.Protocol):
     def append(self, tag, *args):
         mailbox_name = args[0]
         size = args[-1].strip('{}')
-        self.append_literal_command = (tag, mailbox_name, int(size))
-        self.send_untagged_line('Ready for literal data', continuation=True)
+        literal_plus = size.endswith('+')
+        self.append_literal_command = (tag, mailbox_name, int(size.rstrip('+')))
+        self.append_literal_data = bytearray()
+        if not literal_plus:
+            self.send_untagged_line('Ready for literal data', continuation=True)
 
     def append_literal(self, data):
         tag, mailbox_name, size = self.append_literal_command
-        if data == CRLF:
-            if 'UIDPLUS' in self.capabilities:
-                self.send_tagged_line(tag, 'OK [APPENDUID %s %s] APPEND completed.' %
-                                      (self.uidvalidity, self.server_state.max_uid(self.user_login, mailbox_name)))
-            else:
-                self.send_tagged_line(tag, 'OK APPEND completed.')
-            self.append_literal_command = None
+        self.append_literal_data.extend(data)
+        if len(self.append_literal_data) < size + len(CRLF):
+            self._arm_literal_timeout()
             return
+        self._end_append_literal()
 
-        literal_data, rest = data[:size], data[size:]
-        if len(literal_data) < size:
-            self.send_tagged_line(self.append_literal_command[0],
-                                  'BAD literal length : expected %s but was %s' % (size, len(literal_data)))
-            self.append_literal_command = None
-        elif rest and rest != CRLF:
-            self.send_tagged_line(self.append_literal_command[0],
-                                  'BAD literal trailing data : expected CRLF but got %s' % (rest))
-        else:
-            m = email.message_from_bytes(data)
-            self.server_state.add_mail(self.user_login, Mail(m), mailbox_name)
+        literal_data, rest = bytes(self.append_literal_data[:size]), bytes(self.append_literal_data[size:])
+        self.append_literal_data = bytearray()
+        if not rest.startswith(CRLF):
+            self.send_tagged_line(tag, 'BAD literal trailing data : expected CRLF but got %s' % rest)
+            return
 
-            if rest:
-                self.append_literal(rest)
+        m = email.message_from_bytes(literal_data)
+        self.server_state.add_mail(self.user_login, Mail(m), mailbox_name)
+        if 'UIDPLUS' in self.capabilities:
+            self.send_tagged_line(tag, 'OK [APPENDUID %s %s] APPEND completed.' %
+                                  (self.uidvalidity, self.server_state.max_uid(self.user_login, mailbox_name)))
+        else:
+            self.send_tagged_line(tag, 'OK APPEND completed.')
+        if rest[len(CRLF):]:
+            self.handle_commands(rest[len(CRLF):])
+
+    def _arm_literal_timeout(self):
+        if self._literal_timeout_handle is not None:
+            self._literal_timeout_handle.cancel()
+        if not self._reading_paused:
+            self._literal_timeout_handle = self.loop.call_later(self.LITERAL_TIMEOUT_SECONDS,
+                                                                self._append_literal_timeout)
+
+    def _append_literal_timeout(self):
+        tag, _, size = self.append_literal_command
+        self.send_tagged_line(tag, 'BAD literal length : expected %s but was %s' %
+                              (size, len(self.append_literal_data)))
+        self._end_append_literal()
+        self.append_literal_data = bytearray()
+
+    def _end_append_literal(self):
+        if self._literal_timeout_handle is not None:
+            self._literal_timeout_handle.cancel()
+            self._literal_timeout_handle = None
+        self.append_literal_command = None
 
     def expunge(self, tag, *args):
         expunge_range = range(0, sys.maxsize)
@@ -522,16 +906,34 @@ class ImapProtocol(asyncio.Protocol):
                     expunge_range = self._build_sequence_range(args[1])
                 except InvalidUidSet:
                     return self.error(tag, 'Error in IMAP command: Invalid uidset')
-        for message in self.server_state.get_mailbox_messages(self.user_login, self.user_mailbox).copy():
-            if message.uid in expunge_range:
-                self.server_state.remove(message, self.user_login, self.user_mailbox)
-                self.send_untagged_line('{msg_uid} EXPUNGE'.format(msg_uid=message.uid))
+        mailbox = self.server_state.get_mailbox_messages(self.user_login, self.user_mailbox)
+        for message in mailbox.by_uids(expunge_range):
+            self.server_state.remove(message, self.user_login, self.user_mailbox)
+            self.send_untagged_line('{msg_uid} EXPUNGE'.format(msg_uid=message.uid))
         self.send_tagged_line(tag, 'OK %sEXPUNGE completed.' % uid_response)
 
     def capability(self, tag, *args):
-        self.send_untagged_line('CAPABILITY IMAP4rev1 YESAUTH')
+        capabilities = 'IMAP4rev1 YESAUTH'
+        if 'SASL-IR' in self.capabilities.split():
+            capabilities += ' SASL-IR'
+        if self.starttls_context is not None and not self.tls:
+            capabilities += ' STARTTLS'
+        self.send_untagged_line('CAPABILITY %s' % capabilities)
         self.send_tagged_line(tag, 'OK Pre-login capabilities listed, post-login capabilities have more')
 
+    def starttls(self, tag, *args):
+        if self.starttls_context is None or self.tls:
+            return self.send_tagged_line(tag, 'BAD STARTTLS not available')
+        # nothing must be read in clear text until the TLS handshake
+        self.transport.pause_reading()
+        # the OK is written directly, before the transport is replaced by the TLS one
+        self.transport.write(('%s OK Begin TLS negotiation now\r\n' % tag).encode())
+        self.tls = True
+        asyncio.ensure_future(self._start_tls())
+
+    async def _start_tls(self):
+        self.transport = await self.loop.start_tls(self.transport, self, self.starttls_context, server_side=True)
+
     def namespace(self, tag):
         self.send_untagged_line('NAMESPACE (("" "/")) NIL NIL')
         self.send_tagged_line(tag, 'OK NAMESPACE command completed')
@@ -576,26 +978,29 @@ class ImapProtocol(asyncio.Protocol):
         self.send_tagged_line(tag, 'OK CHECK completed.')
 
     def status(self, tag, *args):
-        mailbox_name = args[0]
+        mailbox_name = args[0].strip('"')
         data_items = ' '.join(args[1:])
         mailbox = self.server_state.get_mailbox_messages(self.user_login, mailbox_name)
         if mailbox is None:
             self.send_tagged_line(tag, 'NO STATUS completed.')
             return
+        self.send_untagged_line(self._status_response(mailbox_name, mailbox, data_items))
+        self.send_tagged_line(tag, 'OK STATUS completed.')
+
+    def _status_response(self, mailbox_name, mailbox, data_items):
         status_response = 'STATUS %s (' % mailbox_name
         if 'MESSAGES' in data_items:
             status_response += 'MESSAGES %s' % len(mailbox)
         if 'RECENT' in data_items:
             status_response += ' RECENT %s' % len([m for m in mailbox if 'RECENT' in m.flags])
         if 'UIDNEXT' in data_items:
-            status_response += ' UIDNEXT %s' % (self.server_state.max_uid(self.user_login, self.user_mailbox) + 1)
+            status_response += ' UIDNEXT %s' % (self.server_state.max_uid(self.user_login, mailbox_name) + 1)
         if 'UIDVALIDITY' in data_items:
             status_response += ' UIDVALIDITY %s' % self.uidvalidity
         if 'UNSEEN' in data_items:
             status_response += ' UNSEEN %s' % len([m for m in mailbox if 'UNSEEN' in m.flags])
         status_response += ')'
-        self.send_untagged_line(status_response)
-        self.send_tagged_line(tag, 'OK STATUS completed.')
+        return status_response
 
     def subscribe(self, tag, *args):
         mailbox_name = args[0]
@@ -637,9 +1042,15 @@ class ImapProtocol(asyncio.Protocol):
     def list(self, tag, *args):
         reference = args[0]
         mailbox_pattern = args[1].replace('*', '.*').replace('%', '.*')
+        # LIST-STATUS : RETURN (STATUS (MESSAGES UNSEEN))
+        return_options = ' '.join(args[2:])
+        list_status = 'LIST-STATUS' in self.capabilities.split() and 'STATUS' in return_options
 
         for mb in self.server_state.list(self.user_login, reference, mailbox_pattern):
             self.send_untagged_line('LIST () "/" %s' % mb)
+            if list_status:
+                self.send_untagged_line(self._status_response(
+                    mb, self.server_state.get_mailbox_messages(self.user_login, mb), return_options))
         self.send_tagged_line(tag, 'OK LIST completed.')
 
     def error(self, tag, msg):
@@ -670,10 +1081,14 @@ class ImapProtocol(asyncio.Protocol):
 
 
 class MockImapServer(object):
-    def __init__(self, capabilities=CAPABILITIES, loop=None) -> None:
+    def __init__(self, capabilities=CAPABILITIES, loop=None, conditions=None) -> None:
+        """
+        :type conditions: NetworkConditions
+        """
         self._server_state = ServerState()
         self._connections = list()
         self.capabilities = capabilities
+        self.conditions = conditions
         if loop is None:
             self.loop = asyncio.get_event_loop()
         else:
@@ -707,9 +1122,38 @@ class MockImapServer(object):
     def get_connection(self, user):
         return self._server_state.get_connection(user)
 
-    def run_server(self, host='127.0.0.1', port=1143, fetch_chunk_size=0, ssl_context=None):
+    @property
+    def stats(self):
+        return self._server_state.stats
+
+    def populate(self, nb_users, nb_mailboxes, nb_messages, sizes=((4096, 1),), seed=None):
+        """
+        Load generator mode : creates nb_users users (user0@mail, user1@mail...) having each
+        INBOX and nb_mailboxes - 1 folders (Folder1, Folder2...) of nb_messages synthetic mails.
+
+        :param sizes: size distribution of the mails bodies as (size in bytes, weight) tuples
+        :param seed: random seed to have reproducible mailboxes
+        :return: the list of the created users logins
+        """
+        rand = random.Random(seed)
+        body_sizes, weights = zip(*sizes)
+        users = ['user%d@mail' % i for i in range(nb_users)]
+        mailboxes = ['INBOX'] + ['Folder%d' % i for i in range(1, nb_mailboxes)]
+        # one template per size : building a MIME message for each mail would dominate the setup time
+        templates = {size: Mail.create(['user@mail'], mail_from='load@mockimap', subject='load %d' % size,
+                                       content=synthetic_text(size), encoding='us-ascii').email
+                     for size in body_sizes}
+
+        def mail_factory():
+            return Mail(templates[rand.choices(body_sizes, weights)[0]])
+
+        self._server_state.populate(users, mailboxes, nb_messages, mail_factory)
+        return users
+
+    def run_server(self, host='127.0.0.1', port=1143, fetch_chunk_size=0, ssl_context=None, starttls_context=None):
         def create_protocol():
-            protocol = ImapProtocol(self._server_state, fetch_chunk_size, self.capabilities, self.loop)
+            protocol = ImapProtocol(self._server_state, fetch_chunk_size, self.capabilities, self.loop,
+                                    conditions=self.conditions, starttls_context=starttls_context)
             self._connections.append(protocol)
             return protocol
 
@@ -720,6 +1164,50 @@ class MockImapServer(object):
         self._server_state.reset()
 
 
+def quoted_or_nil(value):
+    return b'NIL' if value is None else ('"%s"' % value).encode()
+
+
+def mime_params(params):
+    if not params:
+        return b'NIL'
+    return b'(' + b' '.join(quoted_or_nil(k.upper()) + b' ' + quoted_or_nil(v) for k, v in params) + b')'
+
+
+def bodystructure(message):
+    """BODYSTRUCTURE (rfc3501 7.4.2) of an email.message.Message (without envelope for message/rfc822)"""
+    params = [(k, v) for k, v in message.get_params([])[1:]]
+    disposition = message.get_content_disposition()
+    disposition = b'NIL' if disposition is None else b'(%s %s)' % (
+        quoted_or_nil(disposition.upper()), mime_params([('filename', message.get_filename())]
+                                                        if message.get_filename() else None))
+    if message.is_multipart():
+        return b'(%s %s %s %s NIL)' % (b''.join(bodystructure(part) for part in message.get_payload()),
+                                      quoted_or_nil(message.get_content_subtype().upper()),
+                                      mime_params(params), disposition)
+    payload = message.get_payload()
+    response = b'(%s %s %s NIL NIL %s %d' % (
+        quoted_or_nil(message.get_content_maintype().upper()), quoted_or_nil(message.get_content_subtype().upper()),
+        mime_params(params), quoted_or_nil(message.get('Content-Transfer-Encoding', '7BIT').upper()),
+        len(payload.encode()))
+    if message.get_content_maintype() == 'text':
+        response += b' %d' % payload.count('\n')
+    return response + b' NIL %s NIL NIL)' % disposition
+
+
+def mime_part(message, section):
+    for index in section.split('.'):
+        if message.is_multipart():
+            message = message.get_payload()[int(index) - 1]
+    return message
+
+
+def synthetic_text(size, line_length=76):
+    words = b'lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+    line = (words * (line_length // len(words) + 1))[:line_length - 2].decode() + '\r\n'
+    return (line * (size // line_length + 1))[:size]
+
+
 class Mail(object):
     def __init__(self, email, date=datetime.now()):
         self.date = date
@@ -791,7 +1279,58 @@ class Mail(object):
         return Mail(msg, date=date)
 
 
-if __name__ == '__main__':
+def parse_sizes(sizes):
+    """'2048:70,65536:25,1048576:5' -> [(2048, 70), (65536, 25), (1048576, 5)]"""
+    return [tuple(int(i) for i in (size_weight + ':1').split(':')[:2]) for size_weight in sizes.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Mock IMAP server (use --users to run it as a load test target)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1143)
+    parser.add_argument('--users', type=int, default=0, help='number of users to pre-populate')
+    parser.add_argument('--mailboxes', type=int, default=1, help='number of mailboxes per user (INBOX included)')
+    parser.add_argument('--messages', type=int, default=100, help='number of messages per mailbox')
+    parser.add_argument('--sizes', default='4096', type=parse_sizes,
+                        help='size distribution of messages as size:weight list, ex: 2048:70,65536:25,1048576:5')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--rtt', type=float, default=0.0, help='simulated round trip time in seconds')
+    parser.add_argument('--bandwidth', type=int, default=0, help='server to client bytes per second')
+    parser.add_argument('--max-fragment-size', type=int, default=0, help='split responses in random chunks')
+    parser.add_argument('--drop-after-bytes', type=int, default=None, help='abort connections after N bytes sent')
+    parser.add_argument('--drop-literal-probability', type=float, default=0.0,
+                        help='probability to abort a connection in the middle of a literal')
+    parser.add_argument('--read-rate', type=int, default=0, help='client to server bytes per second (slow consumer)')
+    parser.add_argument('--report-interval', type=float, default=5.0, help='seconds between throughput reports (0 to disable)')
+    args = parser.parse_args()
+
     loop = asyncio.get_event_loop()
-    server = MockImapServer().run_server()
+    conditions = None
+    if args.rtt or args.bandwidth or args.max_fragment_size or args.drop_after_bytes is not None \
+            or args.drop_literal_probability or args.read_rate:
+        conditions = NetworkConditions(args.rtt, args.bandwidth, args.max_fragment_size, args.drop_after_bytes,
+                                       args.drop_literal_probability, args.read_rate, args.seed)
+    server = MockImapServer(loop=loop, conditions=conditions)
+    if args.users:
+        users = server.populate(args.users, args.mailboxes, args.messages, args.sizes, args.seed)
+        log.info('populated %d users (%s...%s) with %d mailboxes of %d messages',
+                 len(users), users[0], users[-1], args.mailboxes, args.messages)
+    server.run_server(host=args.host, port=args.port)
+    log.info('listening on %s:%d', args.host, args.port)
+
+    def report(previous):
+        stats = Counter(server.stats)
+        delta = stats - previous
+        log.info('%d connections, %.0f commands/s, %.2f MB/s sent, %.2f MB/s received',
+                 stats['connections'], delta['commands'] / args.report_interval,
+                 delta['bytes_sent'] / args.report_interval / 1024 / 1024,
+                 delta['bytes_received'] / args.report_interval / 1024 / 1024)
+        loop.call_later(args.report_interval, report, stats)
+
+    if args.report_interval:
+        loop.call_later(args.report_interval, report, Counter())
     loop.run_forever()
+
+
+if __name__ == '__main__':
+    main()
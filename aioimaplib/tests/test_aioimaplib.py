@@ -15,11 +15,18 @@
 #    You should have received a copy of the GNU General Public License
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import asyncio
+import io
 import logging
 import os
 import ssl
+import tempfile
+import threading
 import unittest
+from array import array
 from datetime import datetime, timedelta
+from email.mime.application import MIMEApplication
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
 
 import asynctest
 from mock import call, MagicMock
@@ -27,7 +34,8 @@ from pytz import utc
 
 from aioimaplib import aioimaplib, CommandTimeout, extract_exists, \
     TWENTY_NINE_MINUTES, STOP_WAIT_SERVER_PUSH, FetchCommand, IdleCommand
-from aioimaplib.aioimaplib import Commands, IMAP4ClientProtocol, Command, Response, Abort, AioImapException
+from aioimaplib.aioimaplib import Commands, IMAP4ClientProtocol, Command, Response, Abort, AioImapException, \
+    AppendCommand, ConnectionLost
 from aioimaplib.tests import imapserver
 from aioimaplib.tests.imapserver import Mail, MockImapServer, ImapProtocol
 from aioimaplib.tests.ssl_cert import create_temp_self_signed_cert
@@ -47,6 +55,160 @@ class TestAioimaplibUtils(unittest.TestCase):
         self.imap_protocol._handle_line = MagicMock(return_value=None)
         aioimaplib.get_running_loop = asyncio.new_event_loop # monkey patch to avoid Exception "No running loop"
 
+    def test_default_ssl_context_is_shared(self):
+        ssl_context = aioimaplib.IMAP4_SSL().ssl_context
+
+        assert isinstance(ssl_context, aioimaplib.SessionCachingSSLContext)
+        assert ssl_context is aioimaplib.IMAP4_SSL().ssl_context
+        assert ssl_context is aioimaplib.default_ssl_context()
+        assert ssl.CERT_REQUIRED == ssl_context.verify_mode
+        assert ssl_context.check_hostname
+        assert ssl.create_default_context().verify_flags == ssl_context.verify_flags
+        assert ssl.create_default_context().options == ssl_context.options
+
+    def test_tls_sessions_are_kept_by_server_with_a_limit(self):
+        ssl_context = aioimaplib.SessionCachingSSLContext(max_sessions=2)
+
+        for port in (993, 994, 995):
+            ssl_context.save_session('imap.mail', MagicMock(session=port), port)
+        ssl_context.save_session('imap.mail', MagicMock(session=None), 996)
+
+        assert {('imap.mail', 994): 994, ('imap.mail', 995): 995} == ssl_context.tls_sessions
+
+    def test_uid_set(self):
+        assert '1:3,5,7:8' == aioimaplib.uid_set([8, 1, 2, 3, 5, 7, 2])
+        assert '' == aioimaplib.uid_set([])
+
+    def test_fetch_cache_is_persisted_and_invalidated_with_uidvalidity(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.db')
+            cache = aioimaplib.FetchCache(path, max_messages=1)
+            cache.validate('INBOX', 10)
+            cache.put('INBOX', 1, {'BODY[HEADER]': b'Subject: a\r\n', 'BODYSTRUCTURE': ['text', 'plain', None]})
+            cache.put('INBOX', 2, {'ENVELOPE': ['date', 'subject', None]})
+            cache.close()
+
+            cache = aioimaplib.FetchCache(path)
+            cache.validate('INBOX', 10)
+            assert {'BODY[HEADER]': b'Subject: a\r\n', 'BODYSTRUCTURE': ['text', 'plain', None]} == cache.get('INBOX', 1)
+            assert {'ENVELOPE': ['date', 'subject', None]} == cache.get('INBOX', 2)
+
+            cache.validate('INBOX', 11)
+            assert {} == cache.get('INBOX', 1)
+            cache.close()
+
+    def test_body_cache_evicts_the_least_recently_used_files(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = aioimaplib.BodyCache(directory, max_size=10)
+            cache.put('user@host/INBOX', 1, 1, 'BODY[]', b'1234')
+            cache.put('user@host/INBOX', 1, 2, 'BODY[]', b'5678')
+            assert b'1234' == cache.get('user@host/INBOX', 1, 1, 'BODY[]')
+            cache.put('user@host/INBOX', 1, 3, 'BODY[1]', b'9012')
+
+            assert None is cache.get('user@host/INBOX', 1, 2, 'BODY[]')
+            assert None is cache.get('user@host/INBOX', 2, 1, 'BODY[]')
+            assert 8 == cache.size
+            assert 2 == len(os.listdir(directory))
+
+            cache = aioimaplib.BodyCache(directory, max_size=10)
+            assert b'1234' == cache.get('user@host/INBOX', 1, 1, 'BODY[]')
+            assert b'9012' == cache.get('user@host/INBOX', 1, 3, 'BODY[1]')
+
+    def test_parse_list_status(self):
+        lines = [b'LIST (\\HasNoChildren) "." INBOX', b'STATUS INBOX (MESSAGES 17 UNSEEN 16)',
+                 b'LIST (\\Noselect) "." {9}', bytearray(b'Old Stuff'), b'',
+                 b'LIST () "." "Sent Items"', b'STATUS "Sent Items" (MESSAGES 3 UNSEEN 0)']
+
+        mailboxes = aioimaplib.parse_list_status(lines)
+
+        assert ['INBOX', 'Old Stuff', 'Sent Items'] == list(mailboxes)
+        assert ('INBOX', ['\\HasNoChildren'], '.', {'MESSAGES': 17, 'UNSEEN': 16}) == mailboxes['INBOX']
+        assert (['\\Noselect'], {}) == (mailboxes['Old Stuff'].flags, mailboxes['Old Stuff'].status)
+        assert {'MESSAGES': 3, 'UNSEEN': 0} == mailboxes['Sent Items'].status
+
+    def test_parse_list(self):
+        response = Response('OK', [b'(\\HasNoChildren) "/" INBOX', b'(\\Noselect \\HasChildren) NIL {4}',
+                                   bytearray(b'Root'), b'', b'() "/" "Sent Items"', b'LIST completed.'])
+
+        assert [('INBOX', ['\\HasNoChildren'], '/', {}), ('Root', ['\\Noselect', '\\HasChildren'], None, {}),
+                ('Sent Items', [], '/', {})] == aioimaplib.parse_list(response)
+
+    def test_parse_status(self):
+        response = Response('OK', [b'"Sent Items" (MESSAGES 12 UIDNEXT 44 UNSEEN 2)', b'STATUS completed.'])
+
+        assert {'MESSAGES': 12, 'UIDNEXT': 44, 'UNSEEN': 2} == aioimaplib.parse_status(response)
+        assert {} == aioimaplib.parse_status(Response('NO', [b'STATUS failed.']))
+
+    def test_parse_namespace(self):
+        response = Response('OK', [b'(("" "/")("#mh/" "/" "X-PARAM" ("FLAG1"))) (("~" "/")) NIL',
+                                   b'NAMESPACE command completed'])
+
+        assert aioimaplib.Namespaces([('', '/'), ('#mh/', '/')], [('~', '/')], []) == \
+               aioimaplib.parse_namespace(response)
+
+    def test_parse_quota(self):
+        response = Response('OK', [b'"" (STORAGE 10 512 MESSAGE 3 1000)', b'GETQUOTAROOT completed.'])
+
+        assert {'': {'STORAGE': (10, 512), 'MESSAGE': (3, 1000)}} == aioimaplib.parse_quota(response)
+
+    def test_parse_esearch(self):
+        response = Response('OK', [b'(TAG "A1") UID COUNT 3 PARTIAL (1:2 4,2)', b'SORT completed.'])
+
+        assert aioimaplib.ESearchResult('A1', True, None, None, 3, [], aioimaplib.Partial(1, 2, [4, 2])) == \
+               aioimaplib.parse_esearch(response)
+        assert [9, 8, 7, 1, 2] == aioimaplib.parse_esearch(Response('OK', [b'(TAG "A2") ALL 9:7,1:2', b'done'])).all
+        assert aioimaplib.Partial(-1, -10, []) == \
+               aioimaplib.parse_esearch(Response('OK', [b'(TAG "A3") PARTIAL (-1:-10 NIL)', b'done'])).partial
+
+    def test_iter_sequence_set(self):
+        assert [1, 2, 3, 7, 9, 8] == list(aioimaplib.iter_sequence_set('1:3,7,9:8'))
+        assert [8, 9, 7, 3, 2, 1] == list(aioimaplib.iter_sequence_set('1:3,7,9:8', reverse=True))
+        assert [] == list(aioimaplib.iter_sequence_set(''))
+
+    def test_esearch_items(self):
+        response = Response('OK', [b'(TAG "A1") UID COUNT 1000000 ALL 1:1000000', b'SEARCH completed.'])
+
+        assert {'TAG': 'A1', 'UID': True, 'COUNT': '1000000', 'ALL': '1:1000000'} == aioimaplib.esearch_items(response)
+        assert {} == aioimaplib.esearch_items(Response('OK', [b'SEARCH completed.']))
+
+    def test_partial_slice(self):
+        ids = list(range(1, 11))
+
+        assert [1, 2, 3] == aioimaplib.partial_slice(ids, 1, 3)
+        assert [9, 10] == aioimaplib.partial_slice(ids, 9, 20)
+        assert [8, 9, 10] == aioimaplib.partial_slice(ids, -1, -3)
+        assert [] == aioimaplib.partial_slice(ids, 11, 20)
+
+    def test_parse_thread(self):
+        response = Response('OK', [b'(2)(3 6 (4 23)(44 7 96))((5)(8))', b'THREAD completed.'])
+        node = aioimaplib.ThreadNode
+
+        assert [node(2, []),
+                node(3, [node(6, [node(4, [node(23, [])]), node(44, [node(7, [node(96, [])])])])]),
+                node(None, [node(5, []), node(8, [])])] == aioimaplib.parse_thread(response)
+        assert [] == aioimaplib.parse_thread(Response('OK', [b'', b'THREAD completed.']))
+
+    def test_status_resp_name(self):
+        assert 'STATUS INBOX' == aioimaplib.status_resp_name(b'inbox (MESSAGES 1)')
+        assert 'STATUS Sent Items' == aioimaplib.status_resp_name(b'"Sent Items" (MESSAGES 1)')
+        assert 'STATUS' == aioimaplib.status_resp_name(b'{10}')
+
+    def test_encode_decode_mailbox(self):
+        for decoded, encoded in (('INBOX', 'INBOX'), ('Entwürfe', 'Entw&APw-rfe'), ('R&D', 'R&-D'),
+                                 ('~peter/mail/台北/日本語', '~peter/mail/&U,BTFw-/&ZeVnLIqe-'),
+                                 ('Éléments envoyés', '&AMk-l&AOk-ments envoy&AOk-s')):
+            assert encoded == aioimaplib.encode_mailbox(decoded)
+            assert decoded == aioimaplib.decode_mailbox(encoded)
+        assert 'Entw&APw-rfe' == aioimaplib.mailbox_to_imap('Entwürfe')
+        assert 'R&-D' == aioimaplib.mailbox_to_imap('R&D')
+        assert 'R&-D' == aioimaplib.mailbox_to_imap('R&-D', encoded=True)
+
+    def test_mailbox_argument(self):
+        assert 'INBOX' == aioimaplib.mailbox_argument('INBOX')
+        assert '"Sent Items"' == aioimaplib.mailbox_argument('Sent Items')
+        assert '""' == aioimaplib.mailbox_argument('')
+        assert '"Sent Items"' == aioimaplib.mailbox_argument('"Sent Items"')
+
     def test_split_responses_no_data(self):
         self.imap_protocol.data_received(b'')
         self.imap_protocol._handle_line.assert_not_called()
@@ -88,6 +250,11 @@ class TestAioimaplibUtils(unittest.TestCase):
                                             call(b'* 1 FETCH (UID 15 FLAGS (BAR))', None),
                                             call(b'TAG OK STORE completed.', None)])
 
+    def test_split_responses_with_more_lines_than_recursion_limit(self):
+        self.imap_protocol.data_received(b'* 1 EXISTS\r\n' * 5000 + b'TAG OK NOOP completed.\r\n')
+
+        assert 5001 == self.imap_protocol._handle_line.call_count
+
     def test_split_responses_with_message_data_expunge(self):
         self.imap_protocol.data_received(b'* 123 EXPUNGE\r\nTAG OK SELECT completed.\r\n')
         self.imap_protocol._handle_line.assert_has_calls([call(b'* 123 EXPUNGE', None),
@@ -196,6 +363,95 @@ class TestAioimaplibUtils(unittest.TestCase):
         assert 'tag UID NAME' == str(Command('NAME', 'tag', prefix='UID'))
 
 
+class TestResponseLines(unittest.TestCase):
+    def test_lines_keep_their_type(self):
+        lines = aioimaplib.ResponseLines([b'1 FETCH (BODY[] {4}', bytearray(b'data'), ')', b''])
+
+        assert 4 == len(lines)
+        assert [bytes, bytearray, str, bytes] == [type(line) for line in lines]
+        assert [b'1 FETCH (BODY[] {4}', b'data', ')', b''] == lines
+
+    def test_indexes_and_slices(self):
+        lines = aioimaplib.ResponseLines([b'one', b'two', b'three'])
+
+        assert b'one' == lines[0]
+        assert b'three' == lines[-1]
+        assert [b'two', b'three'] == lines[1:]
+        with pytest.raises(IndexError):
+            lines[3]
+
+    def test_literals_are_not_copied_and_lines_are_built_once(self):
+        literal = bytearray(b'data' * 1000)
+        lines = aioimaplib.ResponseLines([b'1 FETCH (BODY[] {4000}', literal, b')'])
+
+        assert literal is lines[1]
+        response_lines = lines.tolist()
+        assert literal is response_lines[1]
+        assert response_lines is lines.tolist()
+        lines.append(b'TAG OK FETCH completed')
+        assert response_lines is lines.tolist()
+        assert [b'1 FETCH (BODY[] {4000}', literal, b')', b'TAG OK FETCH completed'] == response_lines
+        assert 4 == len(lines)
+
+    def test_command_response_lines_are_a_list(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        cmd = Command('NOOP', 'TAG', loop=loop)
+        cmd.append_to_resp(b'line')
+        cmd.close(b'NOOP completed', 'OK')
+
+        assert [b'line', b'NOOP completed'] == cmd.response.lines
+        assert cmd.response.lines is cmd.response.lines
+        assert cmd._resp_lines._buffer is None
+        cmd.response.lines.sort()
+        assert [b'NOOP completed', b'line'] == cmd.response.lines
+
+    def test_response_equality(self):
+        assert Response('OK', [b'line']) == Response('OK', aioimaplib.ResponseLines([b'line']))
+        assert Response('OK', [b'line']) != Response('OK', aioimaplib.ResponseLines([b'other']))
+
+
+class TestBodyStructure(unittest.TestCase):
+    def test_parse_imap_list(self):
+        lines = [b'1 FETCH (BODY[HEADER.FIELDS (SUBJECT)] {3}', bytearray(b'abc'), b' FLAGS (\\Seen) X "q\\"z" Y NIL)']
+
+        assert ['BODY[HEADER.FIELDS (SUBJECT)]', b'abc', 'FLAGS', ['\\Seen'], 'X', 'q"z', 'Y', None] == \
+            aioimaplib.parse_imap_list(lines)
+
+    def test_fetch_items(self):
+        lines = [b'1 FETCH (UID 7 BODY[1] {3}', bytearray(b'abc'), b')', b'2 FETCH (UID 8 BODY[1] "de")',
+                 b'FETCH completed.']
+
+        assert [(1, {'UID': '7', 'BODY[1]': b'abc'}), (2, {'UID': '8', 'BODY[1]': 'de'})] == \
+            list(aioimaplib.fetch_items(lines))
+
+    def test_parse_nested_multipart_bodystructure(self):
+        lines = [b'1 FETCH (UID 7 BODYSTRUCTURE ((("TEXT" "PLAIN" ("CHARSET" "utf-8") NIL NIL "7BIT" 12 1 NIL NIL NIL)'
+                 b'("TEXT" "HTML" ("CHARSET" "utf-8") NIL NIL "QUOTED-PRINTABLE" 40 2 NIL NIL NIL) "ALTERNATIVE" '
+                 b'("BOUNDARY" "b2") NIL NIL)("APPLICATION" "PDF" ("NAME" {9}', bytearray(b'a "b".pdf'),
+                 b') NIL NIL "BASE64" 1000 NIL ("ATTACHMENT" ("FILENAME" "a.pdf")) NIL)("MESSAGE" "RFC822" NIL NIL NIL '
+                 b'"7BIT" 300 (NIL "subj" NIL NIL NIL NIL NIL NIL NIL NIL) ("TEXT" "PLAIN" NIL NIL NIL "7BIT" 20 2 '
+                 b'NIL NIL NIL) 10 NIL NIL) "MIXED" ("BOUNDARY" "b1") NIL NIL))']
+        (_, items), = aioimaplib.fetch_items(lines)
+
+        parts = list(aioimaplib.parse_bodystructure(items['BODYSTRUCTURE']).walk())
+
+        assert [('', 'multipart/mixed'), ('1', 'multipart/alternative'), ('1.1', 'text/plain'),
+                ('1.2', 'text/html'), ('2', 'application/pdf'), ('3', 'message/rfc822'), ('3.1', 'text/plain')] == \
+            [(part.section, part.content_type) for part in parts]
+        assert ('a.pdf', 'attachment', 'base64', 1000) == \
+            (parts[4].filename, parts[4].disposition, parts[4].encoding, parts[4].size)
+        assert {'name': 'a "b".pdf'} == parts[4].params
+
+    def test_parse_single_part_bodystructure(self):
+        structure = aioimaplib.parse_imap_list([b'("TEXT" "PLAIN" ("CHARSET" "us-ascii") NIL NIL "QUOTED-PRINTABLE" 3 1 NIL NIL NIL)'])
+
+        part = aioimaplib.parse_bodystructure(structure)
+
+        assert ('1', 'text/plain', 1) == (part.section, part.content_type, part.lines)
+        assert b'caf\xe9' == part.decode(b'caf=E9')
+
+
 class TestDataReceived(unittest.TestCase):
     def setUp(self):
         self.imap_protocol = IMAP4ClientProtocol(None)
@@ -249,14 +505,19 @@ class TestFetchWaitsForAllMessageAttributes(unittest.TestCase):
 
 
 class TestAioimaplibCommand(asynctest.ClockedTestCase):
+    def command(self, timeout):
+        cmd = Command('CMD', 'tag', loop=self.loop, timeout=timeout)
+        cmd.use_scheduler(aioimaplib.TimeoutScheduler(self.loop))
+        return cmd
+
     async def test_command_timeout(self):
-        cmd = Command('CMD', 'tag', loop=self.loop, timeout=1)
+        cmd = self.command(timeout=1)
         await self.advance(2)
         with pytest.raises(AioImapException):
             await cmd.wait()
 
     async def test_command_close_cancels_timer(self):
-        cmd = Command('CMD', 'tag', loop=self.loop, timeout=1)
+        cmd = self.command(timeout=1)
         cmd.close('line', 'OK')
         await self.advance(3)
 
@@ -264,7 +525,7 @@ class TestAioimaplibCommand(asynctest.ClockedTestCase):
         assert Response('OK', ['line']) == cmd.response
 
     async def test_command_begin_literal_data_resets_timer(self):
-        cmd = Command('CMD', 'tag', loop=self.loop, timeout=2)
+        cmd = self.command(timeout=2)
 
         await self.advance(1)
         cmd.begin_literal_data(7, b'literal')
@@ -276,7 +537,7 @@ class TestAioimaplibCommand(asynctest.ClockedTestCase):
         assert Response('OK', [b'literal', 'line']) == cmd.response
 
     async def test_command_append_data_resets_timer(self):
-        cmd = Command('CMD', 'tag', loop=self.loop, timeout=2)
+        cmd = self.command(timeout=2)
         cmd.begin_literal_data(4, b'da')
 
         await self.advance(1.9)
@@ -289,7 +550,7 @@ class TestAioimaplibCommand(asynctest.ClockedTestCase):
         assert Response('OK', [b'data', 'line']) == cmd.response
 
     async def test_command_append_literal_data_resets_timer(self):
-        cmd = Command('CMD', 'tag', loop=self.loop, timeout=2)
+        cmd = self.command(timeout=2)
         cmd.begin_literal_data(12, b'literal')
 
         await self.advance(1.9)
@@ -302,7 +563,7 @@ class TestAioimaplibCommand(asynctest.ClockedTestCase):
         assert Response('OK', [b'literal data', 'line']) == cmd.response
 
     async def test_command_append_to_resp_resets_timer(self):
-        cmd = Command('CMD', 'tag', loop=self.loop, timeout=2)
+        cmd = self.command(timeout=2)
 
         await self.advance(1.9)
         cmd.append_to_resp('line 1')
@@ -314,7 +575,7 @@ class TestAioimaplibCommand(asynctest.ClockedTestCase):
         assert Response('OK', ['line 1', 'line 2']) == cmd.response
 
     async def test_command_timeout_while_receiving_data(self):
-        cmd = Command('CMD', 'tag', loop=self.loop, timeout=2)
+        cmd = self.command(timeout=2)
 
         await self.advance(1)
         cmd.begin_literal_data(12, b'literal')
@@ -324,6 +585,483 @@ class TestAioimaplibCommand(asynctest.ClockedTestCase):
             await cmd.wait()
 
 
+class TestTimeoutScheduler(asynctest.ClockedTestCase):
+    async def test_activity_does_not_create_timer_handles(self):
+        cmd = Command('CMD', 'tag', loop=self.loop, timeout=2)
+        cmd.use_scheduler(aioimaplib.TimeoutScheduler(self.loop))
+        self.loop.call_at = MagicMock(wraps=self.loop.call_at)
+
+        for _ in range(1000):
+            cmd.append_to_resp(b'line')
+        await self.advance(1.9)
+        cmd.close(b'line', 'OK')
+
+        self.loop.call_at.assert_not_called()
+        await cmd.wait()
+
+    async def test_commands_sharing_a_scheduler_timeout_independently(self):
+        scheduler = aioimaplib.TimeoutScheduler(self.loop)
+        cmd1, cmd2 = Command('CMD', 'tag1', loop=self.loop, timeout=2), Command('CMD', 'tag2', loop=self.loop, timeout=3)
+        cmd1.use_scheduler(scheduler)
+        cmd2.use_scheduler(scheduler)
+
+        await self.advance(1.5)
+        cmd1.append_to_resp(b'line')
+        await self.advance(1.6)
+
+        assert not cmd1._event.is_set()
+        with pytest.raises(CommandTimeout):
+            await cmd2.wait()
+
+        await self.advance(0.5)
+        with pytest.raises(CommandTimeout):
+            await cmd1.wait()
+        assert scheduler._handle is None
+
+    async def test_protocol_registers_commands_with_its_scheduler(self):
+        imap_protocol = IMAP4ClientProtocol(self.loop)
+        imap_protocol.transport = MagicMock()
+        imap_protocol.state = aioimaplib.AUTH
+        cmd = Command('NOOP', 'tag', loop=self.loop, timeout=2)
+        assert cmd._scheduler is None
+
+        noop = asyncio.ensure_future(imap_protocol.execute(cmd))
+        await asyncio.sleep(0)
+
+        assert cmd._scheduler is imap_protocol.timeout_scheduler
+        await self.advance(2.1)
+        with pytest.raises(CommandTimeout):
+            await noop
+
+
+class TestFlowControl(asynctest.TestCase):
+    def setUp(self):
+        self.imap_protocol = IMAP4ClientProtocol(self.loop)
+        self.imap_protocol.transport = MagicMock()
+
+    async def test_drain_returns_when_writing_is_not_paused(self):
+        await asyncio.wait_for(self.imap_protocol.drain(), 1)
+
+    async def test_drain_waits_for_resume_writing(self):
+        self.imap_protocol.pause_writing()
+        drain = asyncio.ensure_future(self.imap_protocol.drain())
+        await asyncio.sleep(0)
+        assert not drain.done()
+
+        self.imap_protocol.resume_writing()
+        await asyncio.wait_for(drain, 1)
+
+    async def test_drain_raises_when_connection_is_lost(self):
+        self.imap_protocol.pause_writing()
+        drain = asyncio.ensure_future(self.imap_protocol.drain())
+        await asyncio.sleep(0)
+
+        self.imap_protocol.connection_lost(None)
+        with pytest.raises(Abort):
+            await drain
+        with pytest.raises(Abort):
+            await self.imap_protocol.drain()
+
+    async def test_append_literal_is_sent_by_chunks_waiting_for_the_transport_to_drain(self):
+        literal = b'x' * (aioimaplib.LITERAL_CHUNK_SIZE + 10)
+        cmd = AppendCommand('TAG', literal, loop=self.loop)
+        self.imap_protocol.pending_sync_command = cmd
+        self.imap_protocol.pause_writing()
+
+        self.imap_protocol.data_received(b'+ Ready for literal data\r\n')
+        await asyncio.sleep(0)
+        assert 1 == self.imap_protocol.transport.write.call_count
+
+        self.imap_protocol.resume_writing()
+        await asyncio.wait_for(asyncio.gather(*self.imap_protocol.tasks), 1)
+
+        written = [bytes(c.args[0]) for c in self.imap_protocol.transport.write.call_args_list]
+        assert [aioimaplib.LITERAL_CHUNK_SIZE, 10, 2] == [len(chunk) for chunk in written]
+        assert literal + b'\r\n' == b''.join(written)
+        assert cmd.literal_data is None
+
+    async def test_append_command_is_aborted_when_connection_is_lost_during_literal(self):
+        cmd = AppendCommand('TAG', b'x' * (aioimaplib.LITERAL_CHUNK_SIZE + 10), loop=self.loop)
+        self.imap_protocol.pending_sync_command = cmd
+        self.imap_protocol.pause_writing()
+
+        self.imap_protocol.data_received(b'+ Ready for literal data\r\n')
+        await asyncio.sleep(0)
+        self.imap_protocol.connection_lost(None)
+
+        with pytest.raises(Abort):
+            await asyncio.wait_for(cmd.wait(), 1)
+
+    async def test_literal_chunks_from_file_object_and_iterators(self):
+        async def async_iterator():
+            yield b'foo'
+            yield b'bar'
+
+        assert [b'foo', b'bar'] == [bytes(c) async for c in aioimaplib.literal_chunks(b'foobar', 3)]
+        assert [b'foo', b'bar'] == [c async for c in aioimaplib.literal_chunks(io.BytesIO(b'foobar'), 3)]
+        assert [b'foo', b'bar'] == [c async for c in aioimaplib.literal_chunks(async_iterator())]
+        assert [b'foo', b'bar'] == [c async for c in aioimaplib.literal_chunks(iter([b'foo', b'bar']))]
+
+    async def test_literal_chunks_read_files_off_the_event_loop(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'foobar')
+            f.flush()
+            f.seek(0)
+            read_threads = []
+            read = f.read
+
+            def threaded_read(size):
+                read_threads.append(threading.current_thread())
+                return read(size)
+            f.read = threaded_read
+
+            assert [b'foo', b'bar'] == [c async for c in aioimaplib.literal_chunks(f, 3)]
+            assert [b'foo', b'bar'] == [c async for c in aioimaplib.literal_chunks(f.name, 3)]
+        assert 3 == len(read_threads)
+        assert threading.main_thread() not in read_threads
+
+
+class TestConnectionLost(asynctest.TestCase):
+    def setUp(self):
+        self.imap_protocol = IMAP4ClientProtocol(self.loop)
+        self.imap_protocol.transport = MagicMock()
+        self.imap_protocol.state = aioimaplib.SELECTED
+
+    async def test_pending_commands_fail_when_connection_is_lost(self):
+        sync_cmd = asyncio.ensure_future(self.imap_protocol.execute(Command('SELECT', 'A1', loop=self.loop)))
+        await asyncio.sleep(0)
+        async_cmd = Command('FETCH', 'A2', loop=self.loop)
+        self.imap_protocol.pending_async_commands['FETCH'] = async_cmd
+
+        self.imap_protocol.connection_lost(None)
+
+        with pytest.raises(ConnectionLost):
+            await asyncio.wait_for(sync_cmd, 1)
+        with pytest.raises(ConnectionLost):
+            await asyncio.wait_for(async_cmd.wait(), 1)
+        assert {} == self.imap_protocol.pending_async_commands
+        assert self.imap_protocol.pending_sync_command is None
+
+    async def test_execute_is_rejected_after_connection_is_lost(self):
+        self.imap_protocol.connection_lost(ConnectionResetError())
+
+        with pytest.raises(ConnectionLost):
+            await self.imap_protocol.execute(Command('NOOP', 'A1', loop=self.loop))
+        self.imap_protocol.transport.write.assert_not_called()
+
+    async def test_idle_waiters_are_woken_up_when_connection_is_lost(self):
+        self.imap_protocol.capabilities = {'IDLE'}
+        idle = asyncio.ensure_future(self.imap_protocol.idle())
+        await asyncio.sleep(0)
+        push = asyncio.ensure_future(self.imap_protocol.idle_queue.get())
+        await asyncio.sleep(0)
+
+        self.imap_protocol.connection_lost(None)
+
+        assert STOP_WAIT_SERVER_PUSH == (await asyncio.wait_for(push, 1))
+        with pytest.raises(ConnectionLost):
+            await asyncio.wait_for(idle, 1)
+
+    async def test_state_waiters_fail_when_connection_is_lost(self):
+        self.imap_protocol.state = aioimaplib.CONNECTED
+        wait = asyncio.ensure_future(self.imap_protocol.wait('AUTH|NONAUTH'))
+        await asyncio.sleep(0)
+
+        self.imap_protocol.connection_lost(None)
+
+        with pytest.raises(ConnectionLost):
+            await asyncio.wait_for(wait, 1)
+
+
+class TestCapabilityResponseCodes(asynctest.TestCase):
+    def setUp(self):
+        self.imap_protocol = IMAP4ClientProtocol(self.loop)
+        self.imap_protocol.transport = MagicMock()
+        self.imap_protocol.state = aioimaplib.CONNECTED
+
+    def sent_tag(self):
+        return self.imap_protocol.transport.write.call_args.args[0].split(b' ')[0]
+
+    async def test_capabilities_from_greeting(self):
+        self.imap_protocol.data_received(b'* OK [CAPABILITY IMAP4rev1 IDLE LITERAL+] Server ready\r\n')
+        await asyncio.wait_for(self.imap_protocol.wait('NONAUTH'), 1)
+
+        assert {'IMAP4rev1', 'IDLE', 'LITERAL+'} == self.imap_protocol.capabilities
+        assert 'IMAP4REV1' == self.imap_protocol.imap_version
+        self.imap_protocol.transport.write.assert_not_called()
+
+    async def test_cached_capabilities(self):
+        self.imap_protocol.cached_capabilities = frozenset({'IMAP4rev1', 'IDLE'})
+
+        self.imap_protocol.data_received(b'* OK Server ready\r\n')
+        await asyncio.wait_for(self.imap_protocol.wait('NONAUTH'), 1)
+
+        assert {'IMAP4rev1', 'IDLE'} == self.imap_protocol.capabilities
+        self.imap_protocol.transport.write.assert_not_called()
+
+    async def test_capabilities_from_login_response_code(self):
+        self.imap_protocol.state = aioimaplib.NONAUTH
+        self.imap_protocol.capabilities = {'IMAP4rev1'}
+        login = asyncio.ensure_future(self.imap_protocol.login('user', 'pass'))
+        await asyncio.sleep(0)
+
+        self.imap_protocol.data_received(self.sent_tag() + b' OK [CAPABILITY IMAP4rev1 MOVE ENABLE] Logged in\r\n')
+        await asyncio.wait_for(login, 1)
+
+        assert {'IMAP4rev1', 'MOVE', 'ENABLE'} == self.imap_protocol.capabilities
+
+    async def test_enabled_response(self):
+        self.imap_protocol.state = aioimaplib.AUTH
+        enable = asyncio.ensure_future(self.imap_protocol.enable('CONDSTORE UTF8=ACCEPT'))
+        await asyncio.sleep(0)
+
+        self.imap_protocol.data_received(b'* ENABLED CONDSTORE\r\n' + self.sent_tag() + b' OK Enabled\r\n')
+        await asyncio.wait_for(enable, 1)
+
+        assert {'CONDSTORE'} == self.imap_protocol.enabled
+
+
+class TestSaslAuthentication(asynctest.TestCase):
+    def setUp(self):
+        self.imap_protocol = IMAP4ClientProtocol(self.loop)
+        self.imap_protocol.transport = MagicMock()
+        self.imap_protocol.state = aioimaplib.NONAUTH
+
+    def written(self):
+        return [c.args[0] for c in self.imap_protocol.transport.write.call_args_list]
+
+    async def test_initial_response_is_sent_with_the_command_when_server_has_sasl_ir(self):
+        self.imap_protocol.capabilities = {'IMAP4rev1', 'SASL-IR'}
+        authenticate = asyncio.ensure_future(self.imap_protocol.authenticate(aioimaplib.PlainMechanism('user', 'pass')))
+        await asyncio.sleep(0)
+
+        tag = self.written()[0].split(b' ')[0]
+        assert [tag + b' AUTHENTICATE PLAIN AHVzZXIAcGFzcw==\r\n'] == self.written()
+        self.imap_protocol.data_received(tag + b' OK [CAPABILITY IMAP4rev1 IDLE] Authenticated\r\n')
+
+        assert 'OK' == (await asyncio.wait_for(authenticate, 1)).result
+        assert aioimaplib.AUTH == self.imap_protocol.state
+        assert 'IDLE' in self.imap_protocol.capabilities
+
+    async def test_initial_response_is_sent_after_the_continuation_without_sasl_ir(self):
+        self.imap_protocol.capabilities = {'IMAP4rev1'}
+        authenticate = asyncio.ensure_future(self.imap_protocol.authenticate(aioimaplib.PlainMechanism('user', 'pass')))
+        await asyncio.sleep(0)
+        tag = self.written()[0].split(b' ')[0]
+        assert [tag + b' AUTHENTICATE PLAIN\r\n'] == self.written()
+
+        self.imap_protocol.data_received(b'+ \r\n')
+        assert b'AHVzZXIAcGFzcw==\r\n' == self.written()[-1]
+        self.imap_protocol.data_received(tag + b' OK Authenticated\r\n')
+
+        assert 'OK' == (await asyncio.wait_for(authenticate, 1)).result
+
+    async def test_xoauth2_error_challenge_is_answered_with_an_empty_response(self):
+        authenticate = asyncio.ensure_future(self.imap_protocol.xoauth2('user', 'expired'))
+        await asyncio.sleep(0)
+        tag = self.written()[0].split(b' ')[0]
+
+        self.imap_protocol.data_received(b'+ eyJzdGF0dXMiOiI0MDEifQ==\r\n')
+        assert b'\r\n' == self.written()[-1]
+        self.imap_protocol.data_received(tag + b' NO AUTHENTICATE failed\r\n')
+
+        assert 'NO' == (await asyncio.wait_for(authenticate, 1)).result
+        assert aioimaplib.NONAUTH == self.imap_protocol.state
+
+    async def test_challenge_without_response_cancels_the_exchange(self):
+        class Anonymous(aioimaplib.SaslMechanism):
+            name = 'ANONYMOUS'
+
+        authenticate = asyncio.ensure_future(self.imap_protocol.authenticate(Anonymous()))
+        await asyncio.sleep(0)
+        tag = self.written()[0].split(b' ')[0]
+
+        self.imap_protocol.data_received(b'+ \r\n')
+        assert b'*\r\n' == self.written()[-1]
+        self.imap_protocol.data_received(b'+ not base64!\r\n')
+        assert b'*\r\n' == self.written()[-1]
+        self.imap_protocol.data_received(tag + b' BAD AUTHENTICATE cancelled\r\n')
+
+        assert 'BAD' == (await asyncio.wait_for(authenticate, 1)).result
+
+    def test_oauthbearer_initial_response(self):
+        mechanism = aioimaplib.OAuthBearerMechanism('user@mail', 'token', host='imap.mail', port=993)
+
+        assert b'n,a=user@mail,\1host=imap.mail\1port=993\1auth=Bearer token\1\1' == mechanism.initial_response()
+
+
+class TestStatusResponses(asynctest.TestCase):
+    def setUp(self):
+        self.imap_protocol = IMAP4ClientProtocol(self.loop)
+        self.imap_protocol.transport = MagicMock()
+        self.imap_protocol.state = aioimaplib.AUTH
+
+    def tag(self, index):
+        return self.imap_protocol.transport.write.call_args_list[index].args[0].split(b' ')[0]
+
+    async def test_unmatched_status_response_goes_to_the_only_status_command(self):
+        status = asyncio.ensure_future(self.imap_protocol.status('Sent', '(MESSAGES)'))
+        await asyncio.sleep(0)
+
+        self.imap_protocol.data_received(b'* STATUS "&AFM-ent" (MESSAGES 2)\r\n')
+        self.imap_protocol.data_received(self.tag(0) + b' OK STATUS completed.\r\n')
+
+        assert ('OK', [b'"&AFM-ent" (MESSAGES 2)', b'STATUS completed.']) == await asyncio.wait_for(status, 1)
+
+    async def test_unmatched_status_response_is_ignored_with_several_status_commands(self):
+        statuses = [asyncio.ensure_future(self.imap_protocol.status(mailbox, '(MESSAGES)')) for mailbox in ('A', 'B')]
+        await asyncio.sleep(0)
+
+        self.imap_protocol.data_received(b'* STATUS C (MESSAGES 2)\r\n')
+        self.imap_protocol.data_received(self.tag(0) + b' OK STATUS completed.\r\n')
+        self.imap_protocol.data_received(self.tag(1) + b' OK STATUS completed.\r\n')
+
+        assert 2 * [('OK', [b'STATUS completed.'])] == await asyncio.wait_for(asyncio.gather(*statuses), 1)
+
+
+class TestAppendLiteral(asynctest.TestCase):
+    def setUp(self):
+        self.imap_protocol = IMAP4ClientProtocol(self.loop)
+        self.imap_protocol.transport = MagicMock()
+        self.imap_protocol.state = aioimaplib.AUTH
+
+    def written(self):
+        return b''.join(bytes(c.args[0]) for c in self.imap_protocol.transport.write.call_args_list)
+
+    def test_literal_size(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b'message')
+            f.flush()
+            f.seek(2)
+
+            assert 7 == aioimaplib.literal_size(f.name)
+            assert 5 == aioimaplib.literal_size(f)
+        assert 7 == aioimaplib.literal_size(b'message')
+        assert 8 == aioimaplib.literal_size(memoryview(array('i', [1, 2])))
+        assert 3 == aioimaplib.literal_size(iter([b'foo']), 3)
+        with pytest.raises(ValueError):
+            aioimaplib.literal_size(iter([b'foo']))
+
+    async def test_append_with_literal_plus_does_not_wait_for_continuation(self):
+        self.imap_protocol.capabilities = {'LITERAL+'}
+
+        append = asyncio.ensure_future(self.imap_protocol.append(b'message', 'INBOX'))
+        await asyncio.sleep(0.01)
+
+        tag = self.written().split()[0]
+        assert tag + b' APPEND INBOX {7+}\r\nmessage\r\n' == self.written()
+        self.imap_protocol.data_received(tag + b' OK APPEND completed\r\n')
+        assert 'OK' == (await asyncio.wait_for(append, 1)).result
+
+    async def test_append_with_literal_minus_only_for_small_messages(self):
+        self.imap_protocol.capabilities = {'LITERAL-'}
+
+        asyncio.ensure_future(self.imap_protocol.append(b'x' * 4097, 'INBOX'))
+        await asyncio.sleep(0.01)
+
+        assert self.written().endswith(b' APPEND INBOX {4097}\r\n')
+
+    async def test_append_is_aborted_when_literal_data_is_longer_than_announced(self):
+        cmd = AppendCommand('TAG', iter([b'foo', b'bar']), literal_size=4, loop=self.loop)
+        self.imap_protocol.pending_sync_command = cmd
+
+        self.imap_protocol.data_received(b'+ Ready for literal data\r\n')
+
+        with pytest.raises(Abort):
+            await asyncio.wait_for(cmd.wait(), 1)
+        assert b'foo' == self.written()
+        self.imap_protocol.transport.abort.assert_called_once_with()
+
+    async def test_append_is_aborted_when_literal_data_is_shorter_than_announced(self):
+        cmd = AppendCommand('TAG', iter([b'foo', b'bar']), literal_size=7, loop=self.loop)
+        self.imap_protocol.pending_sync_command = cmd
+
+        self.imap_protocol.data_received(b'+ Ready for literal data\r\n')
+
+        with pytest.raises(Abort):
+            await asyncio.wait_for(cmd.wait(), 1)
+        assert b'foobar' == self.written()
+        self.imap_protocol.transport.abort.assert_called_once_with()
+
+
+class TestStreamingFetch(asynctest.TestCase):
+    def setUp(self):
+        self.imap_protocol = IMAP4ClientProtocol(self.loop)
+        self.imap_protocol.transport = MagicMock()
+        self.imap_protocol.state = aioimaplib.SELECTED
+        self.imap_protocol.read_high_water_mark = 100
+
+    async def start_fetch_stream(self):
+        stream = self.imap_protocol.fetch_stream('1:*', '(BODY[])')
+        first_message = asyncio.ensure_future(stream.__anext__())
+        while not self.imap_protocol.transport.write.called:
+            await asyncio.sleep(0)
+        tag = self.imap_protocol.transport.write.call_args[0][0].split()[0]
+        return stream, first_message, tag
+
+    async def test_reading_is_paused_until_messages_are_consumed(self):
+        stream, first_message, tag = await self.start_fetch_stream()
+
+        self.imap_protocol.data_received(b'* 1 FETCH (BODY[] {90}\r\n' + b'x' * 90 + b')\r\n'
+                                         b'* 2 FETCH (BODY[] {90}\r\n' + b'y' * 90 + b')\r\n')
+        self.imap_protocol.transport.pause_reading.assert_called_once_with()
+
+        assert [b'1 FETCH (BODY[] {90}', b'x' * 90, b')'] == await asyncio.wait_for(first_message, 1)
+        self.imap_protocol.transport.resume_reading.assert_not_called()
+
+        assert [b'2 FETCH (BODY[] {90}', b'y' * 90, b')'] == await asyncio.wait_for(stream.__anext__(), 1)
+        self.imap_protocol.transport.resume_reading.assert_called_once_with()
+
+        self.imap_protocol.data_received(tag + b' OK FETCH completed\r\n')
+        with pytest.raises(StopAsyncIteration):
+            await asyncio.wait_for(stream.__anext__(), 1)
+
+    async def test_reading_is_resumed_when_the_consumer_stops(self):
+        stream, first_message, tag = await self.start_fetch_stream()
+
+        self.imap_protocol.data_received(b'* 1 FETCH (BODY[] {90}\r\n' + b'x' * 90 + b')\r\n'
+                                         b'* 2 FETCH (BODY[] {90}\r\n' + b'y' * 90 + b')\r\n')
+        await asyncio.wait_for(first_message, 1)
+        await stream.aclose()
+
+        self.imap_protocol.transport.resume_reading.assert_called_once_with()
+        self.imap_protocol.data_received(b'* 3 FETCH (BODY[] {90}\r\n' + b'z' * 90 + b')\r\n'
+                                         + tag + b' OK FETCH completed\r\n')
+        self.imap_protocol.transport.pause_reading.assert_called_once_with()
+        assert 0 == self.imap_protocol._unconsumed_size
+
+    async def test_reading_is_paused_while_a_big_literal_is_received(self):
+        stream, first_message, tag = await self.start_fetch_stream()
+
+        self.imap_protocol.data_received(b'* 1 FETCH (BODY[] {1000}\r\n' + b'x' * 500)
+
+        self.imap_protocol.transport.pause_reading.assert_called_once_with()
+        assert not first_message.done()
+        self.imap_protocol.data_received(b'x' * 500 + b')\r\n')
+        assert [b'1 FETCH (BODY[] {1000}', b'x' * 1000, b')'] == await asyncio.wait_for(first_message, 1)
+        self.imap_protocol.transport.resume_reading.assert_called_once_with()
+        assert 0 == self.imap_protocol._unconsumed_size
+
+    async def test_partially_received_message_is_released_on_aclose(self):
+        stream, first_message, tag = await self.start_fetch_stream()
+        self.imap_protocol.data_received(b'* 1 FETCH (BODY[] {90}\r\n' + b'x' * 90 + b')\r\n'
+                                         b'* 2 FETCH (BODY[] {1000}\r\n' + b'y' * 500)
+        await asyncio.wait_for(first_message, 1)
+
+        await stream.aclose()
+
+        assert 0 == self.imap_protocol._unconsumed_size
+        self.imap_protocol.transport.resume_reading.assert_called_once_with()
+
+    async def test_fetch_not_ok_raises_error(self):
+        stream, first_message, tag = await self.start_fetch_stream()
+
+        self.imap_protocol.data_received(tag + b' NO FETCH failed\r\n')
+
+        with pytest.raises(aioimaplib.Error):
+            await asyncio.wait_for(first_message, 1)
+
+
 class AioWithImapServer(WithImapServer):
     async def login_user(self, login, password, select=False, lib=aioimaplib.IMAP4, timeout=3):
         imap_client = lib(port=12345, loop=self.loop, timeout=timeout)
@@ -396,6 +1134,17 @@ class TestAioimaplib(AioWithImapServer, asynctest.TestCase):
         assert {'IMAP4rev1', 'YESAUTH'} == imap_client.protocol.capabilities
         assert imap_client.has_capability('YESAUTH')
 
+    async def test_capabilities_cache(self):
+        capabilities_cache = dict()
+        for _ in range(2):
+            imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+            imap_client.capabilities_cache = capabilities_cache
+            await imap_client.connect()
+            assert {'IMAP4rev1', 'YESAUTH'} == imap_client.protocol.capabilities
+
+        assert 1 == self.imapserver.stats['commands']
+        assert {('127.0.0.1', 12345): {'IMAP4rev1', 'YESAUTH'}} == capabilities_cache
+
     async def test_login(self):
         imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
         await asyncio.wait_for(imap_client.wait_hello_from_server(), 2)
@@ -418,6 +1167,231 @@ class TestAioimaplib(AioWithImapServer, asynctest.TestCase):
         self.assertEqual('OK', result)
         self.assertEqual(b'AUTHENTICATE completed', data[-1])
 
+    async def test_fetch_parts(self):
+        message = MIMEMultipart()
+        message['To'] = 'user'
+        message.attach(MIMEText('hello', 'plain'))
+        message.attach(MIMEText('<b>hello</b>', 'html'))
+        message.attach(MIMEApplication(b'%PDF-1.4 content', 'pdf', Name='doc.pdf'))
+        message.get_payload()[-1].add_header('Content-Disposition', 'attachment', filename='doc.pdf')
+        uid, = self.imapserver.receive(Mail(message))
+        self.imapserver.receive(Mail.create(['user'], mail_from='me', subject='no attachment'))
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+        await imap_client.login('user', 'pass')
+        await imap_client.select()
+
+        parts = await imap_client.fetch_parts('1:2', lambda part: part.content_type == 'application/pdf')
+
+        assert [uid, uid + 1] == sorted(parts)
+        assert [] == parts[uid + 1]
+        (part, data), = parts[uid]
+        assert ('3', 'doc.pdf', 'attachment') == (part.section, part.filename, part.disposition)
+        assert b'%PDF-1.4 content' == part.decode(data)
+
+    async def test_fetch_cached(self):
+        self.imapserver.receive(Mail.create(['user'], mail_from='me', subject='hello'))
+        self.imapserver.receive(Mail.create(['user'], mail_from='you', subject='world'))
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        imap_client.fetch_cache = aioimaplib.FetchCache()
+        await imap_client.connect()
+        await imap_client.login('user', 'pass')
+        await imap_client.select()
+        fetches = list()
+        protocol_fetch = imap_client.protocol.fetch
+
+        async def fetch(message_set, message_parts, **kwargs):
+            fetches.append((message_set, message_parts))
+            return await protocol_fetch(message_set, message_parts, **kwargs)
+        imap_client.protocol.fetch = fetch
+        cache_threads = set()
+        cache_get = imap_client.fetch_cache.get
+        imap_client.fetch_cache.get = lambda *args: cache_threads.add(threading.current_thread()) or cache_get(*args)
+
+        messages = await imap_client.fetch_cached([1], '(FLAGS BODY.PEEK[HEADER.FIELDS (Subject)])')
+        assert cache_threads and threading.current_thread() not in cache_threads
+        subject = messages[1]['BODY[HEADER.FIELDS (SUBJECT)]']
+        assert subject.startswith(b'Subject: ')
+
+        messages = await imap_client.fetch_cached([1, 2], '(FLAGS BODY.PEEK[HEADER.FIELDS (Subject)])')
+        assert subject == messages[1]['BODY[HEADER.FIELDS (SUBJECT)]']
+        assert subject != messages[2]['BODY[HEADER.FIELDS (SUBJECT)]']
+        assert [[], []] == [messages[uid]['FLAGS'] for uid in (1, 2)]
+        assert [('1', '(UID FLAGS BODY.PEEK[HEADER.FIELDS (Subject)])'),
+                ('2', '(UID FLAGS BODY.PEEK[HEADER.FIELDS (Subject)])'),
+                ('1', '(UID FLAGS)')] == fetches
+
+        fetches.clear()
+        self.imapserver.get_connection('user').uidvalidity += 1
+        await imap_client.select()
+        await imap_client.fetch_cached([1, 2], 'BODY.PEEK[HEADER.FIELDS (Subject)]')
+        assert [('1:2', '(UID BODY.PEEK[HEADER.FIELDS (Subject)])')] == fetches
+
+    async def test_fetch_cached_bodies(self):
+        self.imapserver.receive(Mail.create(['user'], mail_from='me', subject='hello'))
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        with tempfile.TemporaryDirectory() as directory:
+            imap_client.body_cache = aioimaplib.BodyCache(directory)
+            await imap_client.connect()
+            await imap_client.login('user', 'pass')
+            await imap_client.select()
+
+            messages = await imap_client.fetch_cached([1], '(FLAGS BODY.PEEK[])')
+            body = messages[1]['BODY[]']
+            assert body.startswith(b'Content-Type')
+            assert 1 == len(os.listdir(directory))
+
+            imap_client.protocol.fetch = MagicMock(side_effect=AssertionError('not cached'))
+            assert {1: {'BODY[]': body}} == await imap_client.fetch_cached([1], 'BODY.PEEK[]')
+
+    async def test_parse_namespace_and_quota_responses(self):
+        self.imapserver.receive(Mail.create(['user']))
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+        await imap_client.login('user', 'pass')
+
+        assert aioimaplib.Namespaces([('', '/')], [], []) == aioimaplib.parse_namespace(await imap_client.namespace())
+        quota = aioimaplib.parse_quota(await imap_client.getquotaroot('INBOX'))
+        assert ['INBOX'] == list(quota)
+        assert imapserver.ImapProtocol.DEFAULT_QUOTA == quota['INBOX']['STORAGE'][1]
+
+    async def test_mailbox_names_are_encoded_in_modified_utf7(self):
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+        await imap_client.login('user', 'pass')
+
+        assert 'OK' == (await imap_client.create('Entwürfe')).result
+        assert self.imapserver._server_state.has_mailbox('user', 'Entw&APw-rfe')
+        assert 'OK' == (await imap_client.select('Entwürfe')).result
+
+        mailboxes = await imap_client.list_status('""', '*', 'MESSAGES')
+        assert {'MESSAGES': 0} == mailboxes['Entwürfe'].status
+
+    async def test_listed_mailbox_can_be_selected(self):
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+        await imap_client.login('user', 'pass')
+        assert 'OK' == (await imap_client.create('R&D')).result
+        assert self.imapserver._server_state.has_mailbox('user', 'R&-D')
+
+        names = [mailbox.name for mailbox in aioimaplib.parse_list(await imap_client.list('""', '*'))]
+        assert 'R&D' in names
+
+        assert 'OK' == (await imap_client.select('R&D')).result
+        assert {'R&D': {'MESSAGES': 0}} == await imap_client.status_many(['R&D'], 'MESSAGES')
+
+        imap_client.encode_mailbox_names = False
+        assert 'OK' == (await imap_client.select('R&-D')).result
+        assert 'R&-D' == self.imapserver.get_connection('user').user_mailbox
+
+    async def test_mailbox_names_are_sent_unchanged_without_encoding(self):
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        imap_client.encode_mailbox_names = False
+        await imap_client.connect()
+        await imap_client.login('user', 'pass')
+
+        assert 'OK' == (await imap_client.create('Entw&APw-rfe')).result
+        assert 'OK' == (await imap_client.select('Entw&APw-rfe')).result
+
+        assert 'Entw&APw-rfe' == self.imapserver.get_connection('user').user_mailbox
+        assert not self.imapserver._server_state.has_mailbox('user', 'Entw&-APw-rfe')
+        assert {'Entwürfe': {'MESSAGES': 0}} == await imap_client.status_many(['Entw&APw-rfe'], 'MESSAGES')
+
+    async def test_status_many_are_pipelined(self):
+        self.imapserver.receive(Mail.create(['user'], mail_from='me', subject='hello'))
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+        await imap_client.login('user', 'pass')
+        await imap_client.create('Archive')
+        in_flight = list()
+        send = imap_client.protocol.send
+
+        def count_in_flight(line, scrub=None):
+            in_flight.append(len([name for name in imap_client.protocol.pending_async_commands
+                                  if name.startswith('STATUS')]))
+            send(line, scrub=scrub)
+        imap_client.protocol.send = count_in_flight
+
+        statuses = await imap_client.status_many(['INBOX', 'Sent', 'Archive', 'Unknown'], 'MESSAGES')
+
+        assert {'INBOX': {'MESSAGES': 1}, 'Sent': {'MESSAGES': 0}, 'Archive': {'MESSAGES': 0}} == statuses
+        assert [1, 2, 3, 4] == in_flight
+
+    async def test_concurrent_status_of_the_same_mailbox(self):
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+        await imap_client.login('user', 'pass')
+
+        responses = await asyncio.gather(*(imap_client.status('INBOX', '(MESSAGES)') for _ in range(3)))
+
+        assert 3 * [('OK', [b'INBOX (MESSAGES 0)', b'STATUS completed.'])] == responses
+
+    async def test_status_of_a_mailbox_with_a_space(self):
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+        await imap_client.login('user', 'pass')
+        assert 'OK' == (await imap_client.create('"Sent Items"')).result
+
+        response = await imap_client.status('Sent Items', '(MESSAGES)')
+
+        assert 'OK' == response.result
+        assert {'MESSAGES': 0} == aioimaplib.parse_status(response)
+
+    async def test_list_status_without_list_status_capability(self):
+        self.imapserver.receive(Mail.create(['user'], mail_from='me', subject='hello'))
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+        await imap_client.login('user', 'pass')
+
+        mailboxes = await imap_client.list_status('""', '*', 'MESSAGES')
+
+        assert ['Drafts', 'INBOX', 'Sent', 'Trash'] == list(mailboxes)
+        assert {'MESSAGES': 1} == mailboxes['INBOX'].status
+        assert {'MESSAGES': 0} == mailboxes['Sent'].status
+
+    async def test_download_by_chunks(self):
+        uid, = self.imapserver.receive(Mail.create(['user'], mail_from='me', subject='big', content='x' * 1000))
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+        await imap_client.login('user', 'pass')
+        await imap_client.select()
+        chunks = list()
+
+        size = await imap_client.download(uid, lambda offset, data: chunks.append((offset, data)), chunk_size=256)
+
+        expected = await imap_client.fetch_range(uid, 0, 10000)
+        assert len(expected) == size
+        assert [0, 256, 512] == [offset for offset, _ in chunks][:3]
+        assert expected == b''.join(data for _, data in chunks)
+        assert 200 == await imap_client.download(uid, lambda offset, data: None, offset=100, end=200)
+
+    async def test_download_concurrently(self):
+        uid, = self.imapserver.receive(Mail.create(['user'], mail_from='me', subject='big', content='x' * 1000))
+        clients = [aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3) for _ in range(3)]
+        for imap_client in clients:
+            await imap_client.connect()
+            await imap_client.login('user', 'pass')
+            await imap_client.select()
+        received = bytearray()
+
+        def sink(offset, data):
+            received[offset:offset + len(data)] = data
+
+        size = await aioimaplib.download_concurrently(clients, uid, sink, chunk_size=100)
+
+        assert size == len(received)
+        assert bytes(received) == await clients[0].fetch_range(uid, 0, size)
+
+    async def test_authenticate_plain_without_sasl_ir(self):
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+
+        result, data = await imap_client.authenticate(aioimaplib.PlainMechanism('user', 'pass'))
+
+        assert aioimaplib.AUTH == imap_client.protocol.state
+        assert 'OK' == result
+        assert b'AUTHENTICATE completed' == data[-1]
+
     async def test_login_with_special_characters(self):
         imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
         await asyncio.wait_for(imap_client.wait_hello_from_server(), 2)
@@ -486,7 +1460,7 @@ class TestAioimaplib(AioWithImapServer, asynctest.TestCase):
     async def test_uid_with_illegal_command(self):
         imap_client = await self.login_user('user', 'pass', select=True)
 
-        for command in {'COPY', 'FETCH', 'STORE', 'EXPUNGE', 'MOVE'}.symmetric_difference(Commands.keys()):
+        for command in {'COPY', 'FETCH', 'STORE', 'EXPUNGE', 'MOVE', 'SORT', 'THREAD'}.symmetric_difference(Commands.keys()):
             with pytest.raises(aioimaplib.Abort) as expected:
                 await imap_client.uid(command)
 
@@ -541,6 +1515,60 @@ class TestAioimaplib(AioWithImapServer, asynctest.TestCase):
         assert 'OK' == response.result
         assert mail.as_bytes() == response.lines[1]
 
+    async def test_fetch_stream(self):
+        mails = [Mail.create(['user'], mail_from='me', subject='hello %d' % i, content='mail %d' % i) for i in range(3)]
+        for mail in mails:
+            self.imapserver.receive(mail)
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+        await imap_client.login('user', 'pass')
+        await imap_client.select()
+
+        messages = [message async for message in imap_client.fetch_stream('1:*', '(UID RFC822)', by_uid=True)]
+
+        assert [[b'%d FETCH (UID %d RFC822 {%d}' % (i, i, len(mail.as_bytes())), mail.as_bytes(), b')']
+                for i, mail in enumerate(mails, 1)] == messages
+
+    async def test_fetch_stream_pauses_reading_for_a_slow_consumer(self):
+        for i in range(5):
+            self.imapserver.receive(Mail.create(['user'], mail_from='me', subject='hello', content='x' * 10000))
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+        await imap_client.login('user', 'pass')
+        await imap_client.select()
+        transport = imap_client.protocol.transport
+        transport.pause_reading = MagicMock(wraps=transport.pause_reading)
+        transport.resume_reading = MagicMock(wraps=transport.resume_reading)
+        imap_client.protocol.read_high_water_mark = 15000
+
+        messages = list()
+        async for message in imap_client.fetch_stream('1:*', '(UID RFC822)', by_uid=True):
+            await asyncio.sleep(0.05)
+            messages.append(message)
+
+        assert 5 == len(messages)
+        assert transport.pause_reading.called
+        assert transport.resume_reading.called
+
+    async def test_fetch_stream_closed_after_breaking_out_early(self):
+        for i in range(5):
+            self.imapserver.receive(Mail.create(['user'], mail_from='me', subject='hello', content='x' * 10000))
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+        await imap_client.login('user', 'pass')
+        await imap_client.select()
+        imap_client.protocol.read_high_water_mark = 15000
+
+        messages = imap_client.fetch_stream('1:*', '(UID RFC822)', by_uid=True)
+        async for message in messages:
+            await asyncio.sleep(0.05)
+            break
+        await messages.aclose()
+
+        assert 0 == imap_client.protocol._unconsumed_size
+        assert not imap_client.protocol._read_paused
+        assert 'OK' == (await imap_client.noop()).result
+
     async def test_idle(self):
         imap_client = await self.login_user('user', 'pass', select=True)
 
@@ -767,6 +1795,42 @@ class TestAioimaplib(AioWithImapServer, asynctest.TestCase):
 
         assert 1 == extract_exists((await imap_client.examine('INBOX')))
 
+    async def test_append_from_file_and_async_iterator(self):
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+        await imap_client.login('user@mail', 'pass')
+        message = Mail.create(['user@mail'], subject='append msg', content='x' * 100000).as_bytes()
+
+        async def chunks():
+            for start in range(0, len(message), 1000):
+                yield message[start:start + 1000]
+
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(message)
+            f.flush()
+            assert 'OK' == (await imap_client.append(f.name)).result
+            f.seek(0)
+            assert 'OK' == (await imap_client.append(f)).result
+        assert 'OK' == (await imap_client.append(chunks(), size=len(message))).result
+
+        assert 3 == extract_exists((await imap_client.select('INBOX')))
+        response = await imap_client.fetch('1:3', 'BODY.PEEK[]')
+        assert [message] * 3 == [line for line in response.lines if isinstance(line, bytearray)]
+
+    async def test_append_with_literal_shorter_than_announced_closes_the_connection(self):
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+        await imap_client.login('user@mail', 'pass')
+
+        async def chunks():
+            yield b'too short'
+
+        with pytest.raises(Abort):
+            await imap_client.append(chunks(), size=100)
+
+        with pytest.raises(aioimaplib.ConnectionLost):
+            await imap_client.noop()
+
     async def test_rfc5032_within(self):
         self.imapserver.receive(Mail.create(['user'], date=datetime.now(tz=utc) - timedelta(seconds=84600 * 3)))  # 1
         self.imapserver.receive(Mail.create(['user'], date=datetime.now(tz=utc) - timedelta(seconds=84600)))  # 2
@@ -868,6 +1932,12 @@ class TestImapServerCapabilities(AioWithImapServer, asynctest.TestCase):
         with pytest.raises(Abort):
             await imap_client.uid('move', '1:1', 'Trash')
 
+    async def test_starttls_without_starttls_capability_abort_command(self):
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+        with pytest.raises(Abort):
+            await imap_client.starttls()
+
     async def test_enable_without_enable_capability_abort_command(self):
         imap_client = await self.login_user('user', 'pass')
         with pytest.raises(Abort):
@@ -879,6 +1949,209 @@ class TestImapServerCapabilities(AioWithImapServer, asynctest.TestCase):
             await imap_client.namespace()
 
 
+class TestAioimaplibLiteralPlus(AioWithImapServer, asynctest.TestCase):
+    def setUp(self):
+        self._init_server(self.loop, capabilities=imapserver.CAPABILITIES + ' LITERAL+')
+
+    async def tearDown(self):
+        await self._shutdown_server()
+
+    async def test_append(self):
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+        await imap_client.login('user@mail', 'pass')
+        message = Mail.create(['user@mail'], subject='append msg', content='x' * 100000).as_bytes()
+
+        response = await imap_client.append(message, mailbox='INBOX')
+
+        assert 'OK' == response.result
+        assert 1 == extract_exists((await imap_client.examine('INBOX')))
+
+
+class TestAioimaplibStartTLS(AioWithImapServer, asynctest.TestCase):
+    def setUp(self):
+        self._cert_file, self._cert_key = create_temp_self_signed_cert()
+
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(self._cert_file, self._cert_key)
+
+        self._init_server(self.loop, starttls_context=ssl_context)
+
+    async def tearDown(self):
+        await self._shutdown_server()
+        os.remove(self._cert_file)
+        os.remove(self._cert_key)
+
+    async def test_starttls(self):
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+        assert imap_client.has_capability('STARTTLS')
+
+        response = await imap_client.starttls(ssl.create_default_context(cafile=self._cert_file))
+
+        assert 'OK' == response.result
+        assert imap_client.protocol.transport.get_extra_info('ssl_object') is not None
+        assert not imap_client.has_capability('STARTTLS')
+        assert 'OK' == (await imap_client.login('user', 'pass')).result
+        assert 'OK' == (await imap_client.select()).result
+
+
+class TestAioimaplibSaslIR(AioWithImapServer, asynctest.TestCase):
+    def setUp(self):
+        self._init_server(self.loop, capabilities=imapserver.CAPABILITIES + ' SASL-IR')
+
+    async def tearDown(self):
+        await self._shutdown_server()
+
+    async def test_authenticate_plain(self):
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+        assert imap_client.has_capability('SASL-IR')
+
+        result, data = await imap_client.authenticate(aioimaplib.PlainMechanism('user', 'pass'))
+
+        assert 'OK' == result
+        assert aioimaplib.AUTH == imap_client.protocol.state
+        assert 'OK' == (await imap_client.select()).result
+
+
+class TestAioimaplibListStatus(AioWithImapServer, asynctest.TestCase):
+    def setUp(self):
+        self._init_server(self.loop, capabilities=imapserver.CAPABILITIES + ' LIST-STATUS')
+
+    async def tearDown(self):
+        await self._shutdown_server()
+
+    async def test_list_status(self):
+        self.imapserver.receive(Mail.create(['user'], mail_from='me', subject='hello'))
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+        await imap_client.login('user', 'pass')
+        imap_client.protocol.status = MagicMock(side_effect=AssertionError('STATUS should not be sent'))
+
+        mailboxes = await imap_client.list_status('""', '*', 'MESSAGES UIDNEXT')
+
+        assert ['Drafts', 'INBOX', 'Sent', 'Trash'] == list(mailboxes)
+        assert aioimaplib.ListedMailbox('INBOX', [], '/', {'MESSAGES': 1, 'UIDNEXT': 2}) == mailboxes['INBOX']
+        assert {'MESSAGES': 0, 'UIDNEXT': 1} == mailboxes['Trash'].status
+
+
+class TestAioimaplibSortThread(AioWithImapServer, asynctest.TestCase):
+    def setUp(self):
+        self._init_server(self.loop, capabilities=imapserver.CAPABILITIES + ' SORT ESORT PARTIAL THREAD=ORDEREDSUBJECT')
+
+    async def tearDown(self):
+        await self._shutdown_server()
+
+    async def login_with_messages(self):
+        for i, subject in enumerate(('banana', 'apple', 'Re: banana', 'cherry')):
+            self.imapserver.receive(Mail.create(['user'], mail_from='me', subject=subject,
+                                                date=datetime(2024, 1, 1 + i, tzinfo=utc)))
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+        await imap_client.login('user', 'pass')
+        await imap_client.select()
+        return imap_client
+
+    async def test_sort(self):
+        imap_client = await self.login_with_messages()
+
+        response = await imap_client.sort('SUBJECT REVERSE DATE', 'ALL')
+        assert 'OK' == response.result
+        assert [2, 3, 1, 4] == aioimaplib.parse_search(response)
+
+        assert [4, 3, 2, 1] == aioimaplib.parse_search(await imap_client.uid_sort('REVERSE ARRIVAL', 'ALL'))
+        assert [4, 3] == aioimaplib.parse_search(await imap_client.uid('sort', '(REVERSE DATE)', '3:4'))
+
+    async def test_sort_page(self):
+        imap_client = await self.login_with_messages()
+
+        assert [3, 2] == await imap_client.sort_page('REVERSE DATE', 'ALL', first=2, last=3)
+        assert [2, 1] == await imap_client.sort_page('REVERSE DATE', 'ALL', first=-1, last=-2)
+        assert [] == await imap_client.sort_page('REVERSE DATE', 'ALL', first=5, last=10)
+
+    async def test_sort_page_without_partial_slices_the_sort_result(self):
+        imap_client = await self.login_with_messages()
+        imap_client.protocol.capabilities.discard('PARTIAL')
+
+        assert [3, 2] == await imap_client.sort_page('REVERSE DATE', 'ALL', first=2, last=3)
+
+    async def test_thread(self):
+        imap_client = await self.login_with_messages()
+
+        response = await imap_client.uid_thread('ORDEREDSUBJECT', 'ALL')
+
+        assert 'OK' == response.result
+        assert [aioimaplib.ThreadNode(1, [aioimaplib.ThreadNode(3, [])]), aioimaplib.ThreadNode(2, []),
+                aioimaplib.ThreadNode(4, [])] == aioimaplib.parse_thread(response)
+
+    async def test_thread_without_capability(self):
+        imap_client = await self.login_with_messages()
+
+        with self.assertRaises(aioimaplib.Abort):
+            await imap_client.thread('REFERENCES', 'ALL')
+
+
+class TestAioimaplibSearchPages(AioWithImapServer, asynctest.TestCase):
+    def setUp(self):
+        self._init_server(self.loop, capabilities=imapserver.CAPABILITIES + ' ESEARCH PARTIAL')
+
+    async def tearDown(self):
+        await self._shutdown_server()
+
+    async def login_with_messages(self, count=5):
+        for _ in range(count):
+            self.imapserver.receive(Mail.create(['user'], mail_from='me', subject='hello'))
+        imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3)
+        await imap_client.connect()
+        await imap_client.login('user', 'pass')
+        await imap_client.select()
+        return imap_client
+
+    async def test_search_page(self):
+        imap_client = await self.login_with_messages()
+
+        assert [2, 3] == await imap_client.search_page('ALL', first=2, last=3)
+        assert [4, 5] == await imap_client.search_page('ALL', first=-1, last=-2)
+        assert [] == await imap_client.search_page('ALL', first=6, last=10)
+
+    async def test_search_pages_with_partial(self):
+        imap_client = await self.login_with_messages()
+        imap_client.protocol.search = MagicMock(wraps=imap_client.protocol.search)
+
+        assert [[1, 2], [3, 4], [5]] == [page async for page in imap_client.search_pages('ALL', page_size=2)]
+        assert [[5, 4], [3, 2], [1]] == \
+               [page async for page in imap_client.search_pages('ALL', page_size=2, reverse=True)]
+        assert 6 == imap_client.protocol.search.call_count
+
+    async def test_search_pages_are_requested_when_consumed(self):
+        imap_client = await self.login_with_messages()
+        imap_client.protocol.search = MagicMock(wraps=imap_client.protocol.search)
+
+        async for page in imap_client.search_pages('ALL', page_size=2):
+            assert [1, 2] == page
+            break
+
+        assert 1 == imap_client.protocol.search.call_count
+
+    async def test_search_pages_with_esearch_slices_the_all_result(self):
+        imap_client = await self.login_with_messages()
+        imap_client.protocol.capabilities.discard('PARTIAL')
+        imap_client.protocol.search = MagicMock(wraps=imap_client.protocol.search)
+
+        assert [[5, 4], [3, 2], [1]] == \
+               [page async for page in imap_client.search_pages('ALL', page_size=2, reverse=True)]
+        assert 1 == imap_client.protocol.search.call_count
+        assert 'ALL' == imap_client.protocol.search.call_args[1]['ret']
+
+    async def test_search_pages_without_esearch(self):
+        imap_client = await self.login_with_messages()
+        imap_client.protocol.capabilities.difference_update({'ESEARCH', 'PARTIAL'})
+
+        assert [[1, 2, 3], [4, 5]] == [page async for page in imap_client.search_pages('ALL', page_size=3)]
+        assert [2, 3] == await imap_client.search_page('ALL', first=2, last=3)
+
+
 class TestAioimaplibClocked(AioWithImapServer, asynctest.ClockedTestCase):
 
     def setUp(self):
@@ -985,6 +2258,10 @@ class TestAioimaplibCallback(AioWithImapServer, asynctest.TestCase):
     def setUp(self):
         self._init_server(self.loop)
 
+    async def tearDown(self):
+        # the server is shut down by the test, this is for when it fails before
+        await self._shutdown_server()
+
     async def test_callback_is_called_when_connection_is_lost(self):
         queue = asyncio.Queue()
         imap_client = aioimaplib.IMAP4(port=12345, loop=self.loop, timeout=3, conn_lost_cb=(
@@ -997,6 +2274,126 @@ class TestAioimaplibCallback(AioWithImapServer, asynctest.TestCase):
         assert 'called with None' == (await asyncio.wait_for(queue.get(), timeout=2))
 
 
+class TestResilientIMAP4(AioWithImapServer, asynctest.TestCase):
+    def setUp(self):
+        self._init_server(self.loop)
+
+    async def tearDown(self):
+        await self._shutdown_server()
+
+    async def connect_user(self, login, password, select=False, **kwargs):
+        imap_client = aioimaplib.ResilientIMAP4(port=12345, loop=self.loop, timeout=3, base_delay=0.01, **kwargs)
+        await imap_client.connect()
+        await imap_client.login(login, password)
+        if select:
+            await imap_client.select()
+        return imap_client
+
+    async def drop_connection(self, imap_client, user):
+        protocol = imap_client.protocol
+        self.imapserver.get_connection(user).transport.close()
+        while imap_client.protocol is protocol:
+            await asyncio.sleep(0.01)
+
+    async def test_reconnects_and_selects_the_mailbox(self):
+        imap_client = await self.connect_user('user', 'pass', select=True)
+        self.imapserver.receive(Mail.create(['user'], mail_from='me', subject='hello'))
+
+        await self.drop_connection(imap_client, 'user')
+        await asyncio.wait_for(imap_client.wait_connected(), 2)
+
+        assert aioimaplib.SELECTED == imap_client.get_state()
+        result, data = await imap_client.fetch('1', '(UID)')
+        assert 'OK' == result
+        assert [b'1 FETCH (UID 1)', b'FETCH completed.'] == data
+
+        await imap_client.logout()
+
+    async def test_reconnects_with_a_refreshed_token(self):
+        tokens = iter(['token2', 'token3'])
+
+        async def refresh():
+            return next(tokens)
+        imap_client = aioimaplib.ResilientIMAP4(port=12345, loop=self.loop, timeout=3, base_delay=0.01,
+                                                token_refresher=refresh)
+        await imap_client.connect()
+        await imap_client.xoauth2('user', 'token1')
+
+        await self.drop_connection(imap_client, 'user')
+        await asyncio.wait_for(imap_client.wait_connected(), 2)
+
+        assert aioimaplib.AUTH == imap_client.get_state()
+        assert ('XOAUTH2', 'user', 'token2') == imap_client._credentials
+
+        await imap_client.logout()
+
+    async def test_download_is_resumed_after_reconnection(self):
+        uid, = self.imapserver.receive(Mail.create(['user'], mail_from='me', subject='big', content='x' * 1000))
+        imap_client = await self.connect_user('user', 'pass', select=True)
+        expected = await imap_client.fetch_range(uid, 0, 10000)
+        offsets = list()
+        received = bytearray()
+
+        def sink(offset, data):
+            if not offsets:
+                self.imapserver.get_connection('user').transport.close()
+            offsets.append(offset)
+            received.extend(data)
+
+        size = await asyncio.wait_for(imap_client.download(uid, sink, chunk_size=300), 3)
+
+        assert len(expected) == size
+        assert list(range(0, size, 300)) == offsets
+        assert expected == received
+
+        await imap_client.logout()
+
+    async def test_pending_command_fails_with_connection_lost(self):
+        imap_client = await self.connect_user('user', 'pass', select=True)
+        command = Command('NOOP', imap_client.protocol.new_tag(), loop=self.loop)
+        imap_client.protocol.pending_sync_command = command
+
+        await self.drop_connection(imap_client, 'user')
+
+        with pytest.raises(ConnectionLost):
+            await asyncio.wait_for(command.wait(), 1)
+        await asyncio.wait_for(imap_client.wait_connected(), 2)
+
+        await imap_client.logout()
+
+    async def test_resumes_idle(self):
+        imap_client = await self.connect_user('user', 'pass', select=True)
+        idle = await imap_client.idle_start(timeout=5)
+
+        await self.drop_connection(imap_client, 'user')
+        await asyncio.wait_for(imap_client.wait_connected(), 2)
+        assert imap_client.is_idling()
+        assert not idle.done()
+
+        self.imapserver.receive(Mail.create(to=['user'], mail_from='me', subject='hello'))
+        assert [b'1 EXISTS', b'1 RECENT'] == (await imap_client.wait_server_push(timeout=2))
+
+        imap_client.idle_done()
+        assert ('OK', [b'IDLE terminated']) == (await asyncio.wait_for(idle, 1))
+        await imap_client.logout()
+
+    async def test_gives_up_after_max_attempts(self):
+        imap_client = await self.connect_user('user', 'pass', max_attempts=2)
+
+        await self._shutdown_server()
+        while imap_client._reconnection is None:
+            await asyncio.sleep(0.01)
+
+        with pytest.raises(ConnectionLost):
+            await asyncio.wait_for(imap_client.wait_connected(), 2)
+
+    def test_backoff_delay_is_bounded(self):
+        imap_client = aioimaplib.ResilientIMAP4(loop=self.loop, base_delay=0.5, max_delay=4)
+
+        for attempt in range(10):
+            assert 0 <= imap_client.backoff_delay(attempt) <= min(4, 0.5 * 2 ** attempt)
+
+
 class TestAioimaplibSSL(WithImapServer, asynctest.TestCase):
     """ Test the aioimaplib with SSL
 
@@ -1025,3 +2422,16 @@ class TestAioimaplibSSL(WithImapServer, asynctest.TestCase):
         assert 'IMAP4REV1' == imap_client.protocol.imap_version
         assert {'IMAP4rev1', 'YESAUTH'} == imap_client.protocol.capabilities
         assert imap_client.has_capability('YESAUTH')
+
+    async def test_tls_session_is_resumed_when_reconnecting(self):
+        ssl_context = aioimaplib.SessionCachingSSLContext.create_default(cafile=self._cert_file)
+
+        reused = list()
+        for _ in range(2):
+            imap_client = aioimaplib.IMAP4_SSL(port=12345, loop=self.loop, ssl_context=ssl_context)
+            await imap_client.connect()
+            reused.append(imap_client.protocol.transport.get_extra_info('ssl_object').session_reused)
+            await imap_client.logout()
+
+        assert [False, True] == reused
+        assert ('127.0.0.1', 12345) in ssl_context.tls_sessions
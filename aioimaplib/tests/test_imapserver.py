@@ -26,9 +26,11 @@ import functools
 import asynctest
 import pytz
 import sys
+from mock import MagicMock
 
 from aioimaplib.tests import imapserver
-from aioimaplib.tests.imapserver import ServerState, Mail, MockImapServer, ImapProtocol, InvalidUidSet
+from aioimaplib.tests.imapserver import ServerState, Mail, MockImapServer, ImapProtocol, InvalidUidSet, \
+    NetworkConditions
 import pytest
 
 
@@ -144,16 +146,170 @@ class TestServerState(unittest.TestCase):
         assert 1 == server_state.max_id('user', 'INBOX')
         assert 3 == server_state.max_uid('user', 'INBOX')
 
+    def test_uids_are_not_reused_after_removing_the_last_message(self):
+        server_state = ServerState()
+        server_state.add_mail('user', Mail.create(['user']), mailbox='INBOX')
+        server_state.add_mail('user', Mail.create(['user']), mailbox='INBOX')
+
+        server_state.remove_byid('user', 'INBOX', 2)
+
+        assert 3 == server_state.add_mail('user', Mail.create(['user']), mailbox='INBOX')
+        assert [1, 3] == [m.uid for m in server_state.get_mailbox_messages('user', 'INBOX')]
+
+
+class TestMailbox(unittest.TestCase):
+    def setUp(self):
+        self.mailbox = imapserver.Mailbox()
+        for _ in range(5):
+            self.mailbox.append(Mail.create(['user']))
+        self.mailbox.remove_by_uid(2)
+
+    def test_get_by_uid_sets_sequence_number(self):
+        assert 3 == self.mailbox.get_by_uid(4).id
+        assert self.mailbox.get_by_uid(2) is None
+
+    def test_by_uids_with_range(self):
+        assert [(2, 3), (3, 4)] == [(m.id, m.uid) for m in self.mailbox.by_uids(range(2, 5))]
+        assert [3, 4, 5] == [m.uid for m in self.mailbox.by_uids(range(3, sys.maxsize))]
+
+    def test_by_uids_with_list(self):
+        assert [(1, 1), (4, 5)] == [(m.id, m.uid) for m in self.mailbox.by_uids([5, 1, 2])]
+
+    def test_by_ids(self):
+        assert [(2, 3), (3, 4)] == [(m.id, m.uid) for m in self.mailbox.by_ids(range(2, 4))]
+        assert [(4, 5)] == [(m.id, m.uid) for m in self.mailbox.by_ids([4, 12])]
+        assert [1, 3, 4, 5] == [m.uid for m in self.mailbox.by_ids(range(1, sys.maxsize))]
+
+    def test_remove_unknown_uid_keeps_index(self):
+        with self.assertRaises(KeyError):
+            self.mailbox.remove_by_uid(2)
+        assert [1, 3, 4, 5] == [m.uid for m in self.mailbox]
+        assert 2 == self.mailbox.get_by_uid(3).id
+
+    def test_iteration_and_indexes(self):
+        assert [(1, 1), (2, 3), (3, 4), (4, 5)] == [(m.id, m.uid) for m in self.mailbox]
+        assert (4, 5) == (self.mailbox[-1].id, self.mailbox[-1].uid)
+        assert [3, 4] == [m.uid for m in self.mailbox[1:3]]
+        assert 6 == self.mailbox.uidnext
+
+
+class TestMockImapServerPopulate(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def test_populate_users_mailboxes_and_messages(self):
+        server = MockImapServer(loop=self.loop)
+
+        users = server.populate(2, 3, 4, sizes=[(100, 1), (5000, 1)], seed=12)
+
+        assert ['user0@mail', 'user1@mail'] == users
+        for user in users:
+            for mailbox in ('INBOX', 'Folder1', 'Folder2'):
+                messages = server._server_state.get_mailbox_messages(user, mailbox)
+                assert [1, 2, 3, 4] == [m.uid for m in messages]
+            assert 0 == len(server._server_state.get_mailbox_messages(user, 'Trash'))
+
+    def test_populate_messages_sizes_follow_distribution(self):
+        server = MockImapServer(loop=self.loop)
+
+        server.populate(1, 1, 200, sizes=[(100, 9), (5000, 1)], seed=12)
+
+        sizes = [len(m.as_bytes()) for m in server._server_state.get_mailbox_messages('user0@mail', 'INBOX')]
+        assert 200 == len(sizes)
+        assert 150 < len([s for s in sizes if s < 1000]) < 200
+        assert all(s > 5000 for s in sizes if s >= 1000)
+
+    def test_parse_sizes(self):
+        assert [(2048, 70), (65536, 25), (1048576, 1)] == imapserver.parse_sizes('2048:70,65536:25,1048576')
+
+
+class TestNetworkConditions(asynctest.ClockedTestCase):
+    def new_protocol(self, **conditions):
+        protocol = ImapProtocol(ServerState(), loop=self.loop, conditions=NetworkConditions(seed=1, **conditions))
+        protocol.transport = MagicMock()
+        return protocol
+
+    def written(self, protocol):
+        return b''.join(call[0][0] for call in protocol.transport.write.call_args_list)
+
+    async def test_rtt_delays_responses(self):
+        protocol = self.new_protocol(rtt=1)
+
+        protocol.send(b'* OK\r\n')
+        await self.advance(0.4)
+        assert b'' == self.written(protocol)
+
+        await self.advance(0.2)
+        assert b'* OK\r\n' == self.written(protocol)
+
+    async def test_bandwidth_paces_responses(self):
+        protocol = self.new_protocol(bandwidth=10)
+
+        protocol.send(b'0123456789')
+        protocol.send(b'abcdefghij')
+        await self.advance(0.5)
+        assert b'0123456789' == self.written(protocol)
+
+        await self.advance(1)
+        assert b'0123456789abcdefghij' == self.written(protocol)
+
+    async def test_fragmentation_keeps_bytes_order(self):
+        protocol = self.new_protocol(max_fragment_size=3)
+
+        protocol.send(b'* 1 FETCH (FLAGS ())\r\n')
+        protocol.send(b'TAG OK FETCH completed.\r\n')
+        await self.advance(0)
+
+        assert protocol.transport.write.call_count > 10
+        assert all(len(call[0][0]) <= 3 for call in protocol.transport.write.call_args_list)
+        assert b'* 1 FETCH (FLAGS ())\r\nTAG OK FETCH completed.\r\n' == self.written(protocol)
+
+    async def test_drop_after_bytes(self):
+        protocol = self.new_protocol(drop_after_bytes=5)
+
+        protocol.send(b'* OK\r\n* BYE\r\n')
+        await self.advance(0)
+
+        assert b'* OK\r' == self.written(protocol)
+        protocol.transport.abort.assert_called_once()
+
+    async def test_drop_in_the_middle_of_a_literal(self):
+        protocol = self.new_protocol(drop_literal_probability=1)
+
+        protocol.send(b'* 1 FETCH (BODY[] {10}\r\n0123456789)\r\n')
+        await self.advance(0)
+
+        written = self.written(protocol)
+        assert written.startswith(b'* 1 FETCH (BODY[] {10}\r\n')
+        assert len(written) < len(b'* 1 FETCH (BODY[] {10}\r\n0123456789')
+        protocol.transport.abort.assert_called_once()
+
+    async def test_slow_consumer_pauses_reading(self):
+        protocol = self.new_protocol(read_rate=100)
+        protocol.transport.is_closing.return_value = False
+
+        protocol.data_received(b'A1 NOOP' + b' ' * 43 + b'\r\n')
+        protocol.transport.pause_reading.assert_called_once()
+
+        await self.advance(0.4)
+        protocol.transport.resume_reading.assert_not_called()
+        await self.advance(0.2)
+        protocol.transport.resume_reading.assert_called_once()
+
 
 class WithImapServer(object):
-    def _init_server(self, loop, capabilities=None, ssl_context=None):
+    def _init_server(self, loop, capabilities=None, ssl_context=None, starttls_context=None):
         self.loop = loop
         if capabilities is not None:
             self.imapserver = MockImapServer(loop=loop, capabilities=capabilities)
         else:
             self.imapserver = MockImapServer(loop=loop)
         self.server = self.imapserver.run_server(
-            host='127.0.0.1', port=12345, fetch_chunk_size=64, ssl_context=ssl_context
+            host='127.0.0.1', port=12345, fetch_chunk_size=64, ssl_context=ssl_context,
+            starttls_context=starttls_context
         )
 
     async def _shutdown_server(self):
@@ -19,7 +19,7 @@ import asyncio
 import asynctest
 
 from aioimaplib import extract_exists
-from aioimaplib.aioimaplib import Command
+from aioimaplib.aioimaplib import AppendCommand
 from aioimaplib.tests.test_aioimaplib import AioWithImapServer
 
 
@@ -35,11 +35,10 @@ class TestAioimaplib(AioWithImapServer, asynctest.TestCase):
         assert 0 == extract_exists((await imap_client.examine('INBOX')))
 
         message_bytes = b'do you see me ?'
-        imap_client.protocol.literal_data = message_bytes * 2
 
         args = ['INBOX', '{%s}' % len(message_bytes)]
         response = await imap_client.protocol.execute(
-            Command('APPEND', imap_client.protocol.new_tag(), *args, loop=self.loop)
+            AppendCommand(imap_client.protocol.new_tag(), message_bytes * 2, *args, loop=self.loop)
         )
         assert 'BAD' == response.result
         assert b'expected CRLF but got' in response.lines[0]
@@ -49,11 +48,10 @@ class TestAioimaplib(AioWithImapServer, asynctest.TestCase):
         assert 0 == extract_exists((await imap_client.examine('INBOX')))
 
         message_bytes = b'do you see me ?' * 2
-        imap_client.protocol.literal_data = message_bytes[:5]
 
         args = ['INBOX', '{%s}' % len(message_bytes)]
         response = await imap_client.protocol.execute(
-            Command('APPEND', imap_client.protocol.new_tag(), *args, loop=self.loop)
+            AppendCommand(imap_client.protocol.new_tag(), message_bytes[:5], *args, loop=self.loop)
         )
         assert 'BAD' == response.result
         assert b'expected 30 but was' in response.lines[0]
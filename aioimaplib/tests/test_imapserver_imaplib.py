@@ -167,7 +167,7 @@ class TestImapServerWithImaplib(WithImapServer, TestCase):
             self.loop.run_in_executor(None, functools.partial(imap_client.uid, 'fetch', '1', '(UID BODY.PEEK[])')), 1)
 
         assert 'OK' == result
-        assert [(b'1 (UID 1 BODY.PEEK[] {340}', mail.as_bytes()), b')'] == data
+        assert [(b'1 (UID 1 BODY[] {340}', mail.as_bytes()), b')'] == data
 
     async def test_fetch_one_messages_by_uid_without_body(self):
         mail = Mail.create(['user'], mail_from='me', subject='hello', content='whatever')
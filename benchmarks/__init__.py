@@ -0,0 +1,67 @@
+#    aioimaplib : an IMAPrev4 lib using python asyncio
+#    Copyright (C) 2016  Bruno Thomas
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Benchmarks for aioimaplib hot paths.
+
+Run them from the repository root with ``python -m benchmarks``. Each case is
+run once for timing and once under tracemalloc for the peak memory, so the
+timings are not skewed by the memory tracing.
+"""
+import asyncio
+import gc
+import time
+import tracemalloc
+from collections import namedtuple
+from typing import Awaitable, Callable, Tuple
+
+MB = 1024 * 1024
+
+BenchResult = namedtuple('BenchResult', 'name messages nbytes seconds peak_memory')
+
+# a case returns (number of messages, number of bytes) processed
+Case = Callable[[], Awaitable[Tuple[int, int]]]
+
+
+def run_case(loop: asyncio.AbstractEventLoop, name: str, case: Case, repeat: int = 3) -> BenchResult:
+    best = None
+    messages, nbytes = 0, 0
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        messages, nbytes = loop.run_until_complete(case())
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        loop.run_until_complete(case())
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return BenchResult(name, messages, nbytes, best, peak)
+
+
+def format_header() -> str:
+    return '%-32s %9s %9s %9s %12s %9s %10s' % ('case', 'messages', 'MB', 'seconds', 'msgs/s', 'MB/s', 'peak MB')
+
+
+def format_result(result: BenchResult) -> str:
+    seconds = result.seconds or float('inf')
+    return '%-32s %9d %9.2f %9.4f %12.0f %9.2f %10.2f' % (
+        result.name, result.messages, result.nbytes / MB, result.seconds,
+        result.messages / seconds, result.nbytes / MB / seconds, result.peak_memory / MB)
@@ -0,0 +1,54 @@
+#    aioimaplib : an IMAPrev4 lib using python asyncio
+#    Copyright (C) 2016  Bruno Thomas
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import argparse
+import asyncio
+import logging
+
+from benchmarks import run_case, format_header, format_result, bench_parser, bench_client
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks', description='aioimaplib benchmarks')
+    parser.add_argument('-s', '--suite', choices=('all', 'parser', 'client'), default='all')
+    parser.add_argument('-n', '--messages', type=int, default=2000, help='number of messages per case')
+    parser.add_argument('--size', type=int, default=4096, help='size of the synthetic messages (bytes)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='timing runs per case (best is kept)')
+    parser.add_argument('-k', '--filter', default='', help='only run cases containing this string')
+    args = parser.parse_args()
+
+    logging.getLogger('aioimaplib.tests.imapserver').setLevel(logging.WARNING)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    print(format_header())
+    if args.suite in ('all', 'parser'):
+        for name, case in bench_parser.cases(args.messages, args.size):
+            if args.filter in name:
+                print(format_result(run_case(loop, name, case, args.repeat)), flush=True)
+
+    if args.suite in ('all', 'client'):
+        bench = bench_client.ClientBench(loop, args.messages, args.size)
+        try:
+            for name, case in bench_client.cases(bench):
+                if args.filter in name:
+                    print(format_result(run_case(loop, name, case, args.repeat)), flush=True)
+        finally:
+            bench.close()
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
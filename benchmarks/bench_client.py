@@ -0,0 +1,93 @@
+#    aioimaplib : an IMAPrev4 lib using python asyncio
+#    Copyright (C) 2016  Bruno Thomas
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+End to end throughput of the IMAP4 client against the bundled MockImapServer.
+Client and server share the same loop, so the figures include the server cost.
+"""
+import asyncio
+from typing import Tuple
+
+from aioimaplib import aioimaplib
+from aioimaplib.tests.imapserver import MockImapServer, Mail
+
+USER = 'bench@mail'
+
+
+class ClientBench(object):
+    def __init__(self, loop: asyncio.AbstractEventLoop, nb_messages: int, message_size: int) -> None:
+        self.loop = loop
+        self.nb_messages = nb_messages
+        self.message_size = message_size
+        self.imapserver = MockImapServer(loop=loop)
+        self.server = self.imapserver.run_server(host='127.0.0.1', port=0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+        self.content = 'x' * message_size
+        for _ in range(nb_messages):
+            self.imapserver.receive(Mail.create([USER], mail_from='me@bench', subject='bench', content=self.content),
+                                    imap_user=USER)
+
+    def close(self) -> None:
+        self.imapserver.reset()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+
+    async def client(self) -> aioimaplib.IMAP4:
+        imap_client = aioimaplib.IMAP4(port=self.port, loop=self.loop, timeout=60)
+        await imap_client.connect()
+        await imap_client.login(USER, 'pass')
+        await imap_client.select()
+        return imap_client
+
+    async def fetch_flags(self) -> Tuple[int, int]:
+        imap_client = await self.client()
+        response = await imap_client.uid('fetch', '1:*', '(UID FLAGS)')
+        await imap_client.logout()
+        return self.nb_messages, sum(len(line) for line in response.lines)
+
+    async def fetch_bodies(self) -> Tuple[int, int]:
+        imap_client = await self.client()
+        response = await imap_client.fetch('1:*', '(BODY.PEEK[])')
+        await imap_client.logout()
+        return self.nb_messages, sum(len(line) for line in response.lines)
+
+    async def search(self) -> Tuple[int, int]:
+        imap_client = await self.client()
+        nb, size = 0, 0
+        for _ in range(10):
+            response = await imap_client.uid_search('ALL')
+            nb += len(response.lines[0].split())
+            size += sum(len(line) for line in response.lines)
+        await imap_client.logout()
+        return nb, size
+
+    async def append(self) -> Tuple[int, int]:
+        imap_client = await self.client()
+        message = Mail.create([USER], mail_from='me@bench', subject='bench append', content=self.content).as_bytes()
+        for _ in range(self.nb_messages):
+            response = await imap_client.append(message, mailbox='Sent')
+            assert 'OK' == response.result, response
+        await imap_client.logout()
+        return self.nb_messages, self.nb_messages * len(message)
+
+
+def cases(bench: ClientBench):
+    return [
+        ('client uid fetch flags', bench.fetch_flags),
+        ('client fetch bodies', bench.fetch_bodies),
+        ('client uid search all x10', bench.search),
+        ('client append', bench.append),
+    ]
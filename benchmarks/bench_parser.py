@@ -0,0 +1,110 @@
+#    aioimaplib : an IMAPrev4 lib using python asyncio
+#    Copyright (C) 2016  Bruno Thomas
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Drives IMAP4ClientProtocol.data_received with synthetic server transcripts,
+without any socket: only the response parsing is measured.
+"""
+import asyncio
+import os
+from typing import Iterator, List, Tuple
+
+from aioimaplib.aioimaplib import IMAP4, IMAP4ClientProtocol, FetchCommand, SELECTED, parse_list_status
+
+ATTACHMENT_EML = os.path.join(os.path.dirname(__file__), '..', 'aioimaplib', 'tests', 'data', 'test_attachment.eml')
+TAG = 'BENCH1'
+# ethernet MSS : what a server writing small segments would produce
+MSS = 1460
+# max read size of asyncio selector transports
+READ_SIZE = 256 * 1024
+
+
+class NullTransport(asyncio.Transport):
+    def write(self, data: bytes) -> None:
+        pass
+
+
+def flags_transcript(nb_messages: int) -> bytes:
+    return b''.join(b'* %d FETCH (UID %d FLAGS (\\Seen \\Answered $Label1))\r\n' % (i, i + 1000)
+                    for i in range(1, nb_messages + 1)) + TAG.encode() + b' OK FETCH completed.\r\n'
+
+
+def literal_transcript(nb_messages: int, message_size: int) -> bytes:
+    body = (b'x' * 76 + b'\r\n') * (message_size // 78) + b'y' * (message_size % 78)
+    return b''.join(b'* %d FETCH (UID %d BODY[] {%d}\r\n%s)\r\n' % (i, i + 1000, len(body), body)
+                    for i in range(1, nb_messages + 1)) + TAG.encode() + b' OK FETCH completed.\r\n'
+
+
+def attachment_transcript(nb_messages: int) -> bytes:
+    with open(ATTACHMENT_EML, 'rb') as eml:
+        body = eml.read()
+    return b''.join(b'* %d FETCH (UID %d RFC822 {%d}\r\n%s)\r\n' % (i, i + 1000, len(body), body)
+                    for i in range(1, nb_messages + 1)) + TAG.encode() + b' OK FETCH completed.\r\n'
+
+
+def list_status_lines(nb_mailboxes: int) -> List[bytes]:
+    lines = list()
+    for i in range(nb_mailboxes):
+        lines.append(b'LIST (\\HasNoChildren \\Marked) "/" "Archives/%d/Folder name"' % i)
+        lines.append(b'STATUS "Archives/%d/Folder name" (MESSAGES %d UNSEEN 3 UIDNEXT %d HIGHESTMODSEQ 91827)'
+                     % (i, i * 7, i * 7 + 1))
+    return lines
+
+
+def chunks(data: bytes, chunk_size: int) -> Iterator[bytes]:
+    for index in range(0, len(data), chunk_size):
+        yield data[index:index + chunk_size]
+
+
+def feed(transcript: bytes, chunk_size: int, timeout: float = IMAP4.TIMEOUT_SECONDS) -> List[bytes]:
+    loop = asyncio.get_event_loop()
+    protocol = IMAP4ClientProtocol(loop)
+    protocol.connection_made(NullTransport())
+    protocol.state = SELECTED
+    command = FetchCommand(TAG, '1:*', '(UID FLAGS)', loop=loop, timeout=timeout)
+    protocol.pending_async_commands[command.untagged_resp_name] = command
+
+    for chunk in chunks(transcript, chunk_size):
+        protocol.data_received(chunk)
+
+    assert 'OK' == command.response.result, command.response
+    return command.response.lines
+
+
+def cases(nb_messages: int, message_size: int):
+    flags = flags_transcript(nb_messages)
+    literals = literal_transcript(nb_messages, message_size)
+    attachments = attachment_transcript(max(1, nb_messages // 100))
+
+    list_status = list_status_lines(nb_messages)
+
+    async def parse_mailboxes() -> Tuple[int, int]:
+        parse_list_status(list_status)
+        return nb_messages, sum(len(line) for line in list_status)
+
+    def case(transcript: bytes, chunk_size: int, nb: int):
+        async def run() -> Tuple[int, int]:
+            feed(transcript, chunk_size)
+            return nb, len(transcript)
+        return run
+
+    return [
+        ('parse fetch flags', case(flags, READ_SIZE, nb_messages)),
+        ('parse fetch flags mss chunks', case(flags, MSS, nb_messages)),
+        ('parse fetch body literals', case(literals, READ_SIZE, nb_messages)),
+        ('parse fetch body mss chunks', case(literals, MSS, nb_messages)),
+        ('parse fetch attachments', case(attachments, READ_SIZE, max(1, nb_messages // 100))),
+        ('parse list status', parse_mailboxes),
+    ]
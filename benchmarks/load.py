@@ -0,0 +1,140 @@
+#    aioimaplib : an IMAPrev4 lib using python asyncio
+#    Copyright (C) 2016  Bruno Thomas
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+Load driver : runs concurrent aioimaplib sessions against an IMAP server and
+reports the client throughput. Each session logs in as one of the
+populated users and loops over SELECT, UID SEARCH, FETCH FLAGS of the last
+messages and FETCH BODY.PEEK[] of a random message.
+
+Against a server started with
+``python -m aioimaplib.tests.imapserver --users 100 --mailboxes 3 --messages 1000``::
+
+    python -m benchmarks.load --port 1143 --users 100 --mailboxes 3 --sessions 200 --duration 30
+
+With --embedded the mock server is started in the same process (and loop),
+so its throughput is reported too.
+"""
+import argparse
+import asyncio
+import logging
+import random
+import time
+from collections import Counter
+
+from aioimaplib import aioimaplib
+from aioimaplib.tests.imapserver import MockImapServer, parse_sizes
+
+MB = 1024 * 1024
+
+
+class Session(object):
+    def __init__(self, args: argparse.Namespace, user: str, rand: random.Random, stats: Counter) -> None:
+        self.args = args
+        self.user = user
+        self.rand = rand
+        self.stats = stats
+
+    def account(self, response: aioimaplib.Response) -> None:
+        self.stats['commands'] += 1
+        self.stats['bytes'] += sum(len(line) for line in response.lines)
+        if response.result != 'OK':
+            self.stats['errors'] += 1
+
+    async def run(self, deadline: float) -> None:
+        imap_client = aioimaplib.IMAP4(host=self.args.host, port=self.args.port, timeout=self.args.timeout)
+        await imap_client.connect()
+        self.account(await imap_client.login(self.user, 'pass'))
+        mailboxes = ['INBOX'] + ['Folder%d' % i for i in range(1, self.args.mailboxes)]
+
+        while time.monotonic() < deadline:
+            response = await imap_client.select(self.rand.choice(mailboxes))
+            self.account(response)
+            exists = aioimaplib.extract_exists(response) or 0
+
+            self.account(await imap_client.uid_search('ALL'))
+            if exists:
+                first = max(1, exists - self.args.window + 1)
+                response = await imap_client.fetch('%d:%d' % (first, exists), '(UID FLAGS)')
+                self.account(response)
+                response = await imap_client.fetch(str(self.rand.randint(1, exists)), '(BODY.PEEK[])')
+                self.account(response)
+                self.stats['messages'] += 1
+            self.stats['iterations'] += 1
+
+        self.account(await imap_client.logout())
+
+
+async def drive(args: argparse.Namespace) -> Counter:
+    stats = Counter()
+    rand = random.Random(args.seed)
+    users = ['user%d@mail' % i for i in range(args.users)]
+    deadline = time.monotonic() + args.duration
+    sessions = [Session(args, users[i % len(users)], random.Random(rand.random()), stats)
+                for i in range(args.sessions)]
+    results = await asyncio.gather(*[session.run(deadline) for session in sessions], return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            stats['failed_sessions'] += 1
+            logging.getLogger(__name__).warning('session failed: %r', result)
+    return stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.load', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=1143)
+    parser.add_argument('--users', type=int, default=10, help='number of populated users (user0@mail...)')
+    parser.add_argument('--mailboxes', type=int, default=1, help='number of mailboxes per user')
+    parser.add_argument('--sessions', type=int, default=20, help='concurrent sessions')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds')
+    parser.add_argument('--window', type=int, default=50, help='number of messages fetched with FLAGS')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--embedded', action='store_true', help='starts a populated mock server in process')
+    parser.add_argument('--messages', type=int, default=100, help='messages per mailbox (embedded server)')
+    parser.add_argument('--sizes', default='4096', type=parse_sizes, help='size:weight list (embedded server)')
+    args = parser.parse_args()
+
+    logging.getLogger('aioimaplib.tests.imapserver').setLevel(logging.WARNING)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    imapserver = server = None
+    if args.embedded:
+        imapserver = MockImapServer(loop=loop)
+        imapserver.populate(args.users, args.mailboxes, args.messages, args.sizes, args.seed)
+        server = imapserver.run_server(host=args.host, port=args.port)
+
+    start = time.monotonic()
+    stats = loop.run_until_complete(drive(args))
+    elapsed = time.monotonic() - start
+
+    print('client: %d sessions (%d failed), %d commands in %.1fs : %.0f commands/s, %.0f msgs/s, %.2f MB/s, %d errors' % (
+        args.sessions, stats['failed_sessions'], stats['commands'], elapsed, stats['commands'] / elapsed,
+        stats['messages'] / elapsed, stats['bytes'] / MB / elapsed, stats['errors']))
+    if imapserver is not None:
+        server_stats = imapserver.stats
+        print('server: %d connections, %.0f commands/s, %.2f MB/s sent, %.2f MB/s received' % (
+            server_stats['connections'], server_stats['commands'] / elapsed,
+            server_stats['bytes_sent'] / MB / elapsed, server_stats['bytes_received'] / MB / elapsed))
+        imapserver.reset()
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()